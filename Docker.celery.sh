@@ -1,4 +1,22 @@
 #!/bin/sh -ex
-celery -A backend.celery beat -l info &
-celery -A backend.celery worker -l info &
+# CELERY_WORKER_ROLES selects the workers this container runs, so roles
+# can be split across containers, e.g. CELERY_WORKER_ROLES="beat otp".
+for role in ${CELERY_WORKER_ROLES:-beat otp default bulk}; do
+  case "$role" in
+    beat)
+      celery -A backend.celery beat -l info &
+      ;;
+    otp)
+      celery -A backend.celery worker -l info -n otp@%h -Q otp \
+        -c "${CELERY_OTP_CONCURRENCY:-8}" --prefetch-multiplier 1 -O fair &
+      ;;
+    default)
+      celery -A backend.celery worker -l info -n default@%h -Q celery &
+      ;;
+    bulk)
+      celery -A backend.celery worker -l info -n bulk@%h -Q bulk \
+        -c "${CELERY_BULK_CONCURRENCY:-2}" --prefetch-multiplier 1 -O fair &
+      ;;
+  esac
+done
 tail -f /dev/null
\ No newline at end of file
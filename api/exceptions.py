@@ -0,0 +1,19 @@
+from rest_framework.views import exception_handler as default_handler
+
+from backend.metrics import REGISTRY
+from backend.middleware import get_route
+
+api_exceptions = REGISTRY.counter(
+    'api_exceptions_total', 'Exceptions handled by DRF views.',
+    ('route', 'exception'),
+)
+
+
+def exception_handler(exc, context):
+    """
+    DRF exception handler that counts handled exceptions (validation
+    errors, throttling, authentication failures...) per route.
+    """
+
+    api_exceptions.inc(get_route(context['request']), type(exc).__name__)
+    return default_handler(exc, context)
@@ -0,0 +1,15 @@
+from rest_framework.pagination import CursorPagination
+
+
+class UserCursorPagination(CursorPagination):
+    """
+    Keyset pagination over the primary key.
+
+    Pages are fetched with ``WHERE id > <cursor> ORDER BY id LIMIT n``, so
+    latency does not grow with depth and no ``COUNT(*)`` is run.
+    """
+
+    ordering = 'id'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
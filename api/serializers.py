@@ -34,3 +34,45 @@ class UserCreateSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         return User.objects.create_user(**validated_data)
+
+
+class ValuesRowSerializer:
+    """
+    Read-only fast path for the fields of a ``ModelSerializer``.
+
+    Works on ``.values()`` rows instead of model instances. The field plan
+    is compiled once: fields whose representation equals the database
+    value are copied, the rest go through the field's
+    ``to_representation``.
+    """
+
+    passthrough_fields = (
+        serializers.CharField,
+        serializers.IntegerField,
+        serializers.BooleanField,
+    )
+
+    def __init__(self, serializer_class):
+        self.plan = []
+        for name, field in serializer_class().fields.items():
+            if field.write_only:
+                continue
+            convert = (
+                None if isinstance(field, self.passthrough_fields)
+                else field.to_representation
+            )
+            self.plan.append((name, field.source, convert))
+        self.columns = [source for _, source, _ in self.plan]
+
+    def to_representation(self, row):
+        return {
+            name: row[source] if convert is None or row[source] is None
+            else convert(row[source])
+            for name, source, convert in self.plan
+        }
+
+    def many(self, rows):
+        return [self.to_representation(row) for row in rows]
+
+
+user_basic_rows = ValuesRowSerializer(UserBasicSerializer)
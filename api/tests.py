@@ -1 +1,1110 @@
-from django.test import TestCase
+import gzip
+import json
+import smtplib
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock, skipIf
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password
+from django.core import mail
+from django.core.cache import caches
+from django.core.mail.backends.smtp import EmailBackend
+from django.db import DatabaseError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_celery_results.models import TaskResult
+from drf_yasg.codecs import OpenAPICodecJson
+from drf_yasg.generators import OpenAPISchemaGenerator
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from backend.metrics import REGISTRY, RedisAggregator, Registry
+from backend.publisher import (OVERFLOW_BLOCK, OVERFLOW_DROP, OVERFLOW_SYNC,
+                               BackgroundPublisher,
+                               publisher_messages, publisher_queue_depth)
+from backend.schema import _specs, spec_path
+from backend.smtp_pool import (SMTPConnectionPool, SMTPPoolExhausted,
+                               close_smtp_pool, get_pool, open_smtp_pool)
+from backend.task_metrics import (EMAIL_SENT, TASK_REGISTRY, emails_total,
+                                  push_task_metrics)
+from backend.celery import store_task_failure
+from backend.task_results import (RESULT_POLICY_ALL, RESULT_POLICY_FAILURES,
+                                  result_annotations)
+from backend.mail import (OTP_EMAIL_BUFFER_KEY, OTP_EMAIL_FLUSH_LOCK_KEY,
+                          send_otp_messages)
+from backend.tasks import (flush_otp_email_batch, import_user_rows,
+                           send_otp_email_celery)
+from users.bulk import stage_import
+from users.maintenance import purge_expired
+from users.models import User, UserImport
+from users.otp import issue_otp
+from users.revocation import RevocationStore
+from users.testing import create_user, fakeredis_caches, token_client
+
+from .renderers import FastJSONRenderer
+from .serializers import UserBasicSerializer, user_basic_rows
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+FAST_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class QueryBudgetTests(TestCase):
+    """
+    Fixed query budgets of the hot endpoints with the default settings
+    (locmem cache, database OTP and attempt stores). Savepoints count.
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = create_user(verified=True)
+        self.user.set_password('Secret-123')
+        self.user.save()
+        self.client = APIClient()
+        self.use_synced_revocation_store()
+
+    def use_synced_revocation_store(self):
+        # A store that synced just now, as between two sync intervals.
+        store = RevocationStore(
+            settings.REVOCATION_CACHE_ALIAS, sync_interval=3600,
+            capacity=1000, error_rate=0.001, max_age=3600,
+        )
+        store.is_revoked('warm-up')
+        patcher = mock.patch('users.revocation._store', store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, path, data):
+        return self.client.post(path, data, format='json')
+
+    def user_list_queries(self):
+        admin = create_user('admin@example.com', verified=True,
+                            is_superuser=True)
+        for i in range(20):
+            create_user(f'user{i}@example.com')
+        client = token_client(admin)
+        client.get('/api/users/')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/users/')
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_user_list(self):
+        # Without a shared cache: the user row, as JWTAuthentication
+        # selects it, and one page of users.
+        self.assertEqual(self.user_list_queries(), 2)
+
+    @skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_user_list_with_a_shared_cache(self):
+        with self.settings(CACHES=fakeredis_caches(shared_default=True)):
+            self.use_synced_revocation_store()
+            # The token version comes from the cache: one page of users.
+            self.assertEqual(self.user_list_queries(), 1)
+
+    def test_create_user(self):
+        data = {
+            'email': 'new@example.com', 'username': 'new',
+            'first_name': 'First', 'last_name': 'Last',
+            'password': 'Secret-123',
+        }
+        # Existing user lookup, email and username uniqueness, savepoint,
+        # user insert, OTP upsert, attempt reset, release.
+        with self.assertNumQueries(8):
+            response = self.post('/api/users/', data)
+        self.assertEqual(response.status_code, 200)
+        # Ends the coalescing window and drops the cached user.
+        caches['default'].clear()
+        # Registering again re-issues the OTP of the unverified user:
+        # user, savepoint, OTP upsert, attempt reset, release.
+        with self.assertNumQueries(5):
+            response = self.post('/api/users/', data)
+        self.assertEqual(response.status_code, 200)
+        # Coalesced within OTP_COALESCE_WINDOW and the user read from the
+        # cache: savepoint and release only.
+        with self.assertNumQueries(2):
+            response = self.post('/api/users/', data)
+        self.assertEqual(response.status_code, 200)
+
+    def test_otp(self):
+        # User, savepoint, OTP upsert, attempt reset, release.
+        with self.assertNumQueries(5):
+            response = self.post('/api/otp/', {'email': self.user.email})
+        self.assertEqual(response.status_code, 200)
+        # Coalesced within OTP_COALESCE_WINDOW: no OTP or attempt writes.
+        with self.assertNumQueries(3):
+            response = self.post('/api/otp/', {'email': self.user.email})
+        self.assertEqual(response.status_code, 200)
+
+    def test_verify(self):
+        user = create_user('new@example.com')
+        otp = issue_otp(user)
+        # User, reserve try, savepoint, consume, mark verified and reset
+        # tries, release.
+        with self.assertNumQueries(6):
+            response = self.post(
+                '/api/verify/', {'email': user.email, 'otp': otp}
+            )
+        self.assertEqual(response.status_code, 200)
+
+    def test_verify_wrong_code(self):
+        user = create_user('new@example.com')
+        issue_otp(user)
+        # User, reserve try, savepoint, failed consume, expiry check,
+        # release.
+        with self.assertNumQueries(6):
+            response = self.post(
+                '/api/verify/', {'email': user.email, 'otp': 'nope00'}
+            )
+        self.assertEqual(response.status_code, 400)
+
+    def test_login(self):
+        otp = issue_otp(self.user)
+        data = {'email': self.user.email, 'password': 'Secret-123'}
+        # Rejected before the password is hashed: user, reserve try,
+        # OTP peek.
+        with self.assertNumQueries(3):
+            response = self.post(
+                '/auth/token/login/', {**data, 'otp': '000000'}
+            )
+        self.assertEqual(response.status_code, 400)
+        # User, reserve try, OTP peek, savepoint, consume, reset tries,
+        # release.
+        with self.assertNumQueries(7):
+            response = self.post('/auth/token/login/', {**data, 'otp': otp})
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class AuthViewTests(TestCase):
+    """
+    Status codes and bodies of the OTP, verification and login views.
+    """
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+
+    def post(self, path, data):
+        return self.client.post(path, data, format='json')
+
+    def test_otp_errors(self):
+        response = self.post('/api/otp/', {})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': 'Email is required'})
+        response = self.post('/api/otp/', {'email': 'nobody@example.com'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data, {'error': 'User with this email doesnt exist'}
+        )
+
+    def test_otp_is_dispatched(self):
+        user = create_user()
+        with mock.patch('api.views.dispatch_otp_email') as dispatch:
+            response = self.post('/api/otp/', {'email': user.email})
+        self.assertEqual(response.status_code, 200)
+        dispatch.assert_called_once_with(user.email, mock.ANY)
+
+    def test_verify_consumes_the_code(self):
+        user = create_user()
+        otp = issue_otp(user)
+        data = {'email': user.email, 'otp': otp}
+        response = self.post('/api/verify/', data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {
+            'message': 'Account verified successfully. Now you can log in.'
+        })
+        user.refresh_from_db()
+        self.assertTrue(user.verified)
+        response = self.post('/api/verify/', data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': 'Email already verified'})
+
+    def test_verify_errors(self):
+        user = create_user()
+        issue_otp(user)
+        response = self.post('/api/verify/', {'email': user.email})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data, {'error': 'Email and OTP code are required'}
+        )
+        response = self.post(
+            '/api/verify/', {'email': user.email, 'otp': '000000'}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': 'Invalid OTP code or email'})
+        for _ in range(settings.OTP_MAX_TRIES):
+            self.post('/api/verify/', {'email': user.email, 'otp': '000000'})
+        response = self.post(
+            '/api/verify/', {'email': user.email, 'otp': '000000'}
+        )
+        self.assertEqual(response.data, {
+            'error': 'Exceeded maximum tries for OTP verification'
+        })
+
+    def test_login_consumes_the_code(self):
+        user = create_user(verified=True)
+        user.set_password('Secret-123')
+        user.save()
+        otp = issue_otp(user)
+        data = {'email': user.email, 'password': 'Secret-123', 'otp': otp}
+        response = self.post('/auth/token/login/', data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            set(response.data), {'auth_token', 'refresh_token'}
+        )
+        response = self.post('/auth/token/login/', data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data, {'non_field_errors': ['Invalid OTP.']}
+        )
+
+    def test_login_errors(self):
+        user = create_user()
+        response = self.post('/auth/token/login/', {'email': user.email})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.data), {'password', 'otp'})
+        response = self.post('/auth/token/login/', {
+            'email': user.email, 'password': 'x', 'otp': '000000'
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {
+            'non_field_errors': ['Your email is not verified yet.']
+        })
+
+
+class ClientIPThrottleTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+
+    def request_otps(self, count):
+        statuses = []
+        for i in range(count):
+            response = self.client.post(
+                '/api/otp/', {'email': f'user{i}@example.com'},
+                format='json', HTTP_X_FORWARDED_FOR=f'10.0.0.{i}'
+            )
+            statuses.append(response.status_code)
+        return statuses
+
+    def test_forwarded_for_is_ignored_without_proxies(self):
+        statuses = self.request_otps(21)
+        self.assertNotIn(429, statuses[:20])
+        self.assertEqual(statuses[20], 429)
+
+    def test_forwarded_for_is_used_behind_a_proxy(self):
+        with override_settings(
+            REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}
+        ):
+            statuses = self.request_otps(21)
+        self.assertNotIn(429, statuses)
+
+
+@override_settings(
+    PASSWORD_HASHERS=FAST_HASHERS,
+    AUTH_THROTTLE_RATES={
+        name: {'ip': '4/min', 'email': '2/min'}
+        for name in ('one_time_password', 'verify_account',
+                     'token_obtain_pair')
+    },
+)
+class AuthThrottleTests(TestCase):
+    """
+    Token buckets of the public auth endpoints, keyed by client IP and by
+    the target email.
+    """
+
+    paths = ['/api/otp/', '/api/verify/', '/auth/token/login/']
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+
+    def post(self, path, email):
+        return self.client.post(
+            path, {'email': email, 'otp': '000000', 'password': 'x'},
+            format='json',
+        )
+
+    def test_rejected_requests_make_no_queries(self):
+        for path in self.paths:
+            with self.subTest(path=path):
+                for _ in range(2):
+                    response = self.post(path, f'a@{path.strip("/")}.com')
+                    self.assertNotEqual(response.status_code, 429)
+                # The email bucket is empty, the IP bucket is not.
+                with self.assertNumQueries(0):
+                    response = self.post(path, f'A@{path.strip("/")}.com ')
+                self.assertEqual(response.status_code, 429)
+                self.assertIn('Retry-After', response)
+                response = self.post(path, f'b@{path.strip("/")}.com')
+                self.assertNotEqual(response.status_code, 429)
+                # Four requests, the rejected one included, used up the IP
+                # bucket.
+                with self.assertNumQueries(0):
+                    response = self.post(path, f'c@{path.strip("/")}.com')
+                self.assertEqual(response.status_code, 429)
+
+    def test_buckets_refill(self):
+        for _ in range(2):
+            self.post('/api/otp/', 'a@example.com')
+        self.assertEqual(
+            self.post('/api/otp/', 'a@example.com').status_code, 429
+        )
+        later = time.time() + 31
+        with mock.patch('time.time', return_value=later):
+            response = self.post('/api/otp/', 'a@example.com')
+        self.assertNotEqual(response.status_code, 429)
+
+    @skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_buckets_can_live_in_redis(self):
+        with self.settings(CACHES=fakeredis_caches(),
+                           THROTTLE_CACHE_ALIAS='redis'):
+            statuses = [
+                self.post('/api/otp/', f'user{i}@example.com').status_code
+                for i in range(5)
+            ]
+        self.assertNotIn(429, statuses[:4])
+        self.assertEqual(statuses[4], 429)
+        # Nothing reached the local cache.
+        self.assertNotEqual(
+            self.post('/api/otp/', 'a@example.com').status_code, 429
+        )
+
+
+class FastSerializationTests(TestCase):
+    """
+    The ``.values()`` fast path must return the same bytes as
+    UserBasicSerializer.
+    """
+
+    def setUp(self):
+        self.admin = create_user('admin@example.com', verified=True,
+                                 is_superuser=True)
+        User.objects.create(username='ünï', email='u@example.com',
+                            first_name='Zoë "Z"', last_name='')
+        User.objects.create(username='lines', email='l@example.com',
+                            first_name='A\u2028B', last_name='C\u2029D')
+        for i in range(5):
+            create_user(f'user{i}@example.com', verified=bool(i % 2))
+        self.client = token_client(self.admin)
+
+    def assertSameResponse(self, path):
+        with self.settings(USER_FAST_SERIALIZATION=False):
+            expected = self.client.get(path)
+        actual = self.client.get(path)
+        self.assertEqual(actual.status_code, expected.status_code)
+        self.assertEqual(actual['Content-Type'], expected['Content-Type'])
+        self.assertEqual(actual.content, expected.content)
+
+    def test_list(self):
+        self.assertSameResponse('/api/users/')
+        self.assertSameResponse('/api/users/?page_size=2')
+        self.assertSameResponse('/api/users/?verified=true')
+        cursor = self.client.get('/api/users/?page_size=2').json()['next']
+        self.assertSameResponse(cursor)
+
+    def test_retrieve(self):
+        for user in User.objects.all():
+            self.assertSameResponse(f'/api/users/{user.pk}/')
+        self.assertSameResponse('/api/users/0/')
+        self.assertSameResponse('/api/users/abc/')
+
+    def test_rows_render_like_the_serializer(self):
+        queryset = User.objects.order_by('id')
+        expected = JSONRenderer().render(
+            UserBasicSerializer(queryset, many=True).data
+        )
+        rows = queryset.values(*user_basic_rows.columns)
+        self.assertEqual(
+            FastJSONRenderer().render(user_basic_rows.many(rows)), expected
+        )
+
+
+@override_settings(PASSWORD_HASHERS=FAST_HASHERS)
+class UserPaginationTests(TestCase):
+
+    def setUp(self):
+        self.admin = create_user('admin@example.com', is_superuser=True)
+        self.users = [self.admin] + [
+            create_user(f'user{i}@example.com') for i in range(4)
+        ]
+        self.client = token_client(self.admin)
+
+    def ids(self, page):
+        return [row['id'] for row in page['results']]
+
+    def test_next_and_previous_cursors(self):
+        pks = [user.pk for user in self.users]
+        first = self.client.get('/api/users/?page_size=2').json()
+        self.assertEqual(self.ids(first), pks[:2])
+        self.assertIsNone(first['previous'])
+        second = self.client.get(first['next']).json()
+        self.assertEqual(self.ids(second), pks[2:4])
+        last = self.client.get(second['next']).json()
+        self.assertEqual(self.ids(last), pks[4:])
+        self.assertIsNone(last['next'])
+        previous = self.client.get(last['previous']).json()
+        self.assertEqual(self.ids(previous), pks[2:4])
+
+    def test_page_size_is_capped(self):
+        User.objects.bulk_create(
+            User(username=f'bulk{i}', email=f'bulk{i}@example.com')
+            for i in range(1000)
+        )
+        page = self.client.get('/api/users/?page_size=5000').json()
+        self.assertEqual(len(page['results']), 1000)
+        self.assertIsNotNone(page['next'])
+
+    def test_inserts_do_not_shift_the_pages(self):
+        first = self.client.get('/api/users/?page_size=2').json()
+        create_user('late@example.com')
+        User.objects.filter(pk=self.users[1].pk).delete()
+        second = self.client.get(first['next']).json()
+        self.assertEqual(
+            self.ids(second), [self.users[2].pk, self.users[3].pk]
+        )
+        pages = [self.ids(first), self.ids(second)]
+        cursor = second['next']
+        while cursor:
+            page = self.client.get(cursor).json()
+            pages.append(self.ids(page))
+            cursor = page['next']
+        seen = [pk for page in pages for pk in page]
+        self.assertEqual(seen, sorted(set(seen)))
+        self.assertEqual(seen[-1], User.objects.latest('pk').pk)
+
+    def test_other_users_get_a_plain_list(self):
+        response = token_client(self.users[1]).get(
+            '/api/users/?page_size=1'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [row['id'] for row in response.json()], [self.users[1].pk]
+        )
+
+
+class BulkImportTests(TestCase):
+
+    def setUp(self):
+        self.admin = create_user('admin@example.com', verified=True,
+                                 is_superuser=True)
+        self.client = token_client(self.admin)
+        self.rows = [
+            {'email': f'new{i}@example.com', 'username': f'new{i}',
+             'first_name': 'First', 'last_name': 'Last',
+             'password': 'Secret-123'}
+            for i in range(3)
+        ]
+
+    def test_import_is_queued_on_the_bulk_queue(self):
+        with mock.patch.object(import_user_rows, 'apply_async') as enqueue:
+            enqueue.return_value.id = 'a1b2c3'
+            response = self.client.post(
+                '/api/users/bulk/?send_otp=false', self.rows, format='json'
+            )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['task_id'], 'a1b2c3')
+        self.assertTrue(
+            response.data['status'].endswith('/api/users/bulk/a1b2c3/')
+        )
+        staged = UserImport.objects.get()
+        self.assertEqual(len(staged.rows), 3)
+        self.assertNotIn('Secret-123', repr(staged.rows))
+        enqueue.assert_called_once_with(
+            (staged.id,), {'send_otp': False}
+        )
+        self.assertNotIn('Secret-123', repr(enqueue.call_args))
+        self.assertFalse(User.objects.filter(username='new0').exists())
+
+    def test_staged_rows_outlive_a_failed_import(self):
+        staged = stage_import(self.rows)
+        with mock.patch(
+            'users.bulk._create_batch', side_effect=DatabaseError
+        ), self.assertRaises(DatabaseError):
+            import_user_rows(staged.id, send_otp=False)
+        self.assertTrue(UserImport.objects.filter(pk=staged.pk).exists())
+        self.assertEqual(
+            import_user_rows(staged.id, send_otp=False),
+            {'created': 3, 'errors': []},
+        )
+        self.assertTrue(check_password(
+            'Secret-123', User.objects.get(username='new0').password
+        ))
+
+    def test_staged_rows_are_deleted_after_the_import(self):
+        staged = stage_import(self.rows)
+        self.assertEqual(
+            import_user_rows(staged.id, send_otp=False),
+            {'created': 3, 'errors': []},
+        )
+        self.assertFalse(UserImport.objects.exists())
+        self.assertIsNone(import_user_rows(staged.id, send_otp=False))
+        self.assertEqual(
+            User.objects.filter(username__startswith='new').count(), 3
+        )
+
+    def test_abandoned_imports_are_purged(self):
+        fresh = stage_import(self.rows)
+        UserImport.objects.filter(
+            pk=stage_import(self.rows).pk
+        ).update(created_at=timezone.now() - timedelta(days=2))
+        self.assertEqual(purge_expired(pause=0)['user_imports'], 1)
+        self.assertEqual(
+            list(UserImport.objects.values_list('pk', flat=True)), [fresh.pk]
+        )
+
+    def test_status_reports_the_result(self):
+        staged = stage_import(self.rows)
+        result = import_user_rows(staged.id, send_otp=False)
+        self.assertEqual(result, {'created': 3, 'errors': []})
+        TaskResult.objects.create(
+            task_id='a1b2c3', status='SUCCESS',
+            result='{"created": 3, "errors": []}',
+            content_type='application/json', content_encoding='utf-8',
+        )
+        response = self.client.get('/api/users/bulk/a1b2c3/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['state'], 'SUCCESS')
+        self.assertEqual(response.data['result'], result)
+        response = self.client.get('/api/users/bulk/d4e5f6/')
+        self.assertEqual(response.data['state'], 'PENDING')
+        self.assertIsNone(response.data['result'])
+
+    def test_status_requires_a_superuser(self):
+        user = create_user(verified=True)
+        response = token_client(user).get('/api/users/bulk/a1b2c3/')
+        self.assertEqual(response.status_code, 403)
+
+
+class SchemaCacheTests(TestCase):
+
+    def setUp(self):
+        for name in ('_specs', '_ui_schemas'):
+            patcher = mock.patch.dict(f'backend.schema.{name}', clear=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        override = override_settings(SCHEMA_CACHE_DIR=cache_dir.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def get_spec(self, **headers):
+        return self.client.get('/swagger/?format=openapi', **headers)
+
+    def test_schema_is_generated_once_per_process(self):
+        get_schema = OpenAPISchemaGenerator.get_schema
+        with mock.patch.object(
+            OpenAPISchemaGenerator, 'get_schema', autospec=True,
+            side_effect=get_schema,
+        ) as generate:
+            for _ in range(3):
+                self.assertEqual(self.get_spec().status_code, 200)
+                for path in ('/swagger/', '/redoc/'):
+                    response = self.client.get(path)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertContains(response, 'Longevity-InTime API')
+        # One full document and one endpoint-less schema for the pages.
+        self.assertEqual(generate.call_count, 2)
+
+    def test_spec_is_loaded_from_the_cache_dir(self):
+        body = self.get_spec().content
+        _specs.clear()
+        with mock.patch('backend.schema.render_spec') as render:
+            self.assertEqual(self.get_spec().content, body)
+        render.assert_not_called()
+
+    def test_conditional_requests(self):
+        response = self.get_spec()
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        response = self.get_spec(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        response = self.get_spec(HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        response = self.get_spec(HTTP_IF_NONE_MATCH='W/"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_gzip(self):
+        plain = self.get_spec()
+        self.assertNotIn('Content-Encoding', plain)
+        response = self.get_spec(HTTP_ACCEPT_ENCODING='br, gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(response['ETag'], plain['ETag'])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        json.loads(plain.content)
+
+    def test_spec_path_depends_on_schema_settings(self):
+        path = spec_path(OpenAPICodecJson, '')
+        self.assertEqual(spec_path(OpenAPICodecJson, ''), path)
+        simple_jwt = {**settings.SIMPLE_JWT, 'AUTH_HEADER_TYPES': ('JWT',)}
+        with self.settings(SIMPLE_JWT=simple_jwt):
+            self.assertNotEqual(spec_path(OpenAPICodecJson, ''), path)
+        rates = {**settings.AUTH_THROTTLE_RATES, 'verify_account': {}}
+        with self.settings(AUTH_THROTTLE_RATES=rates):
+            self.assertNotEqual(spec_path(OpenAPICodecJson, ''), path)
+        with self.settings(METRICS_TOKEN='other'):
+            self.assertEqual(spec_path(OpenAPICodecJson, ''), path)
+
+
+class MetricsAccessTests(TestCase):
+
+    def get(self, path, token=None):
+        headers = {'HTTP_AUTHORIZATION': f'Bearer {token}'} if token else {}
+        return self.client.get(path, **headers)
+
+    def test_metrics_are_private_without_a_token(self):
+        with self.settings(METRICS_TOKEN=''):
+            self.assertEqual(self.get('/metrics').status_code, 403)
+            self.assertEqual(self.get('/metrics', 'x').status_code, 403)
+            self.assertEqual(self.get('/metrics/celery').status_code, 403)
+
+    def test_metrics_require_the_token(self):
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.get('/metrics').status_code, 403)
+            self.assertEqual(self.get('/metrics', 'wrong').status_code, 403)
+            response = self.get('/metrics', 'secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE', response.content)
+
+
+class RequestMetricsTests(TestCase):
+
+    def scrape(self):
+        with self.settings(METRICS_TOKEN='secret'):
+            response = self.client.get(
+                '/metrics', HTTP_AUTHORIZATION='Bearer secret'
+            )
+        self.assertEqual(response.status_code, 200)
+        samples = {}
+        for line in response.content.decode().splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_requests_are_in_the_exposition(self):
+        user = create_user()
+        labels = '{route="users-detail",method="GET"}'
+        total = 'http_requests_total' \
+            '{route="users-detail",method="GET",status="200"}'
+        before = self.scrape()
+        token_client(user).get(f'/api/users/{user.pk}/')
+        after = self.scrape()
+        self.assertEqual(after[total] - before.get(total, 0), 1)
+        count = f'http_request_duration_seconds_count{labels}'
+        self.assertEqual(after[count] - before.get(count, 0), 1)
+        self.assertIn(
+            'http_request_duration_seconds_bucket'
+            '{route="users-detail",method="GET",le="+Inf"}',
+            after,
+        )
+        self.assertIn(f'http_request_duration_seconds_sum{labels}', after)
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class TaskMetricsTests(TestCase):
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        self.clients = [
+            fakeredis.FakeRedis(server=server) for _ in range(2)
+        ]
+
+    def test_pushes_of_several_processes_are_summed(self):
+        registries = [Registry(), Registry()]
+        aggregators = [
+            RedisAggregator(registry, client, 'test')
+            for registry, client in zip(registries, self.clients)
+        ]
+        for registry in registries:
+            counter = registry.counter('jobs_total', 'Jobs.', ('state',))
+            counter.inc('SUCCESS', value=2)
+            registry.histogram('job_seconds', 'Run time.').observe(0.2)
+        for aggregator in aggregators:
+            aggregator.push()
+            aggregator.push()
+        rendered = aggregators[0].render()
+        self.assertIn('jobs_total{state="SUCCESS"} 4', rendered)
+        self.assertIn('job_seconds_count 2', rendered)
+        self.assertIn('job_seconds_bucket{le="0.25"} 2', rendered)
+
+    def test_endpoint_renders_the_totals(self):
+        aggregator = RedisAggregator(TASK_REGISTRY, self.clients[0], 'test')
+        with mock.patch('backend.task_metrics._aggregator', aggregator), \
+                self.settings(METRICS_TOKEN='secret'):
+            for metric in TASK_REGISTRY.metrics():
+                metric.drain()
+            emails_total.inc(EMAIL_SENT)
+            push_task_metrics()
+            response = self.client.get(
+                '/metrics/celery', HTTP_AUTHORIZATION='Bearer secret'
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            b'celery_emails_total{result="sent"} 1', response.content
+        )
+
+
+@override_settings(TASK_METRICS_URL='', CELERY_BROKER_URL='memory://')
+class TaskMetricsWithoutRedisTests(TestCase):
+
+    def test_endpoint_is_unavailable(self):
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(
+                self.client.get('/metrics/celery').status_code, 403
+            )
+            response = self.client.get(
+                '/metrics/celery', HTTP_AUTHORIZATION='Bearer secret'
+            )
+        self.assertEqual(response.status_code, 503)
+
+    def test_metrics_stay_in_the_process(self):
+        with mock.patch('backend.task_metrics._aggregator', None), \
+                mock.patch('redis.Redis.from_url') as from_url:
+            push_task_metrics()
+        from_url.assert_not_called()
+
+
+class TaskResultPolicyTests(TestCase):
+
+    policies = {'a': RESULT_POLICY_FAILURES, 'b': RESULT_POLICY_ALL}
+
+    def test_failures_go_to_the_result_backend_without_a_store(self):
+        with self.settings(TASK_FAILURE_STORE_URL=''):
+            self.assertEqual(result_annotations(self.policies), {'a': {
+                'ignore_result': True, 'store_errors_even_if_ignored': True,
+            }})
+            with mock.patch('backend.task_results.record_failure') as record:
+                store_task_failure(
+                    sender=send_otp_email_celery, task_id='t1',
+                    exception=ValueError(),
+                )
+        record.assert_not_called()
+
+    def test_failures_go_to_the_store(self):
+        with self.settings(TASK_FAILURE_STORE_URL='redis://localhost/0'):
+            self.assertEqual(
+                result_annotations(self.policies),
+                {'a': {'ignore_result': True}},
+            )
+            with mock.patch('backend.task_results.record_failure') as record:
+                store_task_failure(
+                    sender=send_otp_email_celery, task_id='t1',
+                    exception=ValueError(),
+                )
+        record.assert_called_once_with(
+            send_otp_email_celery.name, 't1', mock.ANY, None
+        )
+
+
+class PublisherTests(TestCase):
+
+    def publisher(self, overflow, maxsize=10):
+        return BackgroundPublisher(
+            maxsize=maxsize, batch_size=2, overflow=overflow, block_timeout=0
+        )
+
+    def test_thread_publishes_over_one_producer_per_batch(self):
+        publisher = self.publisher(OVERFLOW_BLOCK)
+        task = mock.Mock()
+        with mock.patch('backend.publisher.current_app') as app:
+            for i in range(5):
+                publisher.publish(task, (i,), countdown=1)
+            self.assertTrue(publisher.flush(timeout=5))
+        producer = app.producer_or_acquire.return_value.__enter__.return_value
+        self.assertEqual(
+            sorted(c.args[0] for c in task.apply_async.call_args_list),
+            [(i,) for i in range(5)],
+        )
+        task.apply_async.assert_called_with(
+            mock.ANY, {}, producer=producer, countdown=1
+        )
+        stats = publisher.stats()
+        self.assertEqual(stats['published'], 5)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertGreaterEqual(stats['batches'], 3)
+
+    def test_full_queue_is_published_by_the_caller(self):
+        publisher = self.publisher(OVERFLOW_SYNC, maxsize=1)
+        task = mock.Mock()
+        with mock.patch.object(publisher, '_ensure_thread'):
+            publisher.publish(task, ('a',))
+            publisher.publish(task, ('b',))
+        task.apply_async.assert_called_once_with(('b',), None)
+        self.assertEqual(publisher.stats()['sync_published'], 1)
+        self.assertFalse(publisher.flush(timeout=0))
+
+    def test_failed_publishes_are_counted(self):
+        publisher = self.publisher(OVERFLOW_BLOCK)
+        task = mock.Mock()
+        task.apply_async.side_effect = [ConnectionError(), None]
+        with mock.patch('backend.publisher.current_app'), \
+                self.assertLogs('backend.publisher', 'ERROR'):
+            publisher.publish(task, ('a',))
+            publisher.publish(task, ('b',))
+            self.assertTrue(publisher.flush(timeout=5))
+        stats = publisher.stats()
+        self.assertEqual((stats['errors'], stats['published']), (1, 1))
+
+
+class PublisherMetricsTests(TestCase):
+
+    def messages(self):
+        return {
+            labels: value for _, labels, value in publisher_messages.samples()
+        }
+
+    def test_publisher_stats_are_exported(self):
+        publisher = BackgroundPublisher(
+            maxsize=1, batch_size=10, overflow=OVERFLOW_DROP, block_timeout=0
+        )
+        publisher_queue_depth.set_function(publisher._queue.qsize)
+        self.addCleanup(publisher_queue_depth.set_function, None)
+        task = mock.Mock()
+        before = self.messages()
+        with mock.patch.object(publisher, '_ensure_thread'):
+            publisher.publish(task, ('a',))
+            with self.assertLogs('backend.publisher', 'WARNING'):
+                publisher.publish(task, ('b',))
+        self.assertIn('task_publisher_queue_depth 1', REGISTRY.render())
+        publisher._send(publisher._next_batch())
+        task.apply_async.assert_called_once()
+        after = self.messages()
+        for result in ('enqueued', 'dropped', 'published'):
+            label = f'{{result="{result}"}}'
+            self.assertEqual(after[label] - before.get(label, 0), 1)
+        rendered = REGISTRY.render()
+        self.assertIn('task_publisher_queue_depth 0', rendered)
+        self.assertIn('task_publisher_batch_seconds_count', rendered)
+        self.assertIn('task_publisher_queue_wait_seconds_count', rendered)
+
+
+class FakeSMTPBackend(EmailBackend):
+    """
+    SMTP backend whose sessions are mocks: NOOP answers ``noop_code`` and
+    every message is accepted. Opening takes ``open_delay`` seconds.
+    """
+
+    opened = 0
+    open_delay = 0
+    noop_code = 250
+    lock = threading.Lock()
+
+    def open(self):
+        if self.connection is not None:
+            return False
+        time.sleep(self.open_delay)
+        self.connection = mock.Mock()
+        self.connection.noop.side_effect = lambda: (type(self).noop_code, b'')
+        with self.lock:
+            type(self).opened += 1
+        return True
+
+    def close(self):
+        self.connection = None
+
+    def send_messages(self, email_messages):
+        return len(email_messages)
+
+
+@override_settings(EMAIL_BACKEND='api.tests.FakeSMTPBackend')
+class SMTPPoolTests(TestCase):
+
+    def setUp(self):
+        for name, value in (('opened', 0), ('open_delay', 0),
+                            ('noop_code', 250)):
+            patcher = mock.patch.object(FakeSMTPBackend, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def pool(self, size=2, max_age=300, max_messages=100, timeout=1):
+        pool = SMTPConnectionPool(size, max_age, max_messages, timeout)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_connections_are_reused(self):
+        pool = self.pool()
+        pool.open()
+        self.assertEqual(FakeSMTPBackend.opened, 2)
+        for _ in range(5):
+            with pool.connection() as conn:
+                conn.messages_sent += 1
+        stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (5, 0))
+        self.assertEqual((stats['open'], stats['idle']), (2, 2))
+        self.assertEqual(FakeSMTPBackend.opened, 2)
+
+    def test_concurrent_checkouts_never_exceed_the_size(self):
+        FakeSMTPBackend.open_delay = 0.01
+        pool = self.pool(size=2, timeout=5)
+        barrier = threading.Barrier(8)
+
+        def send():
+            barrier.wait()
+            with pool.connection():
+                time.sleep(0.005)
+
+        threads = [threading.Thread(target=send) for _ in range(8)]
+        # Slow event recording widens any gap between checking the size
+        # and taking a slot.
+        with mock.patch('backend.smtp_pool.smtp_pool_events') as events:
+            events.inc.side_effect = lambda *args, **kwargs: time.sleep(0.005)
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(FakeSMTPBackend.opened, 2)
+        self.assertEqual(pool.stats()['open'], 2)
+
+    def test_checkout_times_out_when_exhausted(self):
+        pool = self.pool(size=1, timeout=0.01)
+        conn = pool.checkout()
+        with self.assertRaises(SMTPPoolExhausted):
+            pool.checkout()
+        pool.checkin(conn)
+        self.assertIs(pool.checkout(), conn)
+
+    def test_connections_are_recycled(self):
+        pool = self.pool(size=1, max_age=60, max_messages=3)
+        conn = pool.checkout()
+        conn.messages_sent = 3
+        pool.checkin(conn)
+        recycled = pool.checkout()
+        self.assertIsNot(recycled, conn)
+        recycled.created_at -= 61
+        pool.checkin(recycled)
+        aged = pool.checkout()
+        self.assertIsNot(aged, recycled)
+        pool.checkin(aged)
+        FakeSMTPBackend.noop_code = 421
+        self.assertIsNot(pool.checkout(), aged)
+        stats = pool.stats()
+        self.assertEqual((stats['reconnects'], stats['open']), (3, 1))
+        self.assertEqual(FakeSMTPBackend.opened, 4)
+
+    def test_broken_and_failed_connections_free_their_slot(self):
+        pool = self.pool(size=1, timeout=0.01)
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            with pool.connection():
+                raise smtplib.SMTPServerDisconnected
+        self.assertEqual(pool.stats()['open'], 0)
+        with mock.patch.object(
+            FakeSMTPBackend, 'open', side_effect=OSError
+        ), self.assertRaises(OSError):
+            pool.checkout()
+        self.assertEqual(pool.stats()['open'], 0)
+        self.assertIsNotNone(pool.checkout())
+
+    @override_settings(SMTP_POOL_SIZE=1)
+    def test_otp_emails_go_through_the_worker_pool(self):
+        open_smtp_pool()
+        self.addCleanup(close_smtp_pool)
+        items = [(f'user{i}@example.com', '123456') for i in range(3)]
+        self.assertEqual(send_otp_messages(items), (3, 0))
+        self.assertEqual(send_otp_messages(items), (3, 0))
+        self.assertEqual(FakeSMTPBackend.opened, 1)
+        [conn] = list(get_pool()._idle.queue)
+        self.assertEqual(conn.messages_sent, 6)
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+@override_settings(
+    OTP_EMAIL_BATCHING=True, OTP_EMAIL_BATCH_SIZE=2,
+    OTP_EMAIL_BATCH_WINDOW=60,
+    EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+)
+class OTPEmailBatchingTests(TestCase):
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        patcher = mock.patch('backend.mail._buffer_client', self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, count, start=0):
+        with mock.patch.object(
+            flush_otp_email_batch, 'apply_async'
+        ) as apply_async:
+            for i in range(start, start + count):
+                send_otp_email_celery(f'user{i}@example.com', '123456')
+        return apply_async
+
+    def flush(self):
+        with mock.patch.object(flush_otp_email_batch, 'delay') as delay:
+            result = flush_otp_email_batch()
+        return result, delay
+
+    def recipients(self):
+        return [message.to[0] for message in mail.outbox]
+
+    def test_messages_are_buffered_and_flushed_once(self):
+        apply_async = self.send(3)
+        apply_async.assert_called_once_with(countdown=60)
+        self.assertEqual(mail.outbox, [])
+        self.assertEqual(self.redis.llen(OTP_EMAIL_BUFFER_KEY), 3)
+        self.assertGreater(self.redis.pttl(OTP_EMAIL_FLUSH_LOCK_KEY), 59000)
+
+    def test_flush_sends_a_batch_and_reschedules_the_rest(self):
+        self.send(3)
+        result, delay = self.flush()
+        self.assertEqual(result, {'sent': 2, 'failed': 0})
+        delay.assert_called_once_with()
+        self.assertTrue(self.redis.exists(OTP_EMAIL_FLUSH_LOCK_KEY))
+        result, delay = self.flush()
+        self.assertEqual(result, {'sent': 1, 'failed': 0})
+        delay.assert_not_called()
+        self.assertFalse(self.redis.exists(OTP_EMAIL_FLUSH_LOCK_KEY))
+        self.assertEqual(
+            self.recipients(),
+            [f'user{i}@example.com' for i in range(3)],
+        )
+        self.send(1, start=3).assert_called_once_with(countdown=60)
+
+    def test_messages_buffered_during_a_flush_are_rescheduled(self):
+        self.send(1)
+
+        def send_and_buffer(items):
+            apply_async = self.send(1, start=1)
+            apply_async.assert_not_called()
+            return send_otp_messages(items)
+
+        with mock.patch('backend.tasks.send_otp_messages', send_and_buffer):
+            result, delay = self.flush()
+        self.assertEqual(result, {'sent': 1, 'failed': 0})
+        delay.assert_called_once_with()
+        self.assertEqual(self.flush()[0], {'sent': 1, 'failed': 0})
+        self.assertEqual(
+            self.recipients(), ['user0@example.com', 'user1@example.com']
+        )
+
+    def test_a_failed_publish_lets_the_next_message_schedule(self):
+        with mock.patch.object(
+            flush_otp_email_batch, 'apply_async', side_effect=OSError
+        ), self.assertRaises(OSError):
+            send_otp_email_celery('user0@example.com', '123456')
+        self.assertFalse(self.redis.exists(OTP_EMAIL_FLUSH_LOCK_KEY))
+        self.send(1, start=1).assert_called_once_with(countdown=60)
+        self.assertEqual(self.flush()[0], {'sent': 2, 'failed': 0})
+
+    def test_a_failed_reschedule_lets_the_next_message_schedule(self):
+        self.send(3)
+        with mock.patch.object(
+            flush_otp_email_batch, 'delay', side_effect=OSError
+        ), self.assertRaises(OSError):
+            flush_otp_email_batch()
+        self.assertFalse(self.redis.exists(OTP_EMAIL_FLUSH_LOCK_KEY))
+        self.send(1, start=3).assert_called_once_with(countdown=60)
+        self.assertEqual(self.flush()[0], {'sent': 2, 'failed': 0})
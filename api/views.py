@@ -1,13 +1,45 @@
+from celery.result import AsyncResult
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
+from django.urls import reverse
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import permissions, status, viewsets
-from rest_framework.decorators import api_view
+from rest_framework.decorators import (action, api_view,
+                                       authentication_classes,
+                                       throttle_classes)
+from rest_framework.exceptions import ValidationError
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 
-from backend.tasks import send_otp_email_celery
-from users.models import OneTimePassword, User
+from backend.tasks import import_user_rows
+from users.attempts import get_attempt_store
+from users.bulk import stage_import
+from users.cache import get_user_cache
+from users.dispatch import dispatch_otp_email
+from users.export import EXPORT_FORMATS, parse_iso_datetime, stream_export
+from users.models import User
+from users.otp import OTP_EXPIRED, OTP_VALID, issue_otp, redeem_otp
 
-from .serializers import UserBasicSerializer, UserCreateSerializer
+from .pagination import UserCursorPagination
+from .permissions import IsSuperuser
+from .renderers import FastJSONRenderer
+from .serializers import (UserBasicSerializer, UserCreateSerializer,
+                          user_basic_rows)
+from .throttling import ClientIPThrottle, TargetEmailThrottle
+
+
+def parse_query_datetime(name, value):
+    """
+    Parses an ISO 8601 date or datetime query parameter into an aware
+    datetime.
+    """
+
+    parsed = parse_iso_datetime(value)
+    if parsed is None:
+        raise ValidationError({name: 'Must be an ISO 8601 date or datetime.'})
+    return parsed
 
 
 class UserViewSet(viewsets.ModelViewSet):
@@ -15,19 +47,72 @@ class UserViewSet(viewsets.ModelViewSet):
     permission_classes = (permissions.AllowAny,)
     serializer_class = UserBasicSerializer
     queryset = User.objects.all()
+    pagination_class = UserCursorPagination
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
     http_method_names = ['get', 'post', 'patch', 'delete']
 
     def get_permissions(self):
         if self.action == 'create':
             return [permissions.AllowAny()]
+        if self.action in ('export', 'bulk', 'bulk_status'):
+            return [permissions.IsAuthenticated(), IsSuperuser()]
         return [permissions.IsAuthenticated()]
 
     def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):
+            return User.objects.none()
         if self.request.user.is_superuser:
+            if self.action == 'list':
+                return self.filter_user_list(
+                    User.objects.only(*UserBasicSerializer.Meta.fields)
+                )
             return User.objects.all()
         else:
             return User.objects.filter(pk=self.request.user.pk)
 
+    def filter_user_list(self, queryset):
+        """
+        Applies the ``verified`` and ``joined_after`` query parameters.
+        """
+
+        params = self.request.query_params
+        verified = params.get('verified')
+        if verified is not None:
+            if verified.lower() not in ('true', 'false'):
+                raise ValidationError({'verified': 'Must be true or false.'})
+            queryset = queryset.filter(verified=verified.lower() == 'true')
+        joined_after = params.get('joined_after')
+        if joined_after is not None:
+            queryset = queryset.filter(date_joined__gte=parse_query_datetime(
+                'joined_after', joined_after
+            ))
+        return queryset
+
+    def paginate_queryset(self, queryset):
+        if not self.request.user.is_superuser:
+            return None
+        return super().paginate_queryset(queryset)
+
+    def get_object_row(self):
+        """
+        ``get_object`` for the fast path, returns a ``.values()`` row.
+        """
+
+        queryset = self.filter_queryset(self.get_queryset())
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            row = queryset.values(*user_basic_rows.columns).get(
+                **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+            )
+        except User.DoesNotExist:
+            raise Http404(
+                f'No {User._meta.object_name} matches the given query.'
+            )
+        except (TypeError, ValueError):
+            raise Http404
+        self.check_object_permissions(self.request, row)
+        return row
+
     def get_serializer_class(self):
         """
         Get serializer depending on request method.
@@ -38,15 +123,27 @@ class UserViewSet(viewsets.ModelViewSet):
         return UserBasicSerializer
 
     def perform_create(self, serializer):
-        user = serializer.save()
-        email = user.email
-        otp = user.generate_otp()
-        send_otp_email_celery.delay(email, otp)
-        user.save()
+        with transaction.atomic():
+            user = serializer.save()
+            otp = issue_otp(user)
+            dispatch_otp_email(user.email, otp)
 
     @swagger_auto_schema(
         operation_id="Get User List",
-        operation_description="Retrieve a list of users.",
+        operation_description=(
+            "Retrieve a list of users. Superusers get cursor-paginated "
+            "results ordered by id."
+        ),
+        manual_parameters=[
+            openapi.Parameter(
+                'verified', openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+                description="Only users with this verification status.",
+            ),
+            openapi.Parameter(
+                'joined_after', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                description="Only users who joined at or after this date.",
+            ),
+        ],
         responses={
             200: UserBasicSerializer(many=True),
             403: "Permission Denied"
@@ -54,11 +151,169 @@ class UserViewSet(viewsets.ModelViewSet):
         tags=['Users'],
     )
     def list(self, request, *args, **kwargs):
+        if settings.USER_FAST_SERIALIZATION:
+            queryset = self.filter_queryset(self.get_queryset()).values(
+                *user_basic_rows.columns
+            )
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                return self.get_paginated_response(user_basic_rows.many(page))
+            return Response(user_basic_rows.many(queryset))
         response = super().list(request, *args, **kwargs)
         if response.status_code != status.HTTP_200_OK:
             return response
         return Response(response.data, status=status.HTTP_200_OK)
     
+    @swagger_auto_schema(
+        operation_id="Export Users",
+        operation_description=(
+            "Stream all users as NDJSON or CSV. Superusers only."
+        ),
+        manual_parameters=[
+            openapi.Parameter(
+                'output', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                enum=EXPORT_FORMATS, default='ndjson',
+            ),
+            openapi.Parameter(
+                'verified', openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+                description="Only export verified users.",
+            ),
+            openapi.Parameter(
+                'joined_after', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                description="Only users who joined at or after this date.",
+            ),
+            openapi.Parameter(
+                'gzip', openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+                description="Gzip the export.",
+            ),
+        ],
+        responses={
+            200: "Streamed export",
+            403: "Permission Denied"
+        },
+        tags=['Users'],
+    )
+    @action(detail=False, methods=['get'])
+    def export(self, request, *args, **kwargs):
+        params = request.query_params
+        output = params.get('output', 'ndjson')
+        if output not in EXPORT_FORMATS:
+            raise ValidationError({'output': 'Must be ndjson or csv.'})
+        joined_after = params.get('joined_after')
+        if joined_after is not None:
+            joined_after = parse_query_datetime('joined_after', joined_after)
+        compress = params.get('gzip', '').lower() == 'true'
+        filename = f'users.{output}'
+        content_type = (
+            'text/csv' if output == 'csv' else 'application/x-ndjson'
+        )
+        if compress:
+            filename += '.gz'
+            content_type = 'application/gzip'
+        response = StreamingHttpResponse(
+            stream_export(
+                output=output,
+                compress=compress,
+                verified=(
+                    True if params.get('verified', '').lower() == 'true'
+                    else None
+                ),
+                joined_after=joined_after,
+            ),
+            content_type=content_type,
+        )
+        response['Content-Disposition'] = (
+            f'attachment; filename="{filename}"'
+        )
+        return response
+
+    @swagger_auto_schema(
+        operation_id="Bulk Create Users",
+        operation_description=(
+            "Queue the creation of many users. The import runs on a "
+            "worker: all rows are validated before anything is written "
+            "and errors are reported per row index. Poll the returned "
+            "status URL for the result. Superusers only."
+        ),
+        request_body=UserCreateSerializer(many=True),
+        manual_parameters=[
+            openapi.Parameter(
+                'send_otp', openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN,
+                default=True,
+                description="Issue and email one time passwords.",
+            ),
+        ],
+        responses={
+            202: openapi.Response(
+                description="Import queued.",
+                schema=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        'task_id': openapi.Schema(type=openapi.TYPE_STRING),
+                        'status': openapi.Schema(type=openapi.TYPE_STRING),
+                    },
+                ),
+            ),
+            400: "Body is not a list or has too many rows",
+            403: "Permission Denied"
+        },
+        tags=['Users'],
+    )
+    @action(detail=False, methods=['post'])
+    def bulk(self, request, *args, **kwargs):
+        rows = request.data
+        if not isinstance(rows, list):
+            raise ValidationError({'non_field_errors': 'Expected a list.'})
+        if len(rows) > settings.USER_IMPORT_MAX_ROWS:
+            raise ValidationError({'non_field_errors': (
+                f'At most {settings.USER_IMPORT_MAX_ROWS} rows per request.'
+            )})
+        send_otp = request.query_params.get('send_otp', '').lower() != 'false'
+        staged = stage_import(rows)
+        task_id = import_user_rows.delay(staged.id, send_otp=send_otp).id
+        return Response(
+            {
+                'task_id': task_id,
+                'status': request.build_absolute_uri(
+                    reverse('users-bulk-status', args=[task_id])
+                ),
+            },
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+    @swagger_auto_schema(
+        operation_id="Bulk Create Users Status",
+        operation_description=(
+            "State of a queued import: PENDING, STARTED, SUCCESS or "
+            "FAILURE. On success the result holds the number of created "
+            "users and the errors per row. Superusers only."
+        ),
+        responses={
+            200: openapi.Response(
+                description="Import state and result.",
+                schema=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        'task_id': openapi.Schema(type=openapi.TYPE_STRING),
+                        'state': openapi.Schema(type=openapi.TYPE_STRING),
+                        'result': openapi.Schema(type=openapi.TYPE_OBJECT),
+                    },
+                ),
+            ),
+            403: "Permission Denied"
+        },
+        tags=['Users'],
+    )
+    @action(detail=False, methods=['get'],
+            url_path=r'bulk/(?P<task_id>[0-9a-f-]+)')
+    def bulk_status(self, request, task_id, *args, **kwargs):
+        result = AsyncResult(task_id, app=import_user_rows.app)
+        return Response({
+            'task_id': task_id,
+            'state': result.state,
+            'result': result.result if result.successful() else None,
+        })
+
     @swagger_auto_schema(
         operation_id="Get User",
         operation_description="Retrieve a single user.",
@@ -69,6 +324,10 @@ class UserViewSet(viewsets.ModelViewSet):
         tags=['Users'],
     )
     def retrieve(self, request, *args, **kwargs):
+        if settings.USER_FAST_SERIALIZATION:
+            return Response(
+                user_basic_rows.to_representation(self.get_object_row())
+            )
         return super().retrieve(request, *args, **kwargs)
 
     @swagger_auto_schema(
@@ -85,10 +344,13 @@ class UserViewSet(viewsets.ModelViewSet):
         username = request.data.get("username")
         email = request.data.get("email")
         try:
-            existing_user = User.objects.get(username=username, email=email)
-            otp = existing_user.generate_otp()
-            send_otp_email_celery.delay(email, otp)
-            existing_user.save()
+            existing_user = get_user_cache().get_by_email(email)
+            if existing_user.username != username:
+                raise User.DoesNotExist
+            with transaction.atomic():
+                otp = issue_otp(existing_user)
+                if otp:
+                    dispatch_otp_email(email, otp)
             response_data = {
                 "email": email,
                 "username": username
@@ -179,6 +441,8 @@ class UserViewSet(viewsets.ModelViewSet):
     tags=['Authentication'],
 )
 @api_view(['POST'])
+@authentication_classes([])
+@throttle_classes([ClientIPThrottle, TargetEmailThrottle])
 def verify_account(request):
     """
     Endpoint for verifying user account using OTP.
@@ -194,37 +458,31 @@ def verify_account(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
         try:
-            user = User.objects.get(email=email)
+            user = get_user_cache().get_by_email(email)
         except User.DoesNotExist:
             return Response({'error': "User with this email does not exist."})
-        try:
-            otp_instance = OneTimePassword.objects.get(user=user, otp=otp)
-            if not otp_instance.is_otp_valid():
-                return Response(
-                    {'error': 'OTP code has expired'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            if user.otp_tries > 5:
-                return Response(
-                    {'error': 'Exceeded maximum tries for OTP verification'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            if user.verified:
-                return Response(
-                    {'error': 'Email already verified'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-        except OneTimePassword.DoesNotExist:
-            user.otp_tries += 1
-            user.save()
+        if user.verified:
+            return Response(
+                {'error': 'Email already verified'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        attempts = get_attempt_store()
+        if not attempts.reserve(user):
+            return Response(
+                {'error': 'Exceeded maximum tries for OTP verification'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        result = redeem_otp(user, otp, verify=True)
+        if result == OTP_EXPIRED:
+            return Response(
+                {'error': 'OTP code has expired'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if result != OTP_VALID:
             return Response(
                 {'error': 'Invalid OTP code or email'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        user.otp_tries = 0
-        user.verified = True
-        user.save()
-        otp_instance.delete()
         return Response(
             {'message': 'Account verified successfully. Now you can log in.'},
             status=status.HTTP_200_OK
@@ -262,6 +520,8 @@ def verify_account(request):
     tags=['Authentication'],
 )
 @api_view(['POST'])
+@authentication_classes([])
+@throttle_classes([ClientIPThrottle, TargetEmailThrottle])
 def get_otp(request):
     """
     Endpoint for generating and sending OTP to the user's email.
@@ -275,14 +535,16 @@ def get_otp(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
         try:
-            user_instance = User.objects.get(email=email)
+            user_instance = get_user_cache().get_by_email(email)
         except User.DoesNotExist:
             return Response(
                 {'error': 'User with this email doesnt exist'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        otp = user_instance.generate_otp()
-        send_otp_email_celery.delay(email, otp)
+        with transaction.atomic():
+            otp = issue_otp(user_instance)
+            if otp:
+                dispatch_otp_email(email, otp)
         return Response(
             {'message': 'OTP sent to your email. Now you can log in.'},
             status=status.HTTP_200_OK
@@ -3,9 +3,109 @@ from __future__ import absolute_import, unicode_literals
 import os
 
 from celery import Celery
+from celery.signals import (before_task_publish, task_failure,
+                            task_postrun, task_prerun, worker_process_init,
+                            worker_process_shutdown, worker_shutdown)
 from django.conf import settings
+from kombu import Queue
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 app = Celery('backend')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+app.autodiscover_tasks(['backend'])
+
+# Queues, each consumed by its own worker role (see Docker.celery.sh):
+#
+#   otp      OTP emails users are waiting on. Short I/O-bound tasks;
+#            run with --prefetch-multiplier 1 -O fair and enough
+#            concurrency that a slow SMTP send never holds the queue.
+#   celery   everything not routed elsewhere, default Celery settings.
+#   bulk     imports and maintenance. Long tasks; run with
+#            --prefetch-multiplier 1 -O fair and low concurrency.
+#
+# Prefetching is a worker-wide setting in Celery, so it is set on the
+# worker command of each role. Late acknowledgement is set per queue
+# below: a task of those queues that was running when its worker died
+# is delivered again instead of being lost.
+OTP_QUEUE = 'otp'
+DEFAULT_QUEUE = 'celery'
+BULK_QUEUE = 'bulk'
+
+QUEUE_TASK_OPTIONS = {
+    OTP_QUEUE: {'acks_late': True},
+    DEFAULT_QUEUE: {},
+    BULK_QUEUE: {'acks_late': True},
+}
+
+TASK_ROUTES = {
+    'backend.tasks.send_otp_email_celery': {'queue': OTP_QUEUE},
+    'backend.tasks.flush_otp_email_batch': {'queue': OTP_QUEUE},
+    'backend.tasks.relay_outbox_messages': {'queue': OTP_QUEUE},
+    'backend.tasks.send_bulk_otp_emails': {'queue': BULK_QUEUE},
+    'backend.tasks.import_user_rows': {'queue': BULK_QUEUE},
+    'backend.tasks.purge_expired_records': {'queue': BULK_QUEUE},
+}
+
+app.conf.task_default_queue = DEFAULT_QUEUE
+app.conf.task_queues = [Queue(name) for name in QUEUE_TASK_OPTIONS]
+app.conf.task_routes = TASK_ROUTES
+
+
+@app.on_after_configure.connect
+def configure_task_policies(sender, **kwargs):
+    from .task_results import result_annotations
+    annotations = result_annotations(settings.TASK_RESULT_POLICIES)
+    for name, route in TASK_ROUTES.items():
+        options = QUEUE_TASK_OPTIONS[route['queue']]
+        if options:
+            annotations.setdefault(name, {}).update(options)
+    sender.conf.task_annotations = annotations
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    from .smtp_pool import open_smtp_pool
+    open_smtp_pool()
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    from .smtp_pool import close_smtp_pool
+    close_smtp_pool()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def push_worker_metrics(**kwargs):
+    from .task_metrics import push_task_metrics
+    push_task_metrics()
+
+
+@before_task_publish.connect
+def stamp_task_headers(headers=None, **kwargs):
+    from .task_metrics import stamp_enqueue_time
+    if headers is not None:
+        stamp_enqueue_time(headers)
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, task=None, **kwargs):
+    from .task_metrics import task_started
+    task_started(task_id, task)
+
+
+@task_postrun.connect
+def record_task_end(task_id=None, task=None, state=None, **kwargs):
+    from .task_metrics import task_finished
+    task_finished(task_id, task, state)
+
+
+@task_failure.connect
+def store_task_failure(sender=None, task_id=None, exception=None,
+                       traceback=None, **kwargs):
+    from .task_metrics import task_failed
+    task_failed(sender, exception)
+    from .task_results import record_failure, uses_failure_store
+    if uses_failure_store(sender.name):
+        record_failure(sender.name, task_id, exception, traceback)
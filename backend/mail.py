@@ -0,0 +1,140 @@
+import json
+import logging
+import time
+
+import redis
+from django.conf import settings
+from django.core.mail import EmailMessage
+
+from .smtp_pool import smtp_connection
+from .task_metrics import (EMAIL_FAILED, EMAIL_SENT, emails_total,
+                           record_email_send)
+
+logger = logging.getLogger(__name__)
+
+OTP_EMAIL_SUBJECT = 'Lengevity inTime login'
+OTP_EMAIL_BUFFER_KEY = 'otp-email:buffer'
+OTP_EMAIL_FLUSH_LOCK_KEY = 'otp-email:flush-scheduled'
+
+_buffer_client = None
+
+
+def build_otp_message(email, otp, connection=None):
+    """
+    Builds the OTP email message for a single recipient.
+    """
+
+    return EmailMessage(
+        OTP_EMAIL_SUBJECT, f'Your OTP is: {otp}',
+        settings.EMAIL_HOST, [email], connection=connection,
+    )
+
+
+def send_otp_messages(items):
+    """
+    Sends OTP emails for (email, otp) pairs through one SMTP session.
+
+    The session comes from the worker's SMTP pool when it is running.
+    Each message is sent on its own so that a single bad recipient does
+    not abort the rest of the batch; a failed send drops the session and
+    the next message reopens it. Returns a (sent, failed) tuple.
+    """
+
+    if not items:
+        return 0, 0
+    try:
+        with smtp_connection() as (connection, pooled):
+            sent, failed = _send_each(items, connection)
+            if pooled is not None:
+                pooled.messages_sent += sent
+    except Exception:
+        logger.exception('Could not open SMTP connection')
+        emails_total.inc(EMAIL_FAILED, value=len(items))
+        return 0, len(items)
+    return sent, failed
+
+
+def _send_each(items, connection):
+    sent = failed = 0
+    for email, otp in items:
+        started = time.perf_counter()
+        try:
+            connection.open()
+            count = connection.send_messages(
+                [build_otp_message(email, otp, connection)]
+            )
+        except Exception:
+            count = 0
+            logger.exception('Failed to send OTP email to %s', email)
+            connection.close()
+        sent += count
+        failed += 1 - count
+        record_email_send(
+            EMAIL_SENT if count else EMAIL_FAILED,
+            time.perf_counter() - started,
+        )
+    return sent, failed
+
+
+def _flush_lock_ttl():
+    return max(int(settings.OTP_EMAIL_BATCH_WINDOW * 1000), 1)
+
+
+def get_buffer_client():
+    global _buffer_client
+    if _buffer_client is None:
+        _buffer_client = redis.Redis.from_url(settings.OTP_EMAIL_BUFFER_URL)
+    return _buffer_client
+
+
+def buffer_otp_email(email, otp):
+    """
+    Appends an OTP send request to the shared buffer.
+
+    Returns True when the caller is the first to buffer a message in the
+    current window and therefore has to schedule the flush.
+    """
+
+    client = get_buffer_client()
+    pipe = client.pipeline()
+    pipe.rpush(OTP_EMAIL_BUFFER_KEY, json.dumps([email, otp]))
+    pipe.set(
+        OTP_EMAIL_FLUSH_LOCK_KEY, 1, nx=True,
+        px=_flush_lock_ttl(),
+    )
+    _, first = pipe.execute()
+    return bool(first)
+
+
+def cancel_otp_email_flush():
+    """
+    Clears the flush marker when the flush could not be scheduled, so the
+    next buffered message schedules it instead.
+    """
+
+    get_buffer_client().delete(OTP_EMAIL_FLUSH_LOCK_KEY)
+
+
+def drain_otp_email_buffer(limit):
+    """
+    Pops up to ``limit`` buffered OTP send requests.
+    """
+
+    raw = get_buffer_client().lpop(OTP_EMAIL_BUFFER_KEY, limit) or []
+    return [tuple(json.loads(item)) for item in raw]
+
+
+def release_otp_email_flush():
+    """
+    Clears the flush marker after a drain and re-acquires it if messages
+    arrived in the meantime. Returns True when another flush is needed.
+    """
+
+    client = get_buffer_client()
+    client.delete(OTP_EMAIL_FLUSH_LOCK_KEY)
+    if not client.llen(OTP_EMAIL_BUFFER_KEY):
+        return False
+    return bool(client.set(
+        OTP_EMAIL_FLUSH_LOCK_KEY, 1, nx=True,
+        px=_flush_lock_ttl(),
+    ))
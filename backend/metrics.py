@@ -0,0 +1,385 @@
+import bisect
+import hmac
+import json
+import logging
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import HttpResponse
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+_current = ContextVar('request_metrics', default=None)
+
+
+def _escape(value):
+    return (
+        str(value).replace('\\', r'\\').replace('"', r'\"')
+        .replace('\n', r'\n')
+    )
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def empty(self):
+        return type(self)(self.name, self.documentation, self.labels)
+
+    def drain(self):
+        """
+        Removes and returns the values as (labels, part, value) deltas.
+        """
+
+        with self._lock:
+            values, self._values = self._values, {}
+        return [(labels, '', value) for labels, value in values.items()]
+
+    def merge(self, labels, part, value):
+        self.inc(*labels, value=value)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labels, labels), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0
+                ]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def empty(self):
+        return type(self)(
+            self.name, self.documentation, self.labels, self.buckets
+        )
+
+    def drain(self):
+        """
+        Removes and returns the values as (labels, part, value) deltas,
+        where part is a bucket index, ``sum`` or ``count``.
+        """
+
+        with self._lock:
+            values, self._values = self._values, {}
+        deltas = []
+        for labels, (counts, total, count) in values.items():
+            deltas.extend(
+                (labels, index, bucket)
+                for index, bucket in enumerate(counts) if bucket
+            )
+            deltas.append((labels, 'sum', total))
+            deltas.append((labels, 'count', count))
+        return deltas
+
+    def merge(self, labels, part, value):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0, 0
+                ]
+            if part == 'sum':
+                entry[1] += value
+            elif part == 'count':
+                entry[2] += int(value)
+            else:
+                entry[0][int(part)] += int(value)
+
+    def samples(self):
+        with self._lock:
+            values = {
+                labels: (list(counts), total, count)
+                for labels, (counts, total, count) in self._values.items()
+            }
+        for labels, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                yield (
+                    f'{self.name}_bucket',
+                    _format_labels(self.labels, labels, [('le', bound)]),
+                    cumulative,
+                )
+            label_text = _format_labels(self.labels, labels)
+            yield f'{self.name}_sum', label_text, total
+            yield f'{self.name}_count', label_text, count
+
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._function = None
+        self._lock = threading.Lock()
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function):
+        """
+        Reads the unlabelled value from ``function()`` at render time.
+        """
+
+        self._function = function
+
+    def empty(self):
+        return type(self)(self.name, self.documentation, self.labels)
+
+    def drain(self):
+        """
+        Gauges describe the current process and are never pushed.
+        """
+
+        return []
+
+    def merge(self, labels, part, value):
+        self.set(value, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        if self._function is not None:
+            values[()] = self._function()
+        for labels, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labels, labels), value
+
+
+class Registry:
+    """
+    In-process collection of metrics rendered in the Prometheus text
+    format. Each process keeps its own values.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(
+                    name, *args, **kwargs
+                )
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._get(Counter, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, documentation, labels, buckets)
+
+    def gauge(self, name, documentation, labels=()):
+        return self._get(Gauge, name, documentation, labels)
+
+    def metrics(self):
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda m: m.name)
+
+    def render(self):
+        return render_metrics(self.metrics())
+
+
+def render_metrics(metrics):
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{labels} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class RedisAggregator:
+    """
+    Sums the metrics of a registry across processes that cannot be
+    scraped one by one, such as Celery's prefork children. Each process
+    pushes what it recorded since its last push into one Redis hash per
+    metric; ``render`` reads the totals back.
+    """
+
+    def __init__(self, registry, client, prefix):
+        self.registry = registry
+        self.client = client
+        self.prefix = prefix
+
+    def key(self, metric):
+        return f'{self.prefix}:{metric.name}'
+
+    def push(self):
+        drained = [
+            (metric, metric.drain()) for metric in self.registry.metrics()
+        ]
+        pipe = self.client.pipeline(transaction=False)
+        for metric, deltas in drained:
+            for labels, part, value in deltas:
+                pipe.hincrbyfloat(
+                    self.key(metric), json.dumps([*labels, part]), value
+                )
+        try:
+            pipe.execute()
+        except Exception:
+            logger.exception('Could not push metrics, keeping them locally')
+            for metric, deltas in drained:
+                for delta in deltas:
+                    metric.merge(*delta)
+
+    def render(self):
+        metrics = self.registry.metrics()
+        pipe = self.client.pipeline(transaction=False)
+        for metric in metrics:
+            pipe.hgetall(self.key(metric))
+        totals = []
+        for metric, fields in zip(metrics, pipe.execute()):
+            total = metric.empty()
+            for field, value in fields.items():
+                *labels, part = json.loads(field)
+                total.merge(tuple(labels), part, float(value))
+            totals.append(total)
+        return render_metrics(totals)
+
+
+REGISTRY = Registry()
+
+
+class RequestStats:
+    """
+    Counters of the request being served, reachable from database
+    wrappers and caches through a context variable.
+    """
+
+    def __init__(self, capture_sql):
+        self.queries = 0
+        self.query_time = 0.0
+        self.cache_events = {}
+        self.statements = [] if capture_sql else None
+
+    def activate(self):
+        return _current.set(self)
+
+    @staticmethod
+    def deactivate(token):
+        _current.reset(token)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    ``connection.execute_wrapper`` that adds query counts and time to the
+    current request's stats.
+    """
+
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        stats.queries += 1
+        stats.query_time += elapsed
+        if stats.statements is not None:
+            stats.statements.append((elapsed, sql))
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """
+    ``connection_created`` receiver that installs ``record_query`` once
+    per database connection.
+    """
+
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def record_cache_event(event):
+    stats = _current.get()
+    if stats is not None:
+        stats.cache_events[event] = stats.cache_events.get(event, 0) + 1
+
+
+def metrics_authorized(request):
+    """
+    Whether the request carries ``Authorization: Bearer <METRICS_TOKEN>``.
+    Without a METRICS_TOKEN no request is.
+    """
+
+    token = settings.METRICS_TOKEN
+    header = request.headers.get('Authorization', '')
+    return bool(token) and hmac.compare_digest(
+        header.encode(), f'Bearer {token}'.encode()
+    )
+
+
+def metrics_response(request, render):
+    """
+    Returns ``render()`` for Prometheus to authorized requests, see
+    ``metrics_authorized``.
+    """
+
+    if not metrics_authorized(request):
+        return HttpResponse(status=403)
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
+
+
+def metrics_view(request):
+    """
+    Exposes the metrics of the process serving the request.
+    """
+
+    return metrics_response(request, REGISTRY.render)
+
@@ -0,0 +1,111 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+from .metrics import (
+    COUNT_BUCKETS, REGISTRY, SIZE_BUCKETS, RequestStats, install_query_wrapper,
+)
+
+logger = logging.getLogger(__name__)
+
+connection_created.connect(
+    install_query_wrapper, dispatch_uid='metrics_query_wrapper'
+)
+
+request_duration = REGISTRY.histogram(
+    'http_request_duration_seconds', 'Request latency.', ('route', 'method'),
+)
+requests_total = REGISTRY.counter(
+    'http_requests_total', 'Responses by status code.',
+    ('route', 'method', 'status'),
+)
+db_queries = REGISTRY.histogram(
+    'http_db_queries', 'Database queries per request.', ('route',),
+    buckets=COUNT_BUCKETS,
+)
+db_query_seconds = REGISTRY.counter(
+    'http_db_query_seconds_total', 'Time spent in database queries.',
+    ('route',),
+)
+response_size = REGISTRY.histogram(
+    'http_response_size_bytes', 'Response body size.', ('route',),
+    buckets=SIZE_BUCKETS,
+)
+cache_events = REGISTRY.counter(
+    'http_cache_events_total', 'Cache hits and misses during requests.',
+    ('route', 'event'),
+)
+
+
+def get_route(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unmatched>'
+    return match.url_name or match.view_name or match.route
+
+
+class RequestMetricsMiddleware:
+    """
+    Records latency, database queries, response size and cache events per
+    resolved route name. Requests slower than SLOW_REQUEST_THRESHOLD
+    seconds are logged with their SQL; the statements are only kept when
+    the threshold is set.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_threshold = settings.SLOW_REQUEST_THRESHOLD
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats(capture_sql=bool(self.slow_threshold))
+        token = stats.activate()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            RequestStats.deactivate(token)
+        self.record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats(capture_sql=bool(self.slow_threshold))
+        token = stats.activate()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            RequestStats.deactivate(token)
+        self.record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    def record(self, request, response, stats, elapsed):
+        route = get_route(request)
+        request_duration.observe(elapsed, route, request.method)
+        requests_total.inc(route, request.method, str(response.status_code))
+        db_queries.observe(stats.queries, route)
+        db_query_seconds.inc(route, value=stats.query_time)
+        if not response.streaming:
+            response_size.observe(len(response.content), route)
+        for event, count in stats.cache_events.items():
+            cache_events.inc(route, event, value=count)
+        if self.slow_threshold and elapsed >= self.slow_threshold:
+            self.log_slow_request(request, route, stats, elapsed)
+
+    def log_slow_request(self, request, route, stats, elapsed):
+        statements = sorted(stats.statements, reverse=True)[:20]
+        logger.warning(
+            "Slow request %s %s (%s): %.3fs, %d queries in %.3fs%s",
+            request.method, request.path, route, elapsed, stats.queries,
+            stats.query_time,
+            ''.join(f'\n  {t * 1000:.1f}ms {sql}' for t, sql in statements),
+        )
@@ -0,0 +1,212 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from celery import current_app
+from django.conf import settings
+
+from .metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP = 'drop'
+OVERFLOW_SYNC = 'sync'
+
+MESSAGE_RESULTS = {
+    'enqueued': 'enqueued',
+    'published': 'published',
+    'dropped': 'dropped',
+    'sync_published': 'sync',
+    'errors': 'error',
+}
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+publisher_messages = REGISTRY.counter(
+    'task_publisher_messages_total',
+    'Tasks queued, published from the queue, dropped, published by the '
+    'caller on overflow (sync) and failed (error).',
+    ('result',),
+)
+publisher_queue_wait = REGISTRY.histogram(
+    'task_publisher_queue_wait_seconds',
+    'Time a task waited in the publisher queue.',
+)
+publisher_batch_seconds = REGISTRY.histogram(
+    'task_publisher_batch_seconds', 'Time to publish one batch of tasks.',
+)
+publisher_queue_depth = REGISTRY.gauge(
+    'task_publisher_queue_depth', 'Tasks waiting in the publisher queue.',
+)
+
+
+class BackgroundPublisher:
+    """
+    Publishes Celery tasks from a bounded in-memory queue on a background
+    thread, so request threads never wait on the broker.
+
+    The thread drains up to ``batch_size`` messages at a time and sends
+    them through one pooled producer connection. When the queue is full
+    the ``overflow`` policy decides whether the caller blocks for
+    ``block_timeout`` seconds, drops the message or publishes it itself.
+    """
+
+    def __init__(self, maxsize, batch_size, overflow, block_timeout):
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stats = {
+            'enqueued': 0,
+            'published': 0,
+            'dropped': 0,
+            'sync_published': 0,
+            'errors': 0,
+            'batches': 0,
+            'publish_seconds_total': 0.0,
+            'publish_seconds_max': 0.0,
+            'queue_wait_seconds_max': 0.0,
+        }
+
+    def _record(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+        if key in MESSAGE_RESULTS:
+            publisher_messages.inc(MESSAGE_RESULTS[key], value=value)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run, name='task-publisher', daemon=True
+                )
+                self._thread.start()
+
+    def publish(self, task, args=(), kwargs=None, **options):
+        self._ensure_thread()
+        item = (task, args, kwargs or {}, options, time.monotonic())
+        try:
+            if self.overflow == OVERFLOW_BLOCK:
+                self._queue.put(item, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow == OVERFLOW_SYNC:
+                task.apply_async(args, kwargs, **options)
+                self._record('sync_published')
+                return
+            self._record('dropped')
+            logger.warning('Task publisher queue full, dropped %s', task.name)
+            return
+        self._record('enqueued')
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._send(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _send(self, batch):
+        started = time.monotonic()
+        try:
+            with current_app.producer_or_acquire() as producer:
+                for task, args, kwargs, options, enqueued_at in batch:
+                    waited = started - enqueued_at
+                    try:
+                        task.apply_async(
+                            args, kwargs, producer=producer, **options
+                        )
+                    except Exception:
+                        self._record('errors')
+                        logger.exception('Failed to publish %s', task.name)
+                        continue
+                    self._record('published')
+                    publisher_queue_wait.observe(waited)
+                    with self._lock:
+                        self._stats['queue_wait_seconds_max'] = max(
+                            self._stats['queue_wait_seconds_max'], waited
+                        )
+        except Exception:
+            self._record('errors', len(batch))
+            logger.exception('Failed to acquire a broker producer')
+        elapsed = time.monotonic() - started
+        publisher_batch_seconds.observe(elapsed)
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['publish_seconds_total'] += elapsed
+            self._stats['publish_seconds_max'] = max(
+                self._stats['publish_seconds_max'], elapsed
+            )
+
+    def flush(self, timeout=None):
+        """
+        Waits up to ``timeout`` seconds for the queue to drain. Returns
+        True when every queued message was handed to the broker.
+        """
+
+        if self._thread is None or self._pid != os.getpid():
+            return self._queue.unfinished_tasks == 0
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = (
+                    None if deadline is None else deadline - time.monotonic()
+                )
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = BackgroundPublisher(
+                    maxsize=settings.TASK_PUBLISHER_QUEUE_SIZE,
+                    batch_size=settings.TASK_PUBLISHER_BATCH_SIZE,
+                    overflow=settings.TASK_PUBLISHER_OVERFLOW,
+                    block_timeout=settings.TASK_PUBLISHER_BLOCK_TIMEOUT,
+                )
+                publisher_queue_depth.set_function(_publisher._queue.qsize)
+                atexit.register(_flush_at_exit)
+    return _publisher
+
+
+def _flush_at_exit():
+    if _publisher is not None:
+        if not _publisher.flush(settings.TASK_PUBLISHER_FLUSH_TIMEOUT):
+            logger.warning(
+                'Task publisher exited with %d unpublished messages',
+                _publisher.stats()['queue_depth'],
+            )
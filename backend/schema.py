@@ -0,0 +1,204 @@
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from importlib import import_module
+
+from django.apps import apps
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from drf_yasg.codecs import OpenAPICodecJson, OpenAPICodecYaml
+from drf_yasg.renderers import _SpecRenderer
+from drf_yasg.views import get_schema_view
+from rest_framework.response import Response
+
+SPEC_EXTENSIONS = {OpenAPICodecJson: 'json', OpenAPICodecYaml: 'yaml'}
+# Settings that change the generated schema without changing the code.
+SCHEMA_SETTINGS = (
+    'AUTH_THROTTLE_RATES',
+    'REST_FRAMEWORK',
+    'SIMPLE_JWT',
+    'SWAGGER_SETTINGS',
+)
+
+_accepts_gzip = re.compile(r'\bgzip\b')
+_code_version = None
+_specs = {}
+_specs_lock = threading.Lock()
+_ui_schemas = {}
+
+
+def get_code_version():
+    """
+    Returns CODE_VERSION, or a digest of the project's Python sources when
+    it is not set.
+    """
+
+    global _code_version
+    if _code_version is None:
+        version = settings.CODE_VERSION
+        if not version:
+            base_dir = str(settings.BASE_DIR)
+            roots = {
+                config.path for config in apps.get_app_configs()
+                if config.path.startswith(base_dir)
+            }
+            roots.add(os.path.dirname(
+                import_module(settings.ROOT_URLCONF).__file__
+            ))
+            digest = hashlib.sha256()
+            for root in sorted(roots):
+                for path, dirs, files in os.walk(root):
+                    dirs.sort()
+                    for name in sorted(files):
+                        if name.endswith('.py'):
+                            with open(os.path.join(path, name), 'rb') as f:
+                                digest.update(name.encode() + f.read())
+            version = digest.hexdigest()[:16]
+        _code_version = version
+    return _code_version
+
+
+class CachedSpec:
+    """
+    Rendered schema document with its gzipped body and validators.
+    """
+
+    def __init__(self, body, last_modified):
+        self.body = body
+        self.gzipped = gzip.compress(body, mtime=0)
+        self.etag = f'W/"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.last_modified = int(last_modified)
+
+    def respond(self, request, content_type):
+        response = get_conditional_response(
+            request, etag=self.etag, last_modified=self.last_modified
+        )
+        if response is None:
+            accept = request.META.get('HTTP_ACCEPT_ENCODING', '')
+            if _accepts_gzip.search(accept):
+                response = HttpResponse(self.gzipped, content_type=content_type)
+                response['Content-Encoding'] = 'gzip'
+            else:
+                response = HttpResponse(self.body, content_type=content_type)
+        response['ETag'] = self.etag
+        response['Last-Modified'] = http_date(self.last_modified)
+        response['Cache-Control'] = 'no-cache'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+
+def get_settings_version():
+    """
+    Returns a digest of the SCHEMA_SETTINGS values.
+    """
+
+    values = {name: getattr(settings, name, None) for name in SCHEMA_SETTINGS}
+    encoded = json.dumps(values, sort_keys=True, default=repr).encode()
+    return hashlib.sha256(encoded).hexdigest()[:16]
+
+
+def spec_path(codec_class, version):
+    return os.path.join(
+        settings.SCHEMA_CACHE_DIR,
+        f'openapi-{get_code_version()}-{get_settings_version()}-'
+        f'{version or "default"}.{SPEC_EXTENSIONS[codec_class]}',
+    )
+
+
+def render_spec(view_class, codec_class, version):
+    """
+    Generates the public schema without a request, so the document does
+    not depend on the host it is served from.
+    """
+
+    generator = view_class.generator_class(view_class.info, version)
+    return codec_class([]).encode(generator.get_schema(None, public=True))
+
+
+def write_spec(body, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+
+
+def get_spec(view_class, codec_class, version):
+    """
+    Returns the cached document for ``codec_class``, loading it from
+    SCHEMA_CACHE_DIR or generating and storing it on the first call of
+    the process. Files are named after the code version and the
+    SCHEMA_SETTINGS, so a deploy with new code or settings never serves
+    an old schema.
+    """
+
+    key = (codec_class, version)
+    spec = _specs.get(key)
+    if spec is not None:
+        return spec
+    with _specs_lock:
+        spec = _specs.get(key)
+        if spec is None:
+            path = spec_path(codec_class, version)
+            try:
+                with open(path, 'rb') as f:
+                    spec = CachedSpec(f.read(), os.path.getmtime(path))
+            except OSError:
+                spec = CachedSpec(
+                    render_spec(view_class, codec_class, version), time.time()
+                )
+                try:
+                    write_spec(spec.body, path)
+                except OSError:
+                    pass
+            _specs[key] = spec
+    return spec
+
+
+def get_ui_schema(view_class, version):
+    """
+    Returns the schema the Swagger UI and ReDoc pages are rendered from.
+    The pages only read its info and load the document itself from the
+    spec URL, so it is generated once per version without endpoints.
+    """
+
+    schema = _ui_schemas.get(version)
+    if schema is None:
+        generator = view_class.generator_class(
+            view_class.info, version, patterns=[]
+        )
+        schema = _ui_schemas.setdefault(
+            version, generator.get_schema(None, public=True)
+        )
+    return schema
+
+
+def get_cached_schema_view(info, **kwargs):
+    """
+    ``get_schema_view`` whose JSON and YAML documents are generated once
+    and served from memory with ETag, Last-Modified and gzip. The UI
+    pages are rendered from a schema generated once as well.
+    """
+
+    base_class = get_schema_view(info, public=True, **kwargs)
+
+    class CachedSchemaView(base_class):
+
+        def get(self, request, version='', format=None):
+            renderer = request.accepted_renderer
+            version = request.version or version or ''
+            if not isinstance(renderer, _SpecRenderer):
+                return Response(get_ui_schema(type(self), version))
+            spec = get_spec(type(self), renderer.codec_class, version)
+            return spec.respond(
+                request, f'{renderer.media_type}; charset={renderer.charset}'
+            )
+
+    CachedSchemaView.info = info
+    return CachedSchemaView
@@ -1,8 +1,10 @@
 import os
+import tempfile
 from datetime import timedelta
 from pathlib import Path
 import dj_database_url
 
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import find_dotenv, load_dotenv
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -10,12 +12,72 @@ TEMPLATE_DIR = os.path.join(BASE_DIR, "templates")
 ENV_FILE = find_dotenv()
 if ENV_FILE:
     load_dotenv(ENV_FILE)
+
+
+def redis_url(name):
+    """
+    Reads a Redis URL from the environment, '' when unset. Anything else,
+    such as a non-Redis broker URL, fails at startup.
+    """
+
+    url = os.getenv(name, '')
+    if url and not url.startswith(('redis://', 'rediss://', 'unix://')):
+        raise ImproperlyConfigured(
+            f'{name} must be a redis://, rediss:// or unix:// URL.'
+        )
+    return url
+
+
 SECRET_KEY = os.getenv('SECRET_KEY')
 DEBUG = os.getenv('DEBUG', 'True') == 'True'
 ALLOWED_HOSTS = ['*']
 CSRF_TRUSTED_ORIGINS = ['https://*']
 CELERY_BROKER_URL = os.environ['CELERY_BROKER_URL']
 CELERY_RESULT_BACKEND = 'django-db'
+CELERY_RESULT_EXPIRES = None
+CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+CELERY_BEAT_SCHEDULE = {
+    'purge-expired-records': {
+        'task': 'backend.tasks.purge_expired_records',
+        'schedule': timedelta(hours=1),
+    },
+}
+TASK_RESULT_MAX_AGE = timedelta(days=1)
+OTP_EMAIL_DISPATCH = os.getenv('OTP_EMAIL_DISPATCH', 'direct')
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_RELAY_INTERVAL = float(os.getenv('OUTBOX_RELAY_INTERVAL', 2))
+OUTBOX_RETENTION = timedelta(days=1)
+TASK_PUBLISHER_QUEUE_SIZE = int(os.getenv('TASK_PUBLISHER_QUEUE_SIZE', 1000))
+TASK_PUBLISHER_BATCH_SIZE = int(os.getenv('TASK_PUBLISHER_BATCH_SIZE', 50))
+TASK_PUBLISHER_OVERFLOW = os.getenv('TASK_PUBLISHER_OVERFLOW', 'sync')
+TASK_PUBLISHER_BLOCK_TIMEOUT = float(
+    os.getenv('TASK_PUBLISHER_BLOCK_TIMEOUT', 1)
+)
+TASK_PUBLISHER_FLUSH_TIMEOUT = float(
+    os.getenv('TASK_PUBLISHER_FLUSH_TIMEOUT', 5)
+)
+if OTP_EMAIL_DISPATCH == 'outbox':
+    CELERY_BEAT_SCHEDULE['relay-outbox-messages'] = {
+        'task': 'backend.tasks.relay_outbox_messages',
+        'schedule': timedelta(seconds=OUTBOX_RELAY_INTERVAL),
+    }
+TASK_RESULT_POLICIES = {
+    'backend.tasks.send_otp_email_celery': 'failures',
+    'backend.tasks.flush_otp_email_batch': 'failures',
+    'backend.tasks.send_bulk_otp_emails': 'failures',
+    'backend.tasks.relay_outbox_messages': 'failures',
+}
+# Redis URL of the capped failure store. Unset, failures of tasks with
+# the ``failures`` policy are written to the result backend instead.
+TASK_FAILURE_STORE_URL = redis_url('TASK_FAILURE_STORE_URL')
+TASK_FAILURE_STORE_SIZE = int(os.getenv('TASK_FAILURE_STORE_SIZE', 1000))
+# Redis URL the workers push task metrics to. Unset disables them.
+TASK_METRICS_URL = redis_url('TASK_METRICS_URL')
+TASK_METRICS_PUSH_INTERVAL = float(
+    os.getenv('TASK_METRICS_PUSH_INTERVAL', 10)
+)
+PURGE_CHUNK_SIZE = int(os.getenv('PURGE_CHUNK_SIZE', 1000))
+PURGE_CHUNK_PAUSE = float(os.getenv('PURGE_CHUNK_PAUSE', 0.1))
 EMAIL_BACKEND = os.getenv('EMAIL_BACKEND')
 EMAIL_HOST = os.getenv('EMAIL_HOST')
 EMAIL_PORT = os.getenv('EMAIL_PORT')
@@ -23,6 +85,32 @@ EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS') == 'True'
 EMAIL_USE_SSL = os.getenv('EMAIL_USE_SSL') == 'True'
 EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
+CACHE_URL = os.getenv('CACHE_URL')
+OTP_STORE_BACKEND = os.getenv(
+    'OTP_STORE_BACKEND', 'users.otp.DatabaseOTPStore'
+)
+OTP_CACHE_ALIAS = 'default'
+OTP_LIFETIME = timedelta(minutes=15)
+OTP_MAX_TRIES = 5
+OTP_COALESCE_WINDOW = int(os.getenv('OTP_COALESCE_WINDOW', 30))
+OTP_COALESCE_RESEND = os.getenv('OTP_COALESCE_RESEND', 'True') == 'True'
+OTP_ATTEMPT_STORE_BACKEND = os.getenv(
+    'OTP_ATTEMPT_STORE_BACKEND', 'users.attempts.DatabaseAttemptStore'
+)
+OTP_ATTEMPT_CACHE_ALIAS = 'default'
+OTP_LOCKOUT_WINDOW = timedelta(minutes=15)
+SMTP_POOL_SIZE = int(os.getenv('SMTP_POOL_SIZE', 1))
+SMTP_POOL_MAX_AGE = int(os.getenv('SMTP_POOL_MAX_AGE', 300))
+SMTP_POOL_MAX_MESSAGES = int(os.getenv('SMTP_POOL_MAX_MESSAGES', 100))
+SMTP_POOL_CHECKOUT_TIMEOUT = int(os.getenv('SMTP_POOL_CHECKOUT_TIMEOUT', 10))
+OTP_EMAIL_BATCHING = os.getenv('OTP_EMAIL_BATCHING') == 'True'
+OTP_EMAIL_BATCH_SIZE = int(os.getenv('OTP_EMAIL_BATCH_SIZE', 100))
+OTP_EMAIL_BATCH_WINDOW = float(os.getenv('OTP_EMAIL_BATCH_WINDOW', 2))
+OTP_EMAIL_BUFFER_URL = redis_url('OTP_EMAIL_BUFFER_URL')
+if OTP_EMAIL_BATCHING and not OTP_EMAIL_BUFFER_URL:
+    raise ImproperlyConfigured(
+        'OTP_EMAIL_BATCHING needs OTP_EMAIL_BUFFER_URL.'
+    )
 
 
 INSTALLED_APPS = [
@@ -43,6 +131,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'backend.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -98,6 +187,20 @@ DATABASES = {
 }
 """
 
+if CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 AUTH_USER_MODEL = "users.User"
 
 
@@ -132,13 +235,61 @@ STATIC_URL = '/static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 PASSWORD_HASHERS = [
-    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'users.hashers.CalibratedArgon2PasswordHasher',
 ]
+ARGON2_TIME_COST = int(os.getenv('ARGON2_TIME_COST', 2))
+ARGON2_MEMORY_COST = int(os.getenv('ARGON2_MEMORY_COST', 102400))
+ARGON2_PARALLELISM = int(os.getenv('ARGON2_PARALLELISM', 8))
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    ]
+        os.getenv(
+            'JWT_AUTHENTICATION',
+            'users.authentication.StatelessJWTAuthentication'
+        ),
+    ],
+    'EXCEPTION_HANDLER': 'api.exceptions.exception_handler',
+    # Proxies in front of the app. With 0 the client address is
+    # REMOTE_ADDR and a client supplied X-Forwarded-For is ignored.
+    'NUM_PROXIES': int(os.getenv('NUM_PROXIES', 0)),
+}
+TOKEN_VERSION_CACHE_ALIAS = 'default'
+REVOCATION_CACHE_ALIAS = 'default'
+REVOCATION_SYNC_INTERVAL = float(os.getenv('REVOCATION_SYNC_INTERVAL', 1))
+REVOCATION_BLOOM_CAPACITY = int(
+    os.getenv('REVOCATION_BLOOM_CAPACITY', 100000)
+)
+REVOCATION_BLOOM_ERROR_RATE = float(
+    os.getenv('REVOCATION_BLOOM_ERROR_RATE', 0.001)
+)
+REVOCATION_BLOOM_MAX_AGE = int(os.getenv('REVOCATION_BLOOM_MAX_AGE', 3600))
+USER_CACHE_ALIAS = 'default'
+USER_CACHE_TIMEOUT = int(os.getenv('USER_CACHE_TIMEOUT', 300))
+USER_CACHE_LOCAL_SIZE = int(os.getenv('USER_CACHE_LOCAL_SIZE', 1024))
+USER_CACHE_LOCAL_TTL = float(os.getenv('USER_CACHE_LOCAL_TTL', 5))
+USER_EXPORT_CHUNK_SIZE = int(os.getenv('USER_EXPORT_CHUNK_SIZE', 2000))
+USER_IMPORT_BATCH_SIZE = int(os.getenv('USER_IMPORT_BATCH_SIZE', 500))
+USER_IMPORT_HASH_WORKERS = int(
+    os.getenv('USER_IMPORT_HASH_WORKERS', os.cpu_count() or 1)
+)
+USER_IMPORT_MAX_ROWS = int(os.getenv('USER_IMPORT_MAX_ROWS', 10000))
+# Staged imports no worker took are purged after this age.
+USER_IMPORT_MAX_AGE = timedelta(days=1)
+USER_FAST_SERIALIZATION = (
+    os.getenv('USER_FAST_SERIALIZATION', 'True') == 'True'
+)
+
+CODE_VERSION = os.getenv('CODE_VERSION', '')
+SCHEMA_CACHE_DIR = os.getenv(
+    'SCHEMA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'openapi')
+)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+SLOW_REQUEST_THRESHOLD = float(os.getenv('SLOW_REQUEST_THRESHOLD', 0))
+THROTTLE_CACHE_ALIAS = 'default'
+AUTH_THROTTLE_RATES = {
+    'one_time_password': {'ip': '20/min', 'email': '5/min'},
+    'verify_account': {'ip': '30/min', 'email': '10/min'},
+    'token_obtain_pair': {'ip': '30/min', 'email': '10/min'},
 }
 
 SIMPLE_JWT = {
@@ -0,0 +1,248 @@
+import logging
+import queue
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.mail.backends.smtp import EmailBackend
+
+from .task_metrics import smtp_connections, smtp_pool_events, smtp_pool_wait
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+
+POOL_EVENTS = {'hits': 'hit', 'misses': 'miss', 'reconnects': 'reconnect'}
+
+
+class SMTPPoolExhausted(Exception):
+    """
+    No pooled SMTP connection was returned within the checkout timeout.
+    """
+
+
+class PooledConnection:
+    """
+    Django email backend with an open SMTP session and its usage counters.
+    """
+
+    def __init__(self):
+        self.backend = get_connection(fail_silently=False)
+        self.backend.open()
+        self.created_at = time.monotonic()
+        self.messages_sent = 0
+
+    def is_expired(self, max_age, max_messages):
+        return (
+            time.monotonic() - self.created_at > max_age
+            or self.messages_sent >= max_messages
+        )
+
+    def is_alive(self):
+        if self.backend.connection is None:
+            return False
+        try:
+            return self.backend.connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def close(self):
+        try:
+            self.backend.close()
+        except Exception:
+            logger.debug('Error while closing SMTP connection', exc_info=True)
+
+
+class SMTPConnectionPool:
+    """
+    Small per-process pool of persistent SMTP sessions.
+
+    Connections are checked with NOOP before being handed out and are
+    recycled once they exceed ``max_age`` seconds or ``max_messages``
+    sent messages. At most ``size`` connections are open at once; a
+    checkout waits up to ``timeout`` seconds for one to be returned and
+    then raises SMTPPoolExhausted.
+    """
+
+    def __init__(self, size, max_age, max_messages, timeout):
+        self.size = size
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'reconnects': 0,
+            'checkouts': 0,
+            'wait_seconds_total': 0.0,
+            'wait_seconds_max': 0.0,
+        }
+
+    def open(self):
+        while self._reserve():
+            try:
+                self._idle.put(self._connect())
+            except (smtplib.SMTPException, OSError):
+                logger.warning(
+                    'Could not prefill SMTP pool', exc_info=True
+                )
+                break
+
+    def _reserve(self):
+        """
+        Counts a new connection against ``size``. Returns False when the
+        pool is full.
+        """
+
+        with self._lock:
+            if self._created >= self.size:
+                return False
+            self._created += 1
+            return True
+
+    def _connect(self):
+        """
+        Opens a connection for a slot taken with ``_reserve``, giving the
+        slot back when the connection fails.
+        """
+
+        try:
+            conn = PooledConnection()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+        smtp_connections.inc('opened')
+        return conn
+
+    def _record(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+        smtp_pool_events.inc(POOL_EVENTS[key], value=value)
+
+    def checkout(self):
+        started = time.monotonic()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+            if not self._reserve():
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise SMTPPoolExhausted(
+                        f'All {self.size} SMTP connections stayed in use '
+                        f'for {self.timeout} seconds.'
+                    ) from None
+        if conn is None:
+            self._record('misses')
+            conn = self._connect()
+        else:
+            self._record('hits')
+            if (conn.is_expired(self.max_age, self.max_messages)
+                    or not conn.is_alive()):
+                # The new connection takes over the slot of the old one.
+                self._record('reconnects')
+                conn.close()
+                smtp_connections.inc('closed')
+                conn = self._connect()
+        waited = time.monotonic() - started
+        smtp_pool_wait.observe(waited)
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['wait_seconds_total'] += waited
+            self._stats['wait_seconds_max'] = max(
+                self._stats['wait_seconds_max'], waited
+            )
+        return conn
+
+    def checkin(self, conn, broken=False):
+        if broken:
+            self._discard(conn)
+        else:
+            self._idle.put(conn)
+
+    def _discard(self, conn):
+        conn.close()
+        with self._lock:
+            self._created -= 1
+        smtp_connections.inc('closed')
+
+    @contextmanager
+    def connection(self):
+        conn = self.checkout()
+        broken = False
+        try:
+            yield conn
+        except (smtplib.SMTPException, OSError):
+            broken = True
+            raise
+        finally:
+            self.checkin(conn, broken=broken)
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['open'] = self._created
+            stats['idle'] = self._idle.qsize()
+        return stats
+
+
+def get_pool():
+    return _pool
+
+
+@contextmanager
+def smtp_connection():
+    """
+    Yields a (backend, pooled) pair: a pooled SMTP session when the worker
+    pool is running, otherwise a fresh per-call connection.
+    """
+
+    if _pool is None:
+        connection = get_connection(fail_silently=False)
+        try:
+            yield connection, None
+        finally:
+            connection.close()
+        return
+    with _pool.connection() as conn:
+        yield conn.backend, conn
+
+
+def open_smtp_pool():
+    global _pool
+    if settings.SMTP_POOL_SIZE <= 0:
+        return
+    if not isinstance(get_connection(), EmailBackend):
+        return
+    _pool = SMTPConnectionPool(
+        size=settings.SMTP_POOL_SIZE,
+        max_age=settings.SMTP_POOL_MAX_AGE,
+        max_messages=settings.SMTP_POOL_MAX_MESSAGES,
+        timeout=settings.SMTP_POOL_CHECKOUT_TIMEOUT,
+    )
+    _pool.open()
+
+
+def close_smtp_pool():
+    global _pool
+    if _pool is None:
+        return
+    logger.info('SMTP pool stats: %s', _pool.stats())
+    _pool.close()
+    _pool = None
@@ -0,0 +1,156 @@
+import threading
+import time
+from datetime import datetime
+
+import redis
+from django.conf import settings
+from django.http import HttpResponse
+
+from .metrics import (CONTENT_TYPE, RedisAggregator, Registry,
+                      metrics_authorized)
+
+TASK_METRICS_PREFIX = 'task-metrics'
+ENQUEUED_AT_HEADER = 'enqueued_at'
+EMAIL_SENT = 'sent'
+EMAIL_FAILED = 'failed'
+
+SMTP_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+TASK_REGISTRY = Registry()
+
+queue_wait = TASK_REGISTRY.histogram(
+    'celery_task_queue_wait_seconds',
+    'Time from publishing a task, or from its ETA, to a worker starting it.',
+    ('task',), buckets=WAIT_BUCKETS,
+)
+run_time = TASK_REGISTRY.histogram(
+    'celery_task_run_seconds', 'Task execution time.', ('task',),
+)
+tasks_total = TASK_REGISTRY.counter(
+    'celery_tasks_total', 'Finished tasks by state.', ('task', 'state'),
+)
+task_failures = TASK_REGISTRY.counter(
+    'celery_task_failures_total', 'Failed tasks by exception.',
+    ('task', 'exception'),
+)
+email_send_seconds = TASK_REGISTRY.histogram(
+    'celery_email_send_seconds', 'Time to send one email over SMTP.',
+    ('result',),
+)
+emails_total = TASK_REGISTRY.counter(
+    'celery_emails_total', 'Emails sent and failed.', ('result',),
+)
+smtp_pool_events = TASK_REGISTRY.counter(
+    'celery_smtp_pool_events_total',
+    'SMTP pool checkouts served from an idle connection (hit), by a new '
+    'connection (miss) and idle connections replaced (reconnect).',
+    ('event',),
+)
+smtp_pool_wait = TASK_REGISTRY.histogram(
+    'celery_smtp_pool_wait_seconds', 'Time to check out an SMTP connection.',
+    buckets=SMTP_WAIT_BUCKETS,
+)
+smtp_connections = TASK_REGISTRY.counter(
+    'celery_smtp_connections_total',
+    'SMTP connections opened and closed by the pools; the difference is '
+    'the number of open connections.',
+    ('event',),
+)
+
+_started = {}
+_aggregator = None
+_aggregator_lock = threading.Lock()
+_pushed_at = None
+
+
+def get_task_aggregator():
+    """
+    Returns the aggregator on TASK_METRICS_URL, or None when no URL is
+    set. The client is created on first use.
+    """
+
+    global _aggregator
+    if _aggregator is None and settings.TASK_METRICS_URL:
+        with _aggregator_lock:
+            if _aggregator is None:
+                _aggregator = RedisAggregator(
+                    TASK_REGISTRY,
+                    redis.Redis.from_url(settings.TASK_METRICS_URL),
+                    TASK_METRICS_PREFIX,
+                )
+    return _aggregator
+
+
+def stamp_enqueue_time(headers):
+    headers.setdefault(ENQUEUED_AT_HEADER, time.time())
+
+
+def _ready_at(request):
+    enqueued_at = getattr(request, ENQUEUED_AT_HEADER, None)
+    if enqueued_at is None or not request.eta:
+        return enqueued_at
+    try:
+        eta = datetime.fromisoformat(request.eta).timestamp()
+    except (TypeError, ValueError):
+        return enqueued_at
+    return max(enqueued_at, eta)
+
+
+def task_started(task_id, task):
+    _started[task_id] = time.perf_counter()
+    ready_at = _ready_at(task.request)
+    if ready_at is not None:
+        queue_wait.observe(max(0.0, time.time() - ready_at), task.name)
+
+
+def task_finished(task_id, task, state):
+    started = _started.pop(task_id, None)
+    if started is not None:
+        run_time.observe(time.perf_counter() - started, task.name)
+    tasks_total.inc(task.name, state or 'UNKNOWN')
+    push_task_metrics(settings.TASK_METRICS_PUSH_INTERVAL)
+
+
+def task_failed(task, exception):
+    task_failures.inc(task.name, type(exception).__name__)
+
+
+def record_email_send(result, elapsed):
+    email_send_seconds.observe(elapsed, result)
+    emails_total.inc(result)
+
+
+def push_task_metrics(min_interval=0):
+    """
+    Pushes what this process recorded to the shared totals, at most once
+    every ``min_interval`` seconds. Without TASK_METRICS_URL the metrics
+    stay in the process.
+    """
+
+    global _pushed_at
+    aggregator = get_task_aggregator()
+    if aggregator is None:
+        return
+    now = time.monotonic()
+    if _pushed_at is not None and now - _pushed_at < min_interval:
+        return
+    _pushed_at = now
+    aggregator.push()
+
+
+def task_metrics_view(request):
+    """
+    Exposes the task metrics summed over all workers. Answers 503 when
+    TASK_METRICS_URL is not set.
+    """
+
+    if not metrics_authorized(request):
+        return HttpResponse(status=403)
+    aggregator = get_task_aggregator()
+    if aggregator is None:
+        return HttpResponse(
+            'TASK_METRICS_URL is not set.', status=503,
+            content_type='text/plain',
+        )
+    return HttpResponse(aggregator.render(), content_type=CONTENT_TYPE)
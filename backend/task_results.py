@@ -0,0 +1,79 @@
+import json
+import traceback
+
+import redis
+from django.conf import settings
+from django.utils import timezone
+
+RESULT_POLICY_ALL = 'all'
+RESULT_POLICY_FAILURES = 'failures'
+RESULT_POLICY_NONE = 'none'
+
+TASK_FAILURES_KEY = 'task-failures'
+
+_client = None
+
+
+def get_result_policy(task_name):
+    return settings.TASK_RESULT_POLICIES.get(task_name, RESULT_POLICY_ALL)
+
+
+def uses_failure_store(task_name):
+    """
+    Whether failures of ``task_name`` go to the capped failure store.
+    """
+
+    return (
+        bool(settings.TASK_FAILURE_STORE_URL)
+        and get_result_policy(task_name) == RESULT_POLICY_FAILURES
+    )
+
+
+def result_annotations(policies):
+    """
+    Builds CELERY_TASK_ANNOTATIONS that switch off result backend writes
+    for every task whose policy is not ``all``. Without a failure store,
+    tasks with the ``failures`` policy keep writing their failures to the
+    result backend.
+    """
+
+    annotations = {}
+    for name, policy in policies.items():
+        if policy == RESULT_POLICY_ALL:
+            continue
+        annotations[name] = {'ignore_result': True}
+        if (policy == RESULT_POLICY_FAILURES
+                and not settings.TASK_FAILURE_STORE_URL):
+            annotations[name]['store_errors_even_if_ignored'] = True
+    return annotations
+
+
+def get_failure_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.TASK_FAILURE_STORE_URL)
+    return _client
+
+
+def record_failure(task_name, task_id, exception, tb=None):
+    """
+    Pushes a failure onto a capped list holding the latest
+    TASK_FAILURE_STORE_SIZE entries.
+    """
+
+    entry = json.dumps({
+        'task': task_name,
+        'task_id': task_id,
+        'exception': repr(exception),
+        'traceback': ''.join(traceback.format_tb(tb)) if tb else '',
+        'date_done': timezone.now().isoformat(),
+    })
+    pipe = get_failure_client().pipeline()
+    pipe.lpush(TASK_FAILURES_KEY, entry)
+    pipe.ltrim(TASK_FAILURES_KEY, 0, settings.TASK_FAILURE_STORE_SIZE - 1)
+    pipe.execute()
+
+
+def recent_failures(limit=100):
+    raw = get_failure_client().lrange(TASK_FAILURES_KEY, 0, limit - 1)
+    return [json.loads(item) for item in raw]
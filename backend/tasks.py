@@ -2,15 +2,97 @@ import logging
 
 from celery import shared_task
 from django.conf import settings
-from django.core.mail import send_mail
+
+from .mail import (buffer_otp_email, cancel_otp_email_flush,
+                   drain_otp_email_buffer, release_otp_email_flush,
+                   send_otp_messages)
 
 logger = logging.getLogger(__name__)
 
 
 @shared_task
 def send_otp_email_celery(email, otp):
-    message = f'Your OTP is: {otp}'
-    send_mail(
-        'Lengevity inTime login', message,
-        settings.EMAIL_HOST, [email], fail_silently=True
-        )
+    if settings.OTP_EMAIL_BATCHING:
+        if buffer_otp_email(email, otp):
+            try:
+                flush_otp_email_batch.apply_async(
+                    countdown=settings.OTP_EMAIL_BATCH_WINDOW
+                )
+            except Exception:
+                cancel_otp_email_flush()
+                raise
+        return
+    send_otp_messages([(email, otp)])
+
+
+@shared_task
+def send_bulk_otp_emails(items):
+    """
+    Sends OTP emails for a batch of (email, otp) pairs nobody is waiting
+    on, such as those of a user import, over one SMTP connection.
+    """
+
+    sent, failed = send_otp_messages([tuple(item) for item in items])
+    return {'sent': sent, 'failed': failed}
+
+
+@shared_task
+def flush_otp_email_batch():
+    """
+    Sends up to OTP_EMAIL_BATCH_SIZE buffered OTP emails over one SMTP
+    connection.
+    """
+
+    items = drain_otp_email_buffer(settings.OTP_EMAIL_BATCH_SIZE)
+    sent, failed = send_otp_messages(items)
+    if items:
+        logger.info('OTP email batch: %d sent, %d failed', sent, failed)
+    if release_otp_email_flush():
+        try:
+            flush_otp_email_batch.delay()
+        except Exception:
+            cancel_otp_email_flush()
+            raise
+    return {'sent': sent, 'failed': failed}
+
+
+@shared_task
+def import_user_rows(import_id, send_otp=True):
+    """
+    Runs a user import staged by the bulk endpoint. The result holds the
+    number of created users and the errors per row.
+    """
+
+    from users.bulk import import_staged
+
+    return import_staged(import_id, send_otp=send_otp)
+
+
+@shared_task
+def purge_expired_records():
+    """
+    Deletes expired OTPs, aged task results, relayed outbox messages,
+    expired revoked tokens and abandoned user imports in bounded chunks.
+    """
+
+    from users.maintenance import purge_expired
+
+    result = purge_expired()
+    logger.info('Purged expired records: %s', result)
+    return result
+
+
+@shared_task
+def relay_outbox_messages():
+    """
+    Publishes pending outbox messages until the outbox is drained.
+    """
+
+    from users.outbox import relay_outbox
+
+    total = 0
+    while True:
+        published = relay_outbox(settings.OUTBOX_BATCH_SIZE)
+        total += published
+        if published < settings.OUTBOX_BATCH_SIZE:
+            return total
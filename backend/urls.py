@@ -1,14 +1,17 @@
 from django.contrib import admin
 from django.urls import include, path
 from drf_yasg import openapi
-from drf_yasg.views import get_schema_view
 from rest_framework import permissions
 from django.conf import settings
 from django.conf.urls.static import static
 
 from users import views
 
-schema_view = get_schema_view(
+from .metrics import metrics_view
+from .schema import get_cached_schema_view
+from .task_metrics import task_metrics_view
+
+schema_view = get_cached_schema_view(
     openapi.Info(
         title="Longevity-InTime API",
         default_version='v1',
@@ -20,7 +23,6 @@ schema_view = get_schema_view(
         contact=openapi.Contact(email="turnpace1000@gmail.com"),
         license=openapi.License(name="BSD License"),
     ),
-    public=True,
     permission_classes=(permissions.AllowAny,),
 )
 
@@ -44,6 +46,8 @@ urlpatterns = [
         "auth/token/logout/", views.TokenLogoutView.as_view(),
         name='token_logout'
     ),
+    path('metrics', metrics_view, name='metrics'),
+    path('metrics/celery', task_metrics_view, name='task_metrics'),
 ]
 
 
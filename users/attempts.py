@@ -0,0 +1,92 @@
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from django.utils.module_loading import import_string
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class BaseAttemptStore:
+    """
+    Counter of OTP attempts used by verification and login.
+
+    ``reserve`` counts one attempt and returns False once the user is
+    locked out, ``reset`` clears the counter after a successful check or
+    when a new code is issued. Stores that keep the counter in the user
+    row set ``in_user_row``; ``User.mark_verified`` clears it as well.
+    """
+
+    in_user_row = False
+
+    def reserve(self, user):
+        raise NotImplementedError
+
+    def reset(self, user):
+        raise NotImplementedError
+
+
+class DatabaseAttemptStore(BaseAttemptStore):
+    """
+    Keeps the counter in the ``User.otp_tries`` column.
+    """
+
+    in_user_row = True
+
+    def reserve(self, user):
+        return user.reserve_otp_try()
+
+    def reset(self, user):
+        user.reset_otp_tries()
+
+
+class CacheAttemptStore(BaseAttemptStore):
+    """
+    Keeps the counter in a Django cache.
+
+    Every attempt increments the counter and pushes its expiry
+    OTP_LOCKOUT_WINDOW into the future, so a locked out user stays locked
+    while attempts keep coming in. Wrong guesses never touch the database.
+    """
+
+    def __init__(self, alias=None):
+        self.alias = alias or settings.OTP_ATTEMPT_CACHE_ALIAS
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, user):
+        return f'otp-tries:{user.pk}'
+
+    def reserve(self, user):
+        key = self.key(user)
+        window = int(settings.OTP_LOCKOUT_WINDOW.total_seconds())
+        if isinstance(self.cache, RedisCache):
+            redis_key = self.cache.make_and_validate_key(key)
+            client = self.cache._cache.get_client(redis_key, write=True)
+            pipe = client.pipeline()
+            pipe.incr(redis_key)
+            pipe.expire(redis_key, window)
+            tries, _ = pipe.execute()
+        else:
+            with self._lock:
+                self.cache.add(key, 0, window)
+                tries = self.cache.incr(key)
+                self.cache.touch(key, window)
+        return tries <= settings.OTP_MAX_TRIES + 1
+
+    def reset(self, user):
+        self.cache.delete(self.key(user))
+
+
+def get_attempt_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = import_string(settings.OTP_ATTEMPT_STORE_BACKEND)()
+    return _store
@@ -0,0 +1,98 @@
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import (AuthenticationFailed,
+                                                InvalidToken)
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.settings import api_settings
+
+from .cache import get_user_cache
+from .models import User
+from .revocation import get_revocation_store
+from .tokens import (TOKEN_VERSION_CLAIM, get_token_version,
+                     token_versions_are_shared)
+
+
+class ClaimsUser(TokenUser):
+    """
+    User built from signed token claims.
+
+    ``id``, ``is_superuser`` and ``verified`` come from the token; any
+    other attribute loads the ``User`` row on first access.
+    """
+
+    @cached_property
+    def verified(self):
+        return self.token.get('verified', False)
+
+    @property
+    def username(self):
+        return self.instance.username
+
+    @cached_property
+    def instance(self):
+        try:
+            return get_user_cache().get_by_id(self.id)
+        except User.DoesNotExist:
+            raise AuthenticationFailed(
+                _('User not found'), code='user_not_found'
+            )
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.instance, name)
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication that does not select the user row per request.
+
+    The token version claim is compared with the user's current version,
+    kept in the cache, so bumping the version on password change or
+    deletion invalidates issued tokens. Single tokens revoked on logout
+    are rejected through the revocation store. Tokens without a version
+    claim fall back to a lookup through the user cache.
+
+    Without a shared cache the version would have to be selected on every
+    request anyway, so the user row is loaded like ``JWTAuthentication``
+    does and its version compared, which costs the same single query.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(
+                _('Token contained no recognizable user identification')
+            )
+        jti = validated_token.get(api_settings.JTI_CLAIM)
+        if jti and get_revocation_store().is_revoked(jti):
+            raise AuthenticationFailed(
+                _('Token has been revoked'), code='token_revoked'
+            )
+        if not token_versions_are_shared():
+            user = super().get_user(validated_token)
+            version = validated_token.get(TOKEN_VERSION_CLAIM)
+            if version is not None and version != user.token_version:
+                raise AuthenticationFailed(
+                    _('Token has been revoked'), code='token_revoked'
+                )
+            return user
+        if TOKEN_VERSION_CLAIM not in validated_token:
+            try:
+                user = get_user_cache().get_by_id(user_id)
+            except User.DoesNotExist:
+                raise AuthenticationFailed(
+                    _('User not found'), code='user_not_found'
+                )
+            if not user.is_active:
+                raise AuthenticationFailed(
+                    _('User is inactive'), code='user_inactive'
+                )
+            return user
+        if get_token_version(user_id) != validated_token[TOKEN_VERSION_CLAIM]:
+            raise AuthenticationFailed(
+                _('Token has been revoked'), code='token_revoked'
+            )
+        return ClaimsUser(validated_token)
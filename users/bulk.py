@@ -0,0 +1,244 @@
+import base64
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+import django
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.utils.crypto import salted_hmac
+
+from .dispatch import dispatch_otp_emails
+from .models import User, UserImport
+from .otp import issue_otps
+from .tokens import set_token_versions
+
+IMPORT_FIELDS = ['email', 'username', 'first_name', 'last_name', 'password']
+
+
+def clean_row(row):
+    """
+    Validates one import row. Returns an unsaved ``User`` and the raw
+    password, or None and a dict of errors per field.
+
+    Uniqueness is checked separately for the whole import.
+    """
+
+    if not isinstance(row, dict):
+        return None, {'non_field_errors': ['Must be an object.']}
+    errors = {}
+    for field in IMPORT_FIELDS:
+        value = row.get(field)
+        if value is None or value == '':
+            errors[field] = ['This field is required.']
+        elif not isinstance(value, str):
+            errors[field] = ['Must be a string.']
+    if errors:
+        return None, errors
+    user = User(
+        email=User.objects.normalize_email(row['email']),
+        username=User.normalize_username(row['username']),
+        first_name=row['first_name'],
+        last_name=row['last_name'],
+    )
+    try:
+        user.clean_fields(exclude=['password'])
+    except ValidationError as e:
+        return None, e.message_dict
+    return user, row['password']
+
+
+def _find_existing(field, values, chunk_size):
+    existing = set()
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start + chunk_size]
+        existing.update(
+            User.objects.filter(**{f'{field}__in': chunk})
+            .values_list(field, flat=True)
+        )
+    return existing
+
+
+def validate_rows(rows, chunk_size):
+    """
+    Validates all rows before anything is written.
+
+    Returns a list of (index, user, password) for valid rows and a list of
+    per-row errors. Emails and usernames are checked against each other
+    and against the database with one query per ``chunk_size`` values.
+    """
+
+    valid, errors = [], []
+    seen = {'email': set(), 'username': set()}
+    for index, row in enumerate(rows):
+        user, result = clean_row(row)
+        if user is None:
+            errors.append({'row': index, 'errors': result})
+            continue
+        duplicates = {
+            field: ['Duplicate value in this import.']
+            for field in seen if getattr(user, field) in seen[field]
+        }
+        for field in seen:
+            seen[field].add(getattr(user, field))
+        if duplicates:
+            errors.append({'row': index, 'errors': duplicates})
+            continue
+        valid.append((index, user, result))
+    existing = {
+        field: _find_existing(
+            field, [getattr(user, field) for _, user, _ in valid], chunk_size
+        )
+        for field in seen
+    }
+    unique = []
+    for index, user, password in valid:
+        taken = {
+            field: [f'user with this {field} already exists.']
+            for field in existing if getattr(user, field) in existing[field]
+        }
+        if taken:
+            errors.append({'row': index, 'errors': taken})
+        else:
+            unique.append((index, user, password))
+    return unique, errors
+
+
+def _insert(users, send_otp):
+    User.objects.bulk_create(users)
+    set_token_versions({user.pk: user.token_version for user in users})
+    if send_otp:
+        codes = issue_otps(users)
+        dispatch_otp_emails(
+            (user.email, otp) for user, otp in zip(users, codes)
+        )
+
+
+def _create_batch(batch, send_otp):
+    """
+    Inserts one batch in a transaction. When a concurrent write makes the
+    batch conflict, its rows are retried one by one so only the
+    conflicting rows fail.
+    """
+
+    try:
+        with transaction.atomic():
+            _insert([user for _, user in batch], send_otp)
+        return len(batch), []
+    except IntegrityError:
+        pass
+    created, errors = 0, []
+    for index, user in batch:
+        user.pk = None
+        try:
+            with transaction.atomic():
+                _insert([user], send_otp)
+        except IntegrityError:
+            errors.append({
+                'row': index,
+                'errors': {'non_field_errors': ['User already exists.']},
+            })
+        else:
+            created += 1
+    return created, errors
+
+
+def _hash_all(passwords, workers):
+    if workers <= 1 or len(passwords) < 2:
+        return map(make_password, passwords), None
+    if multiprocessing.current_process().daemon:
+        # Celery's prefork children may not start processes. Argon2 runs
+        # in C without the GIL, so threads hash in parallel too.
+        pool = ThreadPoolExecutor(max_workers=workers)
+    else:
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup,
+        )
+    chunksize = max(1, len(passwords) // (workers * 4))
+    return pool.map(make_password, passwords, chunksize=chunksize), pool
+
+
+def import_users(rows, send_otp=True, batch_size=None, workers=None):
+    """
+    Creates users from a list of dicts with the ``IMPORT_FIELDS`` keys.
+
+    All rows are validated first. Passwords of the valid rows are hashed
+    in a pool of ``workers`` processes while the main process inserts
+    users and OTPs in batches of ``batch_size`` with ``bulk_create`` and
+    schedules the OTP emails per batch. Returns the number of created
+    users and the errors per row index.
+    """
+
+    batch_size = batch_size or settings.USER_IMPORT_BATCH_SIZE
+    workers = workers or settings.USER_IMPORT_HASH_WORKERS
+    valid, errors = validate_rows(rows, batch_size)
+    hashes, pool = _hash_all([password for _, _, password in valid], workers)
+    created = 0
+    try:
+        pending = iter(valid)
+        while True:
+            batch = list(islice(pending, batch_size))
+            if not batch:
+                break
+            for (_, user, _), hashed in zip(batch, hashes):
+                user.password = hashed
+            count, batch_errors = _create_batch(
+                [(index, user) for index, user, _ in batch], send_otp
+            )
+            created += count
+            errors.extend(batch_errors)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    errors.sort(key=lambda error: error['row'])
+    return {'created': created, 'errors': errors}
+
+
+def _staging_cipher():
+    key = salted_hmac(
+        'users.bulk.stage_import', 'fernet', algorithm='sha256'
+    ).digest()
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def _map_passwords(rows, func):
+    mapped = []
+    for row in rows:
+        if isinstance(row, dict) and isinstance(row.get('password'), str):
+            row = {**row, 'password': func(row['password'].encode()).decode()}
+        mapped.append(row)
+    return mapped
+
+
+def stage_import(rows):
+    """
+    Stores ``rows`` as a ``UserImport`` for ``import_staged`` and returns
+    it. Passwords are encrypted with a key derived from SECRET_KEY, so
+    the table, its backups and the WAL never hold them in plain text.
+    """
+
+    return UserImport.objects.create(
+        rows=_map_passwords(rows, _staging_cipher().encrypt)
+    )
+
+
+def import_staged(import_id, send_otp=True):
+    """
+    Runs the import staged as ``UserImport`` ``import_id`` and deletes it
+    once every batch is committed. A task redelivered after a crash runs
+    the import again, and the users created by the first run are
+    reported as existing. Returns None when the import already finished.
+    """
+
+    staged = UserImport.objects.filter(pk=import_id).first()
+    if staged is None:
+        return None
+    rows = _map_passwords(staged.rows, _staging_cipher().decrypt)
+    result = import_users(rows, send_otp=send_otp)
+    staged.delete()
+    return result
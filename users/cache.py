@@ -0,0 +1,198 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.base_user import BaseUserManager
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from backend.metrics import record_cache_event
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def is_process_local(cache):
+    """
+    True for caches every process keeps for itself, where a write in one
+    worker is never seen by the others.
+    """
+
+    return isinstance(cache, LocMemCache)
+
+
+# Columns kept in the cache: what token authentication and the user
+# serializers read. Anything else, the password hash included, is
+# deferred and loaded from the database on access.
+CACHED_FIELDS = (
+    'id', 'username', 'email', 'first_name', 'last_name', 'is_active',
+    'is_staff', 'is_superuser', 'verified', 'token_version',
+)
+INVALIDATED = 'invalidated'
+
+
+def normalize_email(email):
+    return BaseUserManager.normalize_email(email.strip())
+
+
+class UserCache:
+    """
+    Read-through cache of ``User`` rows keyed by id and by normalized email.
+
+    A small per-process LRU with a short TTL sits in front of the shared
+    cache. Saves and deletes clear both tiers in the writing process; other
+    processes drop their local copy after USER_CACHE_LOCAL_TTL seconds.
+
+    Only the CACHED_FIELDS are stored. Invalidation leaves a marker for
+    ``invalidation_timeout`` seconds and rows are written back with
+    ``add``, so a row loaded before a concurrent invalidation cannot
+    replace the marker.
+
+    On a process-local cache such as the default locmem one, whose
+    invalidations never reach the other workers, rows expire after
+    USER_CACHE_LOCAL_TTL seconds like the local tier does, so ``verified``
+    and ``is_active`` are never staler there than with a shared cache.
+    """
+
+    invalidation_timeout = 10
+
+    def __init__(self, alias, timeout, local_size, local_ttl):
+        self.alias = alias
+        self.timeout = timeout
+        self.local_size = local_size
+        self.local_ttl = local_ttl
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def shared_timeout(self, shared):
+        if is_process_local(shared):
+            return min(self.timeout, self.local_ttl)
+        return self.timeout
+
+    def _record(self, key):
+        with self._lock:
+            self._stats[key] += 1
+        record_cache_event(f'user_{key}')
+
+    def _local_get(self, key):
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return entry[0]
+
+    def _local_set(self, key, row):
+        with self._lock:
+            self._local[key] = (row, time.monotonic() + self.local_ttl)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def _build(self, row):
+        from .models import User
+
+        names = [
+            field.attname for field in User._meta.concrete_fields
+            if field.attname in row
+        ]
+        return User.from_db(
+            User.objects.db, names, [row[name] for name in names]
+        )
+
+    def _get(self, key, load, matches):
+        row = self._local_get(key)
+        if row is not None:
+            user = self._build(row)
+            if matches(user):
+                self._record('local_hits')
+                return user
+        shared = self.shared
+        cached = shared.get(key)
+        if cached is not None and cached != INVALIDATED:
+            user = self._build(cached)
+            if matches(user):
+                self._record('shared_hits')
+                self._local_set(key, cached)
+                return user
+        self._record('misses')
+        user = load()
+        row = {name: getattr(user, name) for name in CACHED_FIELDS}
+        timeout = self.shared_timeout(shared)
+        if cached is None:
+            stored = shared.add(key, row, timeout)
+        elif cached != INVALIDATED:
+            shared.set(key, row, timeout)
+            stored = True
+        else:
+            stored = False
+        if stored:
+            self._local_set(key, row)
+        return user
+
+    def get_by_id(self, pk):
+        from .models import User
+
+        return self._get(
+            f'user:id:{pk}',
+            lambda: User.objects.get(pk=pk),
+            lambda user: user.pk == pk,
+        )
+
+    def get_by_email(self, email):
+        from .models import User
+
+        if not isinstance(email, str):
+            raise User.DoesNotExist
+        email = normalize_email(email)
+        return self._get(
+            f'user:email:{email}',
+            lambda: User.objects.get(email=email),
+            lambda user: user.email == email,
+        )
+
+    def invalidate(self, user):
+        """
+        Drops the entries of ``user`` under its id, its current email and
+        the email it was loaded with, which differ after an email change.
+        """
+
+        keys = [f'user:id:{user.pk}']
+        for email in {user.email, getattr(user, 'loaded_email', None)}:
+            if email:
+                keys.append(f'user:email:{normalize_email(email)}')
+        self.shared.set_many(
+            dict.fromkeys(keys, INVALIDATED), self.invalidation_timeout
+        )
+        with self._lock:
+            for key in keys:
+                self._local.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['local_size'] = len(self._local)
+        return stats
+
+
+def get_user_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = UserCache(
+                    alias=settings.USER_CACHE_ALIAS,
+                    timeout=settings.USER_CACHE_TIMEOUT,
+                    local_size=settings.USER_CACHE_LOCAL_SIZE,
+                    local_ttl=settings.USER_CACHE_LOCAL_TTL,
+                )
+    return _cache
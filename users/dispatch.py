@@ -0,0 +1,65 @@
+from celery import group
+from django.conf import settings
+from django.db import transaction
+
+from backend.publisher import get_publisher
+from backend.tasks import send_bulk_otp_emails, send_otp_email_celery
+
+from .outbox import enqueue, enqueue_many
+
+
+def dispatch_otp_email(email, otp):
+    """
+    Schedules the OTP email according to OTP_EMAIL_DISPATCH.
+
+    ``outbox`` writes the task into the outbox table inside the current
+    transaction, ``publisher`` hands it to the in-process background
+    publisher and ``direct`` publishes it to the broker, both once the
+    transaction commits.
+    """
+
+    if settings.OTP_EMAIL_DISPATCH == 'outbox':
+        enqueue(send_otp_email_celery, email, otp)
+    elif settings.OTP_EMAIL_DISPATCH == 'publisher':
+        transaction.on_commit(
+            lambda: get_publisher().publish(
+                send_otp_email_celery, (email, otp)
+            )
+        )
+    else:
+        transaction.on_commit(
+            lambda: send_otp_email_celery.delay(email, otp)
+        )
+
+
+def dispatch_otp_emails(pairs):
+    """
+    Schedules OTP emails for a list of (email, otp) pairs, such as those
+    of a user import.
+
+    The pairs are sent by ``send_bulk_otp_emails`` in chunks of
+    OTP_EMAIL_BATCH_SIZE on the bulk queue, so a large import does not
+    delay the OTP emails of users who are logging in. Same modes as
+    ``dispatch_otp_email``, but the outbox gets one insert and ``direct``
+    publishes all chunks as one Celery group.
+    """
+
+    pairs = [list(pair) for pair in pairs]
+    size = settings.OTP_EMAIL_BATCH_SIZE
+    chunks = [(pairs[i:i + size],) for i in range(0, len(pairs), size)]
+    if not chunks:
+        return
+    if settings.OTP_EMAIL_DISPATCH == 'outbox':
+        enqueue_many(send_bulk_otp_emails, chunks)
+    elif settings.OTP_EMAIL_DISPATCH == 'publisher':
+        def publish():
+            publisher = get_publisher()
+            for args in chunks:
+                publisher.publish(send_bulk_otp_emails, args)
+        transaction.on_commit(publish)
+    else:
+        transaction.on_commit(
+            lambda: group(
+                send_bulk_otp_emails.s(*args) for args in chunks
+            ).apply_async()
+        )
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.contrib.auth.hashers import Argon2PasswordHasher
+
+
+class CalibratedArgon2PasswordHasher(Argon2PasswordHasher):
+    """
+    Argon2 with the cost parameters from ARGON2_TIME_COST,
+    ARGON2_MEMORY_COST and ARGON2_PARALLELISM.
+
+    The algorithm name stays ``argon2``, so existing hashes keep working
+    and are rehashed on the next successful login once the parameters
+    change. ``manage.py calibrate_argon2`` suggests values for the host.
+    """
+
+    @property
+    def time_cost(self):
+        return settings.ARGON2_TIME_COST
+
+    @property
+    def memory_cost(self):
+        return settings.ARGON2_MEMORY_COST
+
+    @property
+    def parallelism(self):
+        return settings.ARGON2_PARALLELISM
@@ -0,0 +1,84 @@
+import time
+
+from django.conf import settings
+from django.utils import timezone
+from django_celery_results.models import TaskResult
+
+from .models import OneTimePassword, OutboxMessage, RevokedToken, UserImport
+
+
+def expired_otps():
+    return OneTimePassword.objects.filter(otp_expiration__lte=timezone.now())
+
+
+def stale_task_results():
+    return TaskResult.objects.filter(
+        date_done__lt=timezone.now() - settings.TASK_RESULT_MAX_AGE
+    )
+
+
+def sent_outbox_messages():
+    return OutboxMessage.objects.filter(
+        sent_at__lt=timezone.now() - settings.OUTBOX_RETENTION
+    )
+
+
+def expired_revoked_tokens():
+    return RevokedToken.objects.filter(expires_at__lte=timezone.now())
+
+
+def abandoned_user_imports():
+    return UserImport.objects.filter(
+        created_at__lt=timezone.now() - settings.USER_IMPORT_MAX_AGE
+    )
+
+
+def purge_in_chunks(queryset, chunk_size=None, pause=None):
+    """
+    Deletes the rows of ``queryset`` in primary key ranges that each hold
+    up to ``chunk_size`` matching rows, with a ``pause`` between full
+    chunks, so no single statement holds locks for long. Each range
+    starts at the next matching row, so sparse matches do not cost
+    empty chunks. Returns the number of deleted rows.
+    """
+
+    chunk_size = chunk_size or settings.PURGE_CHUNK_SIZE
+    pause = settings.PURGE_CHUNK_PAUSE if pause is None else pause
+    deleted = 0
+    pending = queryset.order_by('pk')
+    while True:
+        pks = list(pending.values_list('pk', flat=True)[:chunk_size])
+        if not pks:
+            return deleted
+        count, _ = queryset.filter(pk__gte=pks[0], pk__lte=pks[-1]).delete()
+        deleted += count
+        if len(pks) < chunk_size:
+            return deleted
+        pending = pending.filter(pk__gt=pks[-1])
+        if pause:
+            time.sleep(pause)
+
+
+def purge_expired(dry_run=False, chunk_size=None, pause=None):
+    """
+    Purges expired OTPs, aged Celery task results, relayed outbox
+    messages, revoked tokens that have expired and staged user imports no
+    worker took.
+
+    Returns a dict with the number of deleted rows per kind, or the number
+    of rows that would be deleted when ``dry_run`` is set.
+    """
+
+    querysets = {
+        'otps': expired_otps(),
+        'task_results': stale_task_results(),
+        'outbox_messages': sent_outbox_messages(),
+        'revoked_tokens': expired_revoked_tokens(),
+        'user_imports': abandoned_user_imports(),
+    }
+    if dry_run:
+        return {name: qs.count() for name, qs in querysets.items()}
+    return {
+        name: purge_in_chunks(qs, chunk_size, pause)
+        for name, qs in querysets.items()
+    }
@@ -0,0 +1,173 @@
+"""
+Stand-ins for the benchmark command: a fake SMTP server, added query
+latency, a throwaway Celery task and broker, and attribute swaps. Django
+does not load modules starting with an underscore as commands.
+"""
+
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.test import override_settings
+
+from backend.celery import app
+
+
+@contextmanager
+def swap_attributes(target, **values):
+    """
+    Sets attributes of ``target`` for the duration of the block. Own
+    attributes are restored afterwards and the others deleted again, so
+    inherited class attributes and methods show through as before.
+    """
+
+    missing = object()
+    own = vars(target)
+    saved = {name: own.get(name, missing) for name in values}
+    for name, value in values.items():
+        setattr(target, name, value)
+    try:
+        yield target
+    finally:
+        for name, value in saved.items():
+            if value is missing:
+                delattr(target, name)
+            else:
+                setattr(target, name, value)
+
+
+@contextmanager
+def query_latency(seconds):
+    """
+    Adds ``seconds`` of latency to every query on every connection opened
+    meanwhile, to stand in for a database server across the network.
+    """
+
+    def delay(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def install(sender, connection, **kwargs):
+        connection.execute_wrappers.append(delay)
+
+    if not seconds:
+        yield
+        return
+    connection_created.connect(install)
+    current = connections.all()
+    for conn in current:
+        conn.execute_wrappers.append(delay)
+    try:
+        yield
+    finally:
+        connection_created.disconnect(install)
+        for conn in current:
+            conn.execute_wrappers.remove(delay)
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Accepts every message. Sleeps ``server.handshake`` seconds before the
+    greeting to stand in for the TCP and TLS setup of a real server.
+    """
+
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+
+    def handle(self):
+        time.sleep(self.server.handshake)
+        self.reply('220 fake ESMTP')
+        for raw in self.rfile:
+            command = raw.decode(errors='replace').strip().upper()
+            if command.startswith('DATA'):
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                for line in self.rfile:
+                    if line.rstrip(b'\r\n') == b'.':
+                        break
+                self.server.received += 1
+                self.reply('250 OK')
+            elif command.startswith('QUIT'):
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Local SMTP server on a free port, running while used as a context
+    manager.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handshake):
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.handshake = handshake
+        self.received = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    def email_settings(self):
+        return override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1', EMAIL_PORT=self.server_address[1],
+            EMAIL_USE_TLS=False, EMAIL_USE_SSL=False, EMAIL_HOST_USER='',
+            EMAIL_HOST_PASSWORD='',
+        )
+
+
+@contextmanager
+def bulk_work_task():
+    """
+    Registers ``benchmark.bulk_work``, which sleeps for the given number
+    of seconds, on the Celery app for the duration of the block only.
+    """
+
+    def bulk_work(seconds):
+        time.sleep(seconds)
+
+    task = app.task(
+        bulk_work, name='benchmark.bulk_work', ignore_result=True,
+        shared=False,
+    )
+    try:
+        yield task
+    finally:
+        app.tasks.unregister(task.name)
+
+
+@contextmanager
+def memory_broker():
+    """
+    Points the Celery app at the in-memory broker and turns eager mode
+    off, so tasks go through workers started in this process.
+    """
+
+    def update(values):
+        # The app reads its settings from the CELERY_ namespace.
+        app.conf.update({
+            f'CELERY_{name.upper()}': value for name, value in values.items()
+        })
+
+    overrides = {
+        'broker_url': 'memory://',
+        'broker_transport_options': {'polling_interval': 0.001},
+        'task_always_eager': False,
+    }
+    saved = {name: app.conf[name] for name in overrides}
+    update(overrides)
+    try:
+        yield
+    finally:
+        update(saved)
@@ -0,0 +1,416 @@
+import statistics
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+
+from api.renderers import FastJSONRenderer
+from api.serializers import UserBasicSerializer, user_basic_rows
+from backend import task_metrics
+from backend.celery import BULK_QUEUE, DEFAULT_QUEUE, OTP_QUEUE, app
+from backend.mail import send_otp_messages
+from backend.task_metrics import queue_wait
+from backend.task_results import RESULT_POLICY_ALL, RESULT_POLICY_FAILURES
+from backend.tasks import send_otp_email_celery
+from users.models import User
+from users.revocation import RevocationStore
+from users.tokens import issue_tokens
+
+from ._benchmark import (FakeSMTPServer, bulk_work_task, memory_broker,
+                         query_latency, swap_attributes)
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+SCENARIOS = {}
+
+
+def scenario(name, rollback=True, rows=(1000,)):
+    """
+    Registers a scenario. Unless ``rollback`` is False it runs in a
+    transaction that is rolled back; such scenarios clean up themselves.
+    It runs once per size in ``rows`` unless --rows is given.
+    """
+
+    def register(func):
+        func.rollback = rollback
+        func.rows = rows
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def measure(func, repeat):
+    """
+    Returns the median time in milliseconds of ``repeat`` calls.
+    """
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def create_users(count, prefix='bench'):
+    return User.objects.bulk_create(
+        (
+            User(username=f'{prefix}{i}', email=f'{prefix}{i}@example.com',
+                 first_name='First', last_name='Last', verified=True)
+            for i in range(count)
+        ),
+        batch_size=1000,
+    )
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+@scenario('user-serialization', rows=(1000, 10000, 100000))
+def user_serialization(options):
+    """
+    One page of the user list through UserBasicSerializer and the stock
+    renderer, and through the ``.values()`` rows and FastJSONRenderer.
+    """
+
+    create_users(options['rows'])
+    queryset = User.objects.order_by('id')[:options['rows']]
+
+    def serializer():
+        JSONRenderer().render(
+            UserBasicSerializer(
+                queryset.only(*UserBasicSerializer.Meta.fields), many=True
+            ).data
+        )
+
+    def values_rows():
+        FastJSONRenderer().render(user_basic_rows.many(
+            queryset.values(*user_basic_rows.columns)
+        ))
+
+    return [
+        ('serializer', measure(serializer, options['repeat']), ''),
+        ('values rows', measure(values_rows, options['repeat']), ''),
+    ]
+
+
+@scenario('otp-email-batching')
+def otp_email_batching(options):
+    """
+    ``rows`` OTP emails to a local fake SMTP server, over one connection
+    per message as before batching and over one connection per batch of
+    OTP_EMAIL_BATCH_SIZE as ``flush_otp_email_batch`` sends them.
+    """
+
+    items = [(f'bench{i}@example.com', '123456')
+             for i in range(options['rows'])]
+    size = settings.OTP_EMAIL_BATCH_SIZE
+    modes = [
+        ('per message', [[item] for item in items]),
+        (f'batches of {size}', [
+            items[start:start + size] for start in range(0, len(items), size)
+        ]),
+    ]
+    results = []
+    with FakeSMTPServer(options['smtp_handshake_ms'] / 1000) as server:
+        with server.email_settings():
+            for label, batches in modes:
+                server.received = 0
+                elapsed = measure(
+                    lambda: [send_otp_messages(batch) for batch in batches],
+                    1,
+                )
+                results.append((
+                    label, elapsed,
+                    f'{server.received} sent, {len(batches)} connections',
+                ))
+    return results
+
+
+@scenario('task-results')
+def task_results(options):
+    """
+    ``rows`` successful ``send_otp_email_celery`` runs through Celery's
+    tracer and the configured result backend, storing every result as
+    before and with the ``failures`` policy, which ignores successes.
+    Metric pushes are switched off.
+    """
+
+    task = send_otp_email_celery._get_current_object()
+    email_settings = override_settings(
+        EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+        OTP_EMAIL_BATCHING=False,
+    )
+    results = []
+    for policy, ignore_result in (
+        (RESULT_POLICY_ALL, False), (RESULT_POLICY_FAILURES, True),
+    ):
+        with email_settings, swap_attributes(
+            task_metrics, push_task_metrics=lambda *args: None
+        ), swap_attributes(
+            type(task), ignore_result=ignore_result, store_eager_result=True
+        ), CaptureQueriesContext(connection) as queries:
+            elapsed = measure(
+                lambda: [
+                    task.apply((f'bench{i}@example.com', '123456'))
+                    for i in range(options['rows'])
+                ],
+                1,
+            )
+        writes = sum(
+            query['sql'].startswith(('INSERT', 'UPDATE'))
+            for query in queries.captured_queries
+        )
+        per_1k = 1000 / options['rows']
+        results.append((
+            policy, elapsed,
+            f'{len(queries) * per_1k:.0f} queries and '
+            f'{writes * per_1k:.0f} writes per 1k tasks',
+        ))
+    return results
+
+
+def revocation_store(alias):
+    return RevocationStore(
+        alias=alias,
+        sync_interval=settings.REVOCATION_SYNC_INTERVAL,
+        capacity=settings.REVOCATION_BLOOM_CAPACITY,
+        error_rate=settings.REVOCATION_BLOOM_ERROR_RATE,
+        max_age=settings.REVOCATION_BLOOM_MAX_AGE,
+    )
+
+
+@scenario('revocation-check')
+def revocation_check(options):
+    """
+    ``rows`` checks of tokens that are not revoked, the one every
+    authenticated request makes, against ``rows`` revoked ids. Once with
+    the ids in the RevokedToken table, a lookup per request like a
+    database blacklist, and once with the Bloom-fronted Redis store on an
+    in-memory fakeredis server, skipped when fakeredis is not installed.
+    --db-latency-ms is added to each query.
+    """
+
+    stores = [('database', 'default')]
+    caches_setting = settings.CACHES
+    if fakeredis is not None:
+        stores.append(('bloom + redis', 'revocation-benchmark'))
+        caches_setting = {**caches_setting, 'revocation-benchmark': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': 'redis://localhost:6379/0',
+            'OPTIONS': {
+                'connection_class': fakeredis.FakeConnection,
+                'server': fakeredis.FakeServer(),
+            },
+        }}
+    exp = time.time() + 3600
+    jtis = [f'bench-{i}' for i in range(options['rows'])]
+    results = []
+    with override_settings(CACHES=caches_setting), query_latency(
+        options['db_latency_ms'] / 1000
+    ):
+        for label, alias in stores:
+            store = revocation_store(alias)
+            for jti in jtis:
+                store.revoke(f'revoked-{jti}', exp)
+            store.is_revoked('warm-up')
+            queries = []
+            with connection.execute_wrapper(
+                lambda execute, *args: queries.append(1) or execute(*args)
+            ):
+                elapsed = measure(
+                    lambda: [store.is_revoked(jti) for jti in jtis], 1
+                )
+            results.append((
+                label, elapsed,
+                f'{elapsed * 1000 / len(jtis):.1f} us and '
+                f'{len(queries) / len(jtis):.2f} queries per check',
+            ))
+    return results
+
+
+METRICS_MIDDLEWARE = 'backend.middleware.RequestMetricsMiddleware'
+
+
+@scenario('request-metrics')
+def request_metrics(options):
+    """
+    ``rows`` authenticated GET /api/users/<id>/ requests through the
+    Django test client, without and with RequestMetricsMiddleware. The
+    two clients take turns so drift affects both alike; the median
+    latency of one request is reported.
+    """
+
+    user = create_users(1)[0]
+    access, _ = issue_tokens(user)
+    url = f'/api/users/{user.pk}/'
+    without = [name for name in settings.MIDDLEWARE
+               if name != METRICS_MIDDLEWARE]
+    modes = []
+    for label, middleware in (
+        ('without middleware', without),
+        ('with middleware', [METRICS_MIDDLEWARE, *without]),
+    ):
+        client = Client(HTTP_AUTHORIZATION=f'Bearer {access}')
+        # The handler loads the middleware on its first request.
+        with override_settings(MIDDLEWARE=middleware):
+            client.get(url)
+        modes.append((label, client, []))
+    for _ in range(options['rows']):
+        for _, client, timings in modes:
+            started = time.perf_counter()
+            client.get(url)
+            timings.append((time.perf_counter() - started) * 1000)
+    results = [
+        (label, statistics.median(timings), '')
+        for label, _, timings in modes
+    ]
+    overhead = (results[1][1] - results[0][1]) * 1000
+    results[1] = (*results[1][:2], f'{overhead:.1f} us per request')
+    return results
+
+
+@scenario('otp-queue-latency', rollback=False)
+def otp_queue_latency(options):
+    """
+    Queue wait of OTP emails published while a backlog of ``rows`` bulk
+    tasks of --bulk-task-ms each drains. Once with every task on the
+    default queue served by --workers workers, as before routing, and
+    once with the bulk tasks on the bulk queue and the OTP emails routed
+    to the otp queue, each queue served by half the workers. Workers run
+    in this process on the in-memory broker, one task at a time with a
+    prefetch of one like a prefork child. The wait is read from the
+    ``celery_task_queue_wait_seconds`` observations.
+    """
+
+    from celery.contrib.testing.worker import start_worker
+
+    task = send_otp_email_celery._get_current_object()
+    half = max(1, options['workers'] // 2)
+    modes = [
+        ('one queue', DEFAULT_QUEUE, DEFAULT_QUEUE,
+         [DEFAULT_QUEUE] * (2 * half)),
+        ('dedicated queues', BULK_QUEUE, None,
+         [BULK_QUEUE] * half + [OTP_QUEUE] * half),
+    ]
+    otps = 20
+    # Spread the OTP emails over the time the backlog takes to drain.
+    interval = options['rows'] * options['bulk_task_ms'] / 1000 / (
+        2 * half * otps
+    )
+    results = []
+    for label, bulk_queue, otp_queue, worker_queues in modes:
+        waits = []
+
+        def observe(value, name):
+            if name == task.name:
+                waits.append(value * 1000)
+
+        with memory_broker(), bulk_work_task() as bulk_work, override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+            OTP_EMAIL_BATCHING=False,
+        ), swap_attributes(
+            task_metrics, push_task_metrics=lambda *args: None
+        ), swap_attributes(queue_wait, observe=observe):
+            with ExitStack() as workers:
+                for queue in worker_queues:
+                    workers.enter_context(start_worker(
+                        app, pool='solo', queues=[queue],
+                        prefetch_multiplier=1, perform_ping_check=False,
+                    ))
+                started = time.perf_counter()
+                for _ in range(options['rows']):
+                    bulk_work.apply_async(
+                        (options['bulk_task_ms'] / 1000,), queue=bulk_queue
+                    )
+                for i in range(otps):
+                    task.apply_async(
+                        (f'bench{i}@example.com', '123456'), queue=otp_queue
+                    )
+                    time.sleep(interval)
+                while len(waits) < otps:
+                    time.sleep(0.001)
+                elapsed = (time.perf_counter() - started) * 1000
+            with app.connection_for_write() as conn:
+                for queue in set(worker_queues):
+                    conn.default_channel.queue_purge(queue)
+        results.append((
+            f'{label}: OTP wait p50', percentile(waits, 0.5),
+            f'max {max(waits):.1f} ms, {elapsed:.0f} ms to publish and '
+            f'start every OTP email',
+        ))
+    return results
+
+
+class Command(BaseCommand):
+    help = (
+        'Times the old and new implementation of a hot path and prints the '
+        'median of each. Test data is rolled back or deleted afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'scenarios', nargs='*',
+            help=f'Scenarios to run, all by default: {", ".join(SCENARIOS)}.',
+        )
+        parser.add_argument(
+            '--rows', type=int, nargs='+',
+            help='Sizes of the generated data, each run in turn. Defaults '
+                 'to 1000, and to 1000 10000 100000 for user-serialization.',
+        )
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument(
+            '--smtp-handshake-ms', type=float, default=20,
+            help='Connection setup delay of the fake SMTP server.',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='Celery workers of the otp-queue-latency scenario.',
+        )
+        parser.add_argument(
+            '--bulk-task-ms', type=float, default=10,
+            help='Run time of each bulk task of the otp-queue-latency '
+                 'scenario.',
+        )
+        parser.add_argument(
+            '--db-latency-ms', type=float, default=1,
+            help='Delay added to every query by the revocation-check '
+                 'scenario.',
+        )
+
+    def handle(self, *args, **options):
+        names = options['scenarios'] or sorted(SCENARIOS)
+        unknown = set(names) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(
+                f'Unknown scenarios: {", ".join(sorted(unknown))}'
+            )
+        for name in names:
+            func = SCENARIOS[name]
+            for rows in options['rows'] or func.rows:
+                self.run_scenario(name, func, {**options, 'rows': rows})
+
+    def run_scenario(self, name, func, options):
+        if func.rollback:
+            with transaction.atomic():
+                results = func(options)
+                transaction.set_rollback(True)
+        else:
+            results = func(options)
+        baseline = results[0][1]
+        for label, elapsed, note in results:
+            line = (
+                f'{name} [{options["rows"]} rows]: {label}: {elapsed:.2f} ms '
+                f'({baseline / elapsed:.1f}x)'
+            )
+            self.stdout.write(f'{line} {note}' if note else line)
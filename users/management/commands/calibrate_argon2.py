@@ -0,0 +1,91 @@
+import os
+import statistics
+import time
+
+from argon2.low_level import Type, hash_secret
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+MIN_MEMORY_COST = 19456
+
+
+def measure(time_cost, memory_cost, parallelism, samples):
+    """
+    Returns the median time in milliseconds to hash one password.
+    """
+
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        hash_secret(
+            b'calibration password', os.urandom(16),
+            time_cost=time_cost, memory_cost=memory_cost,
+            parallelism=parallelism, hash_len=32, type=Type.ID,
+        )
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks Argon2 on this host and prints the strongest time and '
+        'memory cost that hash a password within the target latency.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--target-ms', type=float, default=250,
+            help='Hashing latency to aim for, in milliseconds.',
+        )
+        parser.add_argument(
+            '--max-memory', type=int, default=262144,
+            help='Largest memory cost to try, in KiB.',
+        )
+        parser.add_argument(
+            '--parallelism', type=int, default=settings.ARGON2_PARALLELISM,
+        )
+        parser.add_argument(
+            '--samples', type=int, default=5,
+            help='Hashes per measurement, the median is used.',
+        )
+
+    def handle(self, *args, **options):
+        target = options['target_ms']
+        parallelism = options['parallelism']
+        samples = options['samples']
+        memory_cost = options['max_memory']
+        current = measure(
+            settings.ARGON2_TIME_COST, settings.ARGON2_MEMORY_COST,
+            settings.ARGON2_PARALLELISM, samples,
+        )
+        self.stdout.write(
+            f'Current: time_cost={settings.ARGON2_TIME_COST} '
+            f'memory_cost={settings.ARGON2_MEMORY_COST} '
+            f'parallelism={settings.ARGON2_PARALLELISM}: {current:.1f} ms'
+        )
+        while True:
+            elapsed = measure(1, memory_cost, parallelism, samples)
+            if elapsed <= target:
+                break
+            memory_cost //= 2
+            if memory_cost < MIN_MEMORY_COST:
+                raise CommandError(
+                    f'Even the minimum memory cost takes {elapsed:.1f} ms, '
+                    'raise --target-ms.'
+                )
+        time_cost = 1
+        while True:
+            next_elapsed = measure(
+                time_cost + 1, memory_cost, parallelism, samples
+            )
+            if next_elapsed > target:
+                break
+            time_cost += 1
+            elapsed = next_elapsed
+        self.stdout.write(
+            f'Calibrated: {elapsed:.1f} ms, '
+            f'{memory_cost // 1024} MiB per concurrent hash'
+        )
+        self.stdout.write(f'ARGON2_TIME_COST={time_cost}')
+        self.stdout.write(f'ARGON2_MEMORY_COST={memory_cost}')
+        self.stdout.write(f'ARGON2_PARALLELISM={parallelism}')
@@ -0,0 +1,51 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from users.export import EXPORT_FORMATS, parse_iso_datetime, stream_export
+
+
+class Command(BaseCommand):
+    help = 'Streams all users as NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices=EXPORT_FORMATS, default='ndjson',
+            dest='output',
+        )
+        parser.add_argument(
+            '--verified-only', action='store_true',
+            help='Only export verified users.',
+        )
+        parser.add_argument(
+            '--joined-after',
+            help='Only export users who joined at or after this ISO date.',
+        )
+        parser.add_argument(
+            '--gzip', action='store_true', help='Gzip the output.',
+        )
+        parser.add_argument(
+            '--output', '-o', dest='path',
+            help='File to write to (default: stdout).',
+        )
+
+    def handle(self, *args, **options):
+        joined_after = options['joined_after']
+        if joined_after:
+            joined_after = parse_iso_datetime(joined_after)
+            if joined_after is None:
+                raise CommandError('--joined-after must be an ISO date.')
+        chunks = stream_export(
+            output=options['output'],
+            compress=options['gzip'],
+            verified=True if options['verified_only'] else None,
+            joined_after=joined_after,
+        )
+        if options['path']:
+            with open(options['path'], 'wb') as target:
+                for chunk in chunks:
+                    target.write(chunk)
+        else:
+            for chunk in chunks:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from backend.schema import SPEC_EXTENSIONS, render_spec, spec_path, write_spec
+from backend.urls import schema_view
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes the OpenAPI schema for the current code version to '
+        'SCHEMA_CACHE_DIR, so /swagger/ and /redoc/ never generate it on a '
+        'request.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--api-version', default='',
+            help='API version to generate the schema for.',
+        )
+
+    def handle(self, *args, **options):
+        version = options['api_version']
+        for codec_class in SPEC_EXTENSIONS:
+            path = spec_path(codec_class, version)
+            write_spec(render_spec(schema_view, codec_class, version), path)
+            self.stdout.write(f'Wrote {path}')
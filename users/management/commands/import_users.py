@@ -0,0 +1,74 @@
+import csv
+import json
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from users.bulk import import_users
+from users.export import EXPORT_FORMATS, unescape_formula
+
+
+def read_rows(source, output):
+    if output == 'csv':
+        return [
+            {key: unescape_formula(value) for key, value in row.items()}
+            for row in csv.DictReader(source)
+        ]
+    rows = []
+    for number, line in enumerate(source, 1):
+        if not line.strip():
+            continue
+        try:
+            rows.append(json.loads(line))
+        except ValueError:
+            raise CommandError(f'Line {number} is not valid JSON.')
+    return rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Creates users in bulk from an NDJSON or CSV file. The quote that '
+        'the CSV export puts before formula characters is removed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', help='File to read (- for stdin).',
+        )
+        parser.add_argument(
+            '--format', choices=EXPORT_FORMATS, default='ndjson',
+            dest='output',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.USER_IMPORT_BATCH_SIZE,
+            help='Users to insert per transaction.',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=settings.USER_IMPORT_HASH_WORKERS,
+            help='Processes used to hash passwords.',
+        )
+        parser.add_argument(
+            '--no-otp', action='store_false', dest='send_otp',
+            help='Do not issue and email one time passwords.',
+        )
+
+    def handle(self, *args, **options):
+        if options['path'] == '-':
+            rows = read_rows(sys.stdin, options['output'])
+        else:
+            with open(options['path'], newline='') as source:
+                rows = read_rows(source, options['output'])
+        result = import_users(
+            rows,
+            send_otp=options['send_otp'],
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+        )
+        for error in result['errors']:
+            self.stderr.write(
+                f"Row {error['row'] + 1}: {json.dumps(error['errors'])}"
+            )
+        self.stdout.write(
+            f"Created {result['created']} of {len(rows)} users"
+        )
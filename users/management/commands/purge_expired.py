@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from users.maintenance import purge_expired
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes expired OTPs, aged Celery task results, relayed outbox '
+        'messages, expired revoked tokens and abandoned staged user '
+        'imports in chunks.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Only count the rows that would be deleted.',
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=None,
+            help='Rows per delete statement (default: PURGE_CHUNK_SIZE).',
+        )
+        parser.add_argument(
+            '--pause', type=float, default=None,
+            help='Seconds to sleep between full chunks '
+                 '(default: PURGE_CHUNK_PAUSE).',
+        )
+
+    def handle(self, *args, **options):
+        result = purge_expired(
+            dry_run=options['dry_run'],
+            chunk_size=options['chunk_size'],
+            pause=options['pause'],
+        )
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        for name, count in result.items():
+            self.stdout.write(f'{verb} {count} {name.replace("_", " ")}')
@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from users.outbox import relay_outbox
+
+
+class Command(BaseCommand):
+    help = 'Publishes pending outbox messages to the broker.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.OUTBOX_BATCH_SIZE,
+            help='Messages to publish per batch.',
+        )
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep relaying until interrupted.',
+        )
+        parser.add_argument(
+            '--interval', type=float,
+            default=settings.OUTBOX_RELAY_INTERVAL,
+            help='Seconds to wait when the outbox is empty.',
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            published = relay_outbox(options['batch_size'])
+            if published:
+                self.stdout.write(f'Published {published} messages')
+            if not options['loop']:
+                break
+            if published < options['batch_size']:
+                time.sleep(options['interval'])
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.11 on 2026-10-17 14:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_auto_20240329_2155'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='onetimepassword',
+            name='otp_expiration',
+            field=models.DateTimeField(db_index=True, verbose_name='Expiration datetime'),
+        ),
+    ]
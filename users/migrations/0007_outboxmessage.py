@@ -0,0 +1,26 @@
+# Generated by Django 4.2.11 on 2026-10-17 14:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_alter_onetimepassword_otp_expiration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=255, verbose_name='Task name')),
+                ('args', models.JSONField(default=list, verbose_name='Task arguments')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Creation datetime')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Publish datetime')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('sent_at__isnull', True)), fields=['id'], name='outbox_pending_idx')],
+            },
+        ),
+    ]
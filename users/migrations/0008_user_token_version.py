@@ -0,0 +1,18 @@
+# Generated by Django 4.2.11 on 2026-10-17 14:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='token_version',
+            field=models.PositiveIntegerField(default=0, verbose_name='Version of issued tokens'),
+        ),
+    ]
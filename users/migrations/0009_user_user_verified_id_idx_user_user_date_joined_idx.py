@@ -0,0 +1,21 @@
+# Generated by Django 4.2.11 on 2026-10-17 14:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_user_token_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['verified', 'id'], name='user_verified_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['date_joined'], name='user_date_joined_idx'),
+        ),
+    ]
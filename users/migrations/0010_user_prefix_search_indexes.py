@@ -0,0 +1,42 @@
+from django.db import migrations
+
+PREFIX_INDEXES = {
+    'user_email_prefix_idx': 'email',
+    'user_username_prefix_idx': 'username',
+}
+
+
+def create_prefix_indexes(apps, schema_editor):
+    """
+    Indexes UPPER(column) with text_pattern_ops, which serves the admin's
+    case-insensitive prefix search. Built concurrently so the table stays
+    writable; PostgreSQL only.
+    """
+
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, column in PREFIX_INDEXES.items():
+        schema_editor.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{name}" '
+            f'ON "users_user" (UPPER("{column}"::text) text_pattern_ops)'
+        )
+
+
+def drop_prefix_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name in PREFIX_INDEXES:
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('users', '0009_user_user_verified_id_idx_user_user_date_joined_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_prefix_indexes, drop_prefix_indexes),
+    ]
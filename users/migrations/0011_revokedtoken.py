@@ -0,0 +1,21 @@
+# Generated by Django 4.2.11 on 2026-10-17 15:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_user_prefix_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RevokedToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('jti', models.CharField(max_length=255, unique=True, verbose_name='Token id')),
+                ('expires_at', models.DateTimeField(db_index=True, verbose_name='Token expiration')),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.11 on 2026-10-17 18:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0011_revokedtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserImport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rows', models.JSONField(verbose_name='Rows')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Creation datetime')),
+            ],
+        ),
+    ]
@@ -1,13 +1,22 @@
-import random
-
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, make_password
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import RegexValidator
 from django.db import models
+from django.db.models import F
 from django.utils import timezone
 
+from .attempts import get_attempt_store
+from .cache import get_user_cache
+from .otp import generate_code, get_otp_store
+from .tokens import set_token_version
 from .validators import special_names_validator
 
 
+TOKEN_CLAIM_FIELDS = ('is_active', 'is_staff', 'is_superuser', 'verified')
+LOADED_FIELDS = ('email',) + TOKEN_CLAIM_FIELDS
+
+
 class User(AbstractUser):
     username = models.CharField(
         max_length=30,
@@ -34,9 +43,19 @@ class User(AbstractUser):
     otp_tries = models.IntegerField(
         default=0, verbose_name="Attempts to verificate or log in"
     )
+    token_version = models.PositiveIntegerField(
+        default=0, verbose_name="Version of issued tokens"
+    )
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
 
+    class Meta(AbstractUser.Meta):
+        swappable = 'AUTH_USER_MODEL'
+        indexes = [
+            models.Index(fields=['verified', 'id'], name='user_verified_id_idx'),
+            models.Index(fields=['date_joined'], name='user_date_joined_idx'),
+        ]
+
     extra_kwargs = {
             'password': {'write_only': True},
         }
@@ -44,22 +63,122 @@ class User(AbstractUser):
     def __str__(self):
         return self.username
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._remember_loaded()
+        return instance
+
+    def _remember_loaded(self):
+        self._loaded = {
+            name: self.__dict__[name] for name in LOADED_FIELDS
+            if name in self.__dict__
+        }
+
+    @property
+    def loaded_email(self):
+        """
+        Email as last loaded from or saved to the database.
+        """
+        return getattr(self, '_loaded', {}).get('email')
+
+    def claims_changed(self):
+        loaded = getattr(self, '_loaded', {})
+        return any(
+            name in loaded and loaded[name] != getattr(self, name)
+            for name in TOKEN_CLAIM_FIELDS
+        )
+
+    def save(self, *args, **kwargs):
+        """
+        Saves the user and invalidates issued tokens when a field the
+        tokens carry or depend on (activity, staff and superuser status,
+        verification) changed.
+        """
+        if self.pk is not None and self.claims_changed():
+            self.token_version += 1
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'token_version'}
+        super().save(*args, **kwargs)
+        self._remember_loaded()
+
+    def set_password(self, raw_password):
+        """
+        Sets the password and invalidates tokens issued for the old one.
+        """
+        super().set_password(raw_password)
+        if self.pk is not None:
+            self.token_version += 1
+
+    def check_password(self, raw_password):
+        """
+        Checks the password against the loaded hash. An outdated hash is
+        upgraded without bumping ``token_version``, so sessions survive
+        the rehash.
+        """
+        return check_password(
+            raw_password, self.password, self.upgrade_password
+        )
+
+    def upgrade_password(self, raw_password):
+        """
+        Rehashes the password with the current hasher parameters.
+        """
+        self.password = make_password(raw_password)
+        User.objects.filter(pk=self.pk).update(password=self.password)
+        get_user_cache().invalidate(self)
+
     def generate_otp(self,):
         """
         Generates a 6-digit one-time password (OTP) and stores it for the user.
         """
-        otp_instance, created = OneTimePassword.objects.update_or_create(
-            user=self,
-            defaults={
-                'otp': ''.join([str(random.randint(0, 9)) for _ in range(6)]),
-                'otp_expiration': (
-                    timezone.now() + timezone.timedelta(minutes=15)
-                )
-            }
+        otp = generate_code()
+        get_otp_store().issue(self, otp)
+        get_attempt_store().reset(self)
+        return otp
+
+    def reserve_otp_try(self):
+        """
+        Atomically counts one OTP attempt.
+
+        Returns False without writing anything once the user has used up
+        OTP_MAX_TRIES attempts.
+        """
+        reserved = User.objects.filter(
+            pk=self.pk, otp_tries__lte=settings.OTP_MAX_TRIES
+        ).update(otp_tries=F('otp_tries') + 1)
+        if reserved:
+            self.otp_tries += 1
+        return bool(reserved)
+
+    def reset_otp_tries(self):
+        User.objects.filter(pk=self.pk, otp_tries__gt=0).update(otp_tries=0)
+        self.otp_tries = 0
+
+    def revoke_tokens(self):
+        """
+        Invalidates every token issued to the user by bumping
+        ``token_version``.
+        """
+        User.objects.filter(pk=self.pk).update(
+            token_version=F('token_version') + 1
         )
+        self.refresh_from_db(fields=['token_version'])
+        set_token_version(self.pk, self.token_version)
+        get_user_cache().invalidate(self)
+
+    def mark_verified(self):
+        """
+        Marks the email as verified and clears ``otp_tries`` in the same
+        UPDATE.
+        """
+        User.objects.filter(pk=self.pk).update(verified=True, otp_tries=0)
+        self.verified = True
         self.otp_tries = 0
-        self.save()
-        return otp_instance.otp
+        if hasattr(self, '_loaded'):
+            self._loaded['verified'] = True
+        get_user_cache().invalidate(self)
 
 
 class OneTimePassword(models.Model):
@@ -67,7 +186,59 @@ class OneTimePassword(models.Model):
         User, on_delete=models.CASCADE, related_name='otp'
     )
     otp = models.CharField(max_length=6, verbose_name="One time password")
-    otp_expiration = models.DateTimeField(verbose_name="Expiration datetime")
+    otp_expiration = models.DateTimeField(
+        verbose_name="Expiration datetime", db_index=True
+    )
 
     def is_otp_valid(self):
         return timezone.now() < self.otp_expiration
+
+
+class OutboxMessage(models.Model):
+    """
+    Celery task call written in the same transaction as the data it refers
+    to and published to the broker later by the outbox relay.
+    """
+
+    task = models.CharField(max_length=255, verbose_name="Task name")
+    args = models.JSONField(default=list, verbose_name="Task arguments")
+    created_at = models.DateTimeField(
+        auto_now_add=True, verbose_name="Creation datetime"
+    )
+    sent_at = models.DateTimeField(
+        null=True, blank=True, verbose_name="Publish datetime"
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['id'], condition=models.Q(sent_at__isnull=True),
+                name='outbox_pending_idx',
+            ),
+        ]
+
+
+class RevokedToken(models.Model):
+    """
+    Id (``jti``) of a token revoked on logout, kept until the token
+    expires. Backs the revocation store when no Redis cache is set up.
+    """
+
+    jti = models.CharField(max_length=255, unique=True, verbose_name="Token id")
+    expires_at = models.DateTimeField(
+        verbose_name="Token expiration", db_index=True
+    )
+
+
+class UserImport(models.Model):
+    """
+    Rows posted to the bulk import endpoint, kept until a worker has
+    imported them. The task only receives the id, so passwords never pass
+    through the broker or the result backend, and the passwords in
+    ``rows`` are encrypted, see ``users.bulk.stage_import``.
+    """
+
+    rows = models.JSONField(verbose_name="Rows")
+    created_at = models.DateTimeField(
+        auto_now_add=True, verbose_name="Creation datetime", db_index=True
+    )
@@ -0,0 +1,275 @@
+import random
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+OTP_VALID = 'valid'
+OTP_INVALID = 'invalid'
+OTP_EXPIRED = 'expired'
+
+# Seconds a coalescing window claimed by ``issue_otp`` survives when the
+# transaction that issues its code never commits.
+CLAIM_TIMEOUT = 5
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class BaseOTPStore:
+    """
+    Storage backend for one time passwords.
+
+    ``issue`` replaces any previous code of the user, ``consume`` checks a
+    code and deletes it on success in a single step.
+    """
+
+    def issue(self, user, otp):
+        raise NotImplementedError
+
+    def consume(self, user, otp):
+        raise NotImplementedError
+
+    def peek(self, user, otp):
+        """
+        Checks a code like ``consume`` without using it up.
+        """
+
+        raise NotImplementedError
+
+    def issue_many(self, pairs):
+        """
+        Issues codes for a list of (user, otp) pairs.
+        """
+
+        for user, otp in pairs:
+            self.issue(user, otp)
+
+
+class DatabaseOTPStore(BaseOTPStore):
+    """
+    Keeps codes in the ``OneTimePassword`` table.
+    """
+
+    def issue(self, user, otp):
+        self.issue_many([(user, otp)])
+
+    def issue_many(self, pairs):
+        from .models import OneTimePassword
+
+        expiration = timezone.now() + settings.OTP_LIFETIME
+        OneTimePassword.objects.bulk_create(
+            [
+                OneTimePassword(user=user, otp=otp, otp_expiration=expiration)
+                for user, otp in pairs
+            ],
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['otp', 'otp_expiration'],
+        )
+
+    def consume(self, user, otp):
+        from .models import OneTimePassword
+
+        codes = OneTimePassword.objects.filter(user=user, otp=otp)
+        deleted, _ = codes.filter(otp_expiration__gt=timezone.now()).delete()
+        if deleted:
+            return OTP_VALID
+        if codes.exists():
+            return OTP_EXPIRED
+        return OTP_INVALID
+
+    def peek(self, user, otp):
+        from .models import OneTimePassword
+
+        expiration = (
+            OneTimePassword.objects.filter(user=user, otp=otp)
+            .values_list('otp_expiration', flat=True).first()
+        )
+        return self._status(expiration)
+
+    def _status(self, expiration):
+        if expiration is None:
+            return OTP_INVALID
+        if expiration <= timezone.now():
+            return OTP_EXPIRED
+        return OTP_VALID
+
+
+class CacheOTPStore(BaseOTPStore):
+    """
+    Keeps codes in a Django cache with the OTP lifetime as key TTL.
+
+    On a Redis cache the compare-and-delete runs as one Lua script, so a
+    code can be consumed only once. Other caches fall back to a
+    process-local lock, which is enough for locmem.
+    """
+
+    consume_script = (
+        "if redis.call('get', KEYS[1]) == ARGV[1] then "
+        "return redis.call('del', KEYS[1]) end return 0"
+    )
+
+    def __init__(self, alias=None):
+        self.alias = alias or settings.OTP_CACHE_ALIAS
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, user):
+        return f'otp:{user.pk}'
+
+    def issue(self, user, otp):
+        self.cache.set(
+            self.key(user), otp, settings.OTP_LIFETIME.total_seconds()
+        )
+
+    def issue_many(self, pairs):
+        self.cache.set_many(
+            {self.key(user): otp for user, otp in pairs},
+            settings.OTP_LIFETIME.total_seconds(),
+        )
+
+    def consume(self, user, otp):
+        key = self.key(user)
+        if isinstance(self.cache, RedisCache):
+            redis_key = self.cache.make_and_validate_key(key)
+            client = self.cache._cache.get_client(redis_key, write=True)
+            value = self.cache._cache._serializer.dumps(otp)
+            deleted = client.eval(self.consume_script, 1, redis_key, value)
+        else:
+            with self._lock:
+                deleted = self.cache.get(key) == otp
+                if deleted:
+                    self.cache.delete(key)
+        return OTP_VALID if deleted else OTP_INVALID
+
+    def peek(self, user, otp):
+        stored = self.cache.get(self.key(user))
+        return OTP_VALID if stored == otp else OTP_INVALID
+
+
+def get_otp_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = import_string(settings.OTP_STORE_BACKEND)()
+    return _store
+
+
+def generate_code():
+    """
+    Returns a new 6-digit one-time password.
+    """
+
+    return ''.join([str(random.randint(0, 9)) for _ in range(6)])
+
+
+def _issued_keys(user):
+    key = f'otp-issued:{user.pk}'
+    return key, f'{key}:resent'
+
+
+def issue_otp(user):
+    """
+    Generates a new code for ``user`` unless one was issued within
+    OTP_COALESCE_WINDOW seconds.
+
+    Returns the code to email, or None when the request was coalesced.
+    A coalesced request costs one cache lookup and no database writes;
+    with OTP_COALESCE_RESEND the previous code is returned once more so
+    it can be resent.
+
+    The window is claimed for CLAIM_TIMEOUT seconds and only opened for
+    its full length once the transaction commits, so a failed or rolled
+    back issue does not block new codes.
+    """
+
+    window = settings.OTP_COALESCE_WINDOW
+    if not window:
+        return user.generate_otp()
+    cache = caches[settings.OTP_CACHE_ALIAS]
+    issued_key, resent_key = _issued_keys(user)
+    if cache.add(issued_key, '', min(window, CLAIM_TIMEOUT)):
+        try:
+            otp = user.generate_otp()
+        except Exception:
+            cache.delete(issued_key)
+            raise
+
+        def open_window():
+            cache.set(issued_key, otp, window)
+            cache.delete(resent_key)
+
+        transaction.on_commit(open_window)
+        return otp
+    if not settings.OTP_COALESCE_RESEND:
+        return None
+    otp = cache.get(issued_key)
+    if otp and cache.add(resent_key, True, window):
+        return otp
+    return None
+
+
+def issue_otps(users):
+    """
+    Issues codes for freshly created ``users`` with one store write.
+
+    Opens the coalescing window of every user once the transaction
+    commits, like ``issue_otp`` does, and returns the codes in the order
+    of ``users``.
+    """
+
+    codes = [generate_code() for _ in users]
+    get_otp_store().issue_many(list(zip(users, codes)))
+    window = settings.OTP_COALESCE_WINDOW
+    if window:
+        transaction.on_commit(
+            lambda: caches[settings.OTP_CACHE_ALIAS].set_many(
+                {
+                    _issued_keys(user)[0]: otp
+                    for user, otp in zip(users, codes)
+                },
+                window,
+            )
+        )
+    return codes
+
+
+def consume_otp(user, otp):
+    """
+    Consumes ``otp`` through the configured store and ends the coalescing
+    window once the code has been used.
+    """
+
+    result = get_otp_store().consume(user, otp)
+    if result == OTP_VALID and settings.OTP_COALESCE_WINDOW:
+        caches[settings.OTP_CACHE_ALIAS].delete_many(_issued_keys(user))
+    return result
+
+
+def redeem_otp(user, otp, verify=False):
+    """
+    Consumes ``otp`` and, when it is valid, resets the attempt counter and
+    with ``verify`` marks the user verified, in the same transaction.
+    Returns the OTP status.
+    """
+
+    from .attempts import get_attempt_store
+
+    attempts = get_attempt_store()
+    with transaction.atomic():
+        result = consume_otp(user, otp)
+        if result == OTP_VALID:
+            if verify:
+                user.mark_verified()
+            if not (verify and attempts.in_user_row):
+                attempts.reset(user)
+    return result
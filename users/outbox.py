@@ -0,0 +1,68 @@
+import logging
+
+from celery import current_app
+from django.db import transaction
+from django.utils import timezone
+
+from .models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(task, *args):
+    """
+    Records a call of ``task`` in the outbox. Must run inside the
+    transaction that writes the data the task depends on.
+    """
+
+    return OutboxMessage.objects.create(task=task.name, args=list(args))
+
+
+def enqueue_many(task, calls):
+    """
+    Records one call of ``task`` per argument tuple in ``calls`` with a
+    single insert.
+    """
+
+    return OutboxMessage.objects.bulk_create(
+        [OutboxMessage(task=task.name, args=list(args)) for args in calls]
+    )
+
+
+def relay_outbox(batch_size):
+    """
+    Publishes up to ``batch_size`` pending outbox messages over one broker
+    connection and marks them sent. Returns the number of published
+    messages.
+
+    Rows are locked with SKIP LOCKED, so several relays can run side by
+    side. Delivery is at least once: a crash between publish and commit
+    publishes the batch again.
+    """
+
+    with transaction.atomic():
+        messages = list(
+            OutboxMessage.objects
+            .filter(sent_at__isnull=True)
+            .order_by('id')
+            .select_for_update(skip_locked=True)[:batch_size]
+        )
+        if not messages:
+            return 0
+        published = []
+        try:
+            with current_app.producer_or_acquire() as producer:
+                for message in messages:
+                    current_app.send_task(
+                        message.task, args=message.args, producer=producer
+                    )
+                    published.append(message.pk)
+        except Exception:
+            logger.exception(
+                'Outbox relay stopped after %d of %d messages',
+                len(published), len(messages)
+            )
+        OutboxMessage.objects.filter(pk__in=published).update(
+            sent_at=timezone.now()
+        )
+    return len(published)
@@ -0,0 +1,216 @@
+import hashlib
+import math
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from django.utils import timezone
+from rest_framework_simplejwt.settings import api_settings
+
+REVOKE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[3],
+                           'LIMIT', 0, 100)
+if #expired > 0 then
+    redis.call('ZREM', KEYS[1], unpack(expired))
+    redis.call('ZREM', KEYS[2], unpack(expired))
+end
+local seq = redis.call('INCR', KEYS[3])
+redis.call('ZADD', KEYS[1], seq, ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return seq
+"""
+
+_store = None
+_store_lock = threading.Lock()
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter of strings. Sized for ``capacity`` items at
+    ``error_rate`` false positives, it never gives false negatives.
+    """
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(1, capacity)
+        self.size = max(64, math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        ))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+class RevocationStore:
+    """
+    Set of revoked token ids (``jti``), each kept until the token would
+    have expired anyway.
+
+    On Redis the set lives in two sorted sets, one scored by a revocation
+    sequence number and one by expiry. Every process keeps a Bloom filter
+    of the revoked ids in front of it and pulls new revocations at most
+    every REVOCATION_SYNC_INTERVAL seconds. A token that is not revoked,
+    the common case, is answered from memory; only Bloom hits ask Redis.
+    The filter is rebuilt from the live entries every
+    REVOCATION_BLOOM_MAX_AGE seconds to drop expired ids.
+
+    Without Redis the revoked ids are kept in the ``RevokedToken`` table
+    and the filter follows its primary keys the same way, so the table is
+    only read once per sync and on Bloom hits. Revocations are inserted
+    in autocommit, so keys become visible in order.
+    """
+
+    def __init__(self, alias, sync_interval, capacity, error_rate, max_age):
+        self.alias = alias
+        self.sync_interval = sync_interval
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._bloom = BloomFilter(capacity, error_rate)
+        self._built_at = None
+        self._synced_at = None
+        self._seq = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def shared(self):
+        return isinstance(self.cache, RedisCache)
+
+    def _keys(self):
+        keys = [
+            self.cache.make_and_validate_key(f'{{revoked-jti}}:{name}')
+            for name in ('by-seq', 'by-exp', 'seq')
+        ]
+        return keys, self.cache._cache.get_client(keys[0], write=True)
+
+    def revoke(self, jti, exp):
+        from .models import RevokedToken
+
+        now = time.time()
+        if exp <= now:
+            return
+        if not self.shared:
+            RevokedToken.objects.bulk_create(
+                [RevokedToken(
+                    jti=jti,
+                    expires_at=datetime.fromtimestamp(exp, dt_timezone.utc),
+                )],
+                ignore_conflicts=True,
+            )
+        else:
+            keys, client = self._keys()
+            client.eval(REVOKE_SCRIPT, 3, *keys, jti, exp, now)
+        self._bloom.add(jti)
+
+    def revoke_token(self, token):
+        self.revoke(token[api_settings.JTI_CLAIM], token['exp'])
+
+    def _rebuild(self, client, keys):
+        seq = int(client.get(keys[2]) or 0)
+        entries = client.zrange(keys[0], 0, -1)
+        bloom = BloomFilter(
+            max(self.capacity, 2 * len(entries)), self.error_rate
+        )
+        for jti in entries:
+            bloom.add(jti.decode())
+        self._bloom = bloom
+        self._seq = seq
+        self._built_at = time.monotonic()
+
+    def _sync_redis(self, now):
+        keys, client = self._keys()
+        seq = int(client.get(keys[2]) or 0)
+        if (
+            self._built_at is None or seq < self._seq
+            or now - self._built_at >= self.max_age
+        ):
+            self._rebuild(client, keys)
+        elif seq > self._seq:
+            added = client.zrangebyscore(keys[0], f'({self._seq}', seq)
+            for jti in added:
+                self._bloom.add(jti.decode())
+            self._seq = seq
+
+    def _sync_database(self, now):
+        from .models import RevokedToken
+
+        live = RevokedToken.objects.filter(expires_at__gt=timezone.now())
+        if self._built_at is None or now - self._built_at >= self.max_age:
+            entries = list(live.values_list('pk', 'jti'))
+            self._bloom = BloomFilter(
+                max(self.capacity, 2 * len(entries)), self.error_rate
+            )
+            self._seq = 0
+            self._built_at = now
+        else:
+            entries = live.filter(pk__gt=self._seq).values_list('pk', 'jti')
+        for pk, jti in entries:
+            self._bloom.add(jti)
+            self._seq = max(self._seq, pk)
+
+    def _sync(self):
+        now = time.monotonic()
+        if self._synced_at is not None and (
+            now - self._synced_at < self.sync_interval
+        ):
+            return
+        with self._lock:
+            if self._synced_at is not None and (
+                now - self._synced_at < self.sync_interval
+            ):
+                return
+            if self.shared:
+                self._sync_redis(now)
+            else:
+                self._sync_database(now)
+            self._synced_at = now
+
+    def is_revoked(self, jti):
+        from .models import RevokedToken
+
+        self._sync()
+        if jti not in self._bloom:
+            return False
+        if not self.shared:
+            return RevokedToken.objects.filter(
+                jti=jti, expires_at__gt=timezone.now()
+            ).exists()
+        keys, client = self._keys()
+        exp = client.zscore(keys[1], jti)
+        return exp is not None and exp > time.time()
+
+
+def get_revocation_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = RevocationStore(
+                    alias=settings.REVOCATION_CACHE_ALIAS,
+                    sync_interval=settings.REVOCATION_SYNC_INTERVAL,
+                    capacity=settings.REVOCATION_BLOOM_CAPACITY,
+                    error_rate=settings.REVOCATION_BLOOM_ERROR_RATE,
+                    max_age=settings.REVOCATION_BLOOM_MAX_AGE,
+                )
+    return _store
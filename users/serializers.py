@@ -1,7 +1,9 @@
-from django.contrib.auth import authenticate, get_user_model
+from django.contrib.auth import get_user_model
 from rest_framework import serializers
 
-from .models import OneTimePassword
+from .attempts import get_attempt_store
+from .cache import normalize_email
+from .otp import OTP_EXPIRED, OTP_VALID, get_otp_store, redeem_otp
 
 User = get_user_model()
 
@@ -18,14 +20,30 @@ class CustomTokenObtainPairSerializer(serializers.Serializer):
     class Meta:
         fields = ['email', 'password', 'otp']
 
+    def check_otp(self, result):
+        if result == OTP_EXPIRED:
+            raise serializers.ValidationError("OTP is expired.")
+        if result != OTP_VALID:
+            raise serializers.ValidationError("Invalid OTP.")
+
     def validate(self, attrs):
+        """
+        Loads the user once and runs the cheap rejections (unverified,
+        inactive, locked out, wrong OTP) before the Argon2 check, which
+        runs against the loaded row. The OTP is only used up once the
+        password matched.
+
+        The row is read from the database rather than the user cache,
+        which does not hold password hashes.
+        """
+
         email = attrs.get("email")
         password = attrs.get("password")
         otp = attrs.get("otp")
 
         if email and password and otp:
             try:
-                user = User.objects.get(email=email)
+                user = User.objects.get(email=normalize_email(email))
                 if not user.verified:
                     raise serializers.ValidationError(
                         "Your email is not verified yet."
@@ -34,26 +52,19 @@ class CustomTokenObtainPairSerializer(serializers.Serializer):
                 raise serializers.ValidationError(
                     "User with this email does not exist."
                 )
-            if not authenticate(email=email, password=password):
+            if not user.is_active:
                 raise serializers.ValidationError("Incorrect password.")
-            try:
-                otp_instance = OneTimePassword.objects.get(user=user, otp=otp)
-                if not otp_instance.is_otp_valid():
-                    raise serializers.ValidationError("OTP is expired.")
-                if user.otp_tries > 5:
-                    raise serializers.ValidationError(
-                        "Exceeded maximum attempts to enter OTP."
-                    )
-            except OneTimePassword.DoesNotExist:
-                user.otp_tries += 1
-                user.save()
-                raise serializers.ValidationError("Invalid OTP.")
+            if not get_attempt_store().reserve(user):
+                raise serializers.ValidationError(
+                    "Exceeded maximum attempts to enter OTP."
+                )
+            self.check_otp(get_otp_store().peek(user, otp))
+            if not user.check_password(password):
+                raise serializers.ValidationError("Incorrect password.")
+            self.check_otp(redeem_otp(user, otp))
         else:
             raise serializers.ValidationError(
                 "Email, password, and OTP must be provided."
             )
-        user.otp_tries = 0
-        user.save()
-        otp_instance.delete()
         attrs["user"] = user
         return attrs
@@ -0,0 +1,22 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import get_user_cache
+from .models import User
+from .tokens import REVOKED_VERSION, set_token_version
+
+
+@receiver(post_save, sender=User)
+def sync_token_version(sender, instance, **kwargs):
+    set_token_version(instance.pk, instance.token_version)
+
+
+@receiver(post_delete, sender=User)
+def revoke_token_version(sender, instance, **kwargs):
+    set_token_version(instance.pk, REVOKED_VERSION)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    get_user_cache().invalidate(instance)
@@ -0,0 +1,48 @@
+from rest_framework.test import APIClient
+
+from .models import User
+from .tokens import issue_tokens
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def fakeredis_caches(shared_default=False):
+    """
+    CACHES with a ``redis`` RedisCache talking to an in-memory fakeredis
+    server. The default cache is locmem, or the same server with
+    ``shared_default``.
+    """
+
+    redis_cache = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/0',
+        'OPTIONS': {
+            'connection_class': fakeredis.FakeConnection,
+            'server': fakeredis.FakeServer(),
+        },
+    }
+    if shared_default:
+        return {'default': redis_cache, 'redis': redis_cache}
+    return {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'redis': redis_cache,
+    }
+
+
+def create_user(email='user@example.com', **kwargs):
+    return User.objects.create(
+        username=email.split('@')[0], email=email, first_name='First',
+        last_name='Last', **kwargs
+    )
+
+
+def token_client(user):
+    access, _ = issue_tokens(user)
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Bearer {access}')
+    return client
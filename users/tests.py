@@ -0,0 +1,848 @@
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipIf
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, transaction
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django_celery_results.models import TaskResult
+from rest_framework.test import APIClient
+
+from backend.celery import app
+from backend.tasks import send_bulk_otp_emails, send_otp_email_celery
+
+from .admin import EstimatedCountPaginator, estimate_count
+from .attempts import CacheAttemptStore, DatabaseAttemptStore
+from .bulk import _hash_all
+from .cache import UserCache, get_user_cache
+from .dispatch import dispatch_otp_email, dispatch_otp_emails
+from .export import stream_export
+from .management.commands._benchmark import swap_attributes
+from .management.commands.benchmark import SCENARIOS
+from .management.commands.calibrate_argon2 import measure
+from .maintenance import expired_otps, purge_expired, purge_in_chunks
+from .models import OneTimePassword, OutboxMessage, RevokedToken, User
+from .outbox import relay_outbox
+from .otp import (CLAIM_TIMEOUT, OTP_EXPIRED, OTP_INVALID, OTP_VALID,
+                  CacheOTPStore, DatabaseOTPStore, consume_otp, issue_otp,
+                  issue_otps, redeem_otp)
+from .revocation import RevocationStore
+from .testing import create_user, fakeredis_caches, token_client
+from .tokens import get_token_version
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class OTPStoreTestsMixin:
+    expired_status = OTP_INVALID
+
+    def get_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.get_store()
+        self.user = create_user()
+
+    def test_code_is_consumed_once(self):
+        self.store.issue(self.user, '123456')
+        self.assertEqual(self.store.consume(self.user, '123456'), OTP_VALID)
+        self.assertEqual(self.store.consume(self.user, '123456'), OTP_INVALID)
+
+    def test_wrong_code_keeps_the_issued_one(self):
+        self.store.issue(self.user, '123456')
+        self.assertEqual(self.store.consume(self.user, '654321'), OTP_INVALID)
+        self.assertEqual(self.store.peek(self.user, '123456'), OTP_VALID)
+        self.assertEqual(self.store.consume(self.user, '123456'), OTP_VALID)
+
+    def test_new_code_replaces_the_previous_one(self):
+        self.store.issue(self.user, '123456')
+        self.store.issue(self.user, '222222')
+        self.assertEqual(self.store.consume(self.user, '123456'), OTP_INVALID)
+        self.assertEqual(self.store.consume(self.user, '222222'), OTP_VALID)
+
+    @override_settings(OTP_LIFETIME=timedelta(seconds=1))
+    def test_expired_code_is_rejected(self):
+        self.store.issue(self.user, '123456')
+        time.sleep(1.1)
+        self.assertEqual(self.store.peek(self.user, '123456'),
+                         self.expired_status)
+        self.assertEqual(self.store.consume(self.user, '123456'),
+                         self.expired_status)
+
+
+class DatabaseOTPStoreTests(OTPStoreTestsMixin, TestCase):
+    expired_status = OTP_EXPIRED
+
+    def get_store(self):
+        return DatabaseOTPStore()
+
+
+class LocmemOTPStoreTests(OTPStoreTestsMixin, TestCase):
+
+    def get_store(self):
+        store = CacheOTPStore('default')
+        store.cache.clear()
+        return store
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisOTPStoreTests(OTPStoreTestsMixin, TestCase):
+
+    def setUp(self):
+        override = override_settings(CACHES=fakeredis_caches())
+        override.enable()
+        self.addCleanup(override.disable)
+        super().setUp()
+
+    def get_store(self):
+        return CacheOTPStore('redis')
+
+
+@override_settings(OTP_COALESCE_WINDOW=30, OTP_COALESCE_RESEND=True)
+class OTPCoalescingTests(TestCase):
+
+    def setUp(self):
+        caches[settings.OTP_CACHE_ALIAS].clear()
+        self.user = create_user()
+
+    def issue(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return issue_otp(self.user)
+
+    def test_repeated_requests_are_coalesced(self):
+        otp = self.issue()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.issue(), otp)
+            self.assertIsNone(self.issue())
+        self.assertEqual(consume_otp(self.user, otp), OTP_VALID)
+        self.assertNotIn(self.issue(), (None, otp))
+
+    @override_settings(OTP_COALESCE_RESEND=False)
+    def test_coalesced_requests_without_resend(self):
+        self.issue()
+        self.assertIsNone(self.issue())
+
+    def test_failed_issue_releases_the_window(self):
+        with mock.patch.object(
+            User, 'generate_otp', side_effect=DatabaseError
+        ), self.assertRaises(DatabaseError):
+            self.issue()
+        self.assertIsNotNone(self.issue())
+
+    def test_rolled_back_issue_does_not_open_the_window(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                otp = issue_otp(self.user)
+                raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertIsNone(self.issue())
+        expired = time.time() + CLAIM_TIMEOUT + 1
+        with mock.patch('time.time', return_value=expired):
+            self.assertNotIn(self.issue(), (None, otp))
+
+    def test_bulk_issue_opens_the_window_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            [otp] = issue_otps([self.user])
+        self.assertEqual(len(callbacks), 1)
+        self.assertFalse(caches[settings.OTP_CACHE_ALIAS].has_key(
+            f'otp-issued:{self.user.pk}'
+        ))
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.issue(), otp)
+
+
+class AttemptStoreTestsMixin:
+
+    def get_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.store = self.get_store()
+        self.user = create_user()
+
+    def test_lockout_after_max_tries(self):
+        for _ in range(settings.OTP_MAX_TRIES + 1):
+            self.assertTrue(self.store.reserve(self.user))
+        self.assertFalse(self.store.reserve(self.user))
+        self.assertFalse(self.store.reserve(self.user))
+
+    def test_reset_lifts_the_lockout(self):
+        for _ in range(settings.OTP_MAX_TRIES + 2):
+            self.store.reserve(self.user)
+        self.store.reset(self.user)
+        self.assertTrue(self.store.reserve(self.user))
+
+    def test_counters_are_per_user(self):
+        other = create_user('other@example.com')
+        for _ in range(settings.OTP_MAX_TRIES + 2):
+            self.store.reserve(self.user)
+        self.assertTrue(self.store.reserve(other))
+
+    def test_verification_resets_the_counter(self):
+        otp = self.user.generate_otp()
+        for _ in range(settings.OTP_MAX_TRIES + 1):
+            self.store.reserve(self.user)
+        with mock.patch('users.attempts._store', self.store):
+            result = redeem_otp(self.user, otp, verify=True)
+        self.assertEqual(result, OTP_VALID)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.verified)
+        self.assertTrue(self.store.reserve(self.user))
+
+
+class CacheAttemptStoreTestsMixin(AttemptStoreTestsMixin):
+
+    @override_settings(OTP_LOCKOUT_WINDOW=timedelta(seconds=1))
+    def test_lockout_expires(self):
+        for _ in range(settings.OTP_MAX_TRIES + 2):
+            self.store.reserve(self.user)
+        time.sleep(1.1)
+        self.assertTrue(self.store.reserve(self.user))
+
+
+class DatabaseAttemptStoreTests(AttemptStoreTestsMixin, TestCase):
+
+    def get_store(self):
+        return DatabaseAttemptStore()
+
+
+class LocmemAttemptStoreTests(CacheAttemptStoreTestsMixin, TestCase):
+
+    def get_store(self):
+        store = CacheAttemptStore('default')
+        store.cache.clear()
+        return store
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisAttemptStoreTests(CacheAttemptStoreTestsMixin, TestCase):
+
+    def setUp(self):
+        override = override_settings(CACHES=fakeredis_caches())
+        override.enable()
+        self.addCleanup(override.disable)
+        super().setUp()
+
+    def get_store(self):
+        return CacheAttemptStore('redis')
+
+
+class TokenClaimsTests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = create_user(verified=True, is_superuser=True)
+        self.client = token_client(self.user)
+
+    def test_demoting_a_superuser_revokes_tokens(self):
+        self.assertEqual(self.client.get('/api/users/').status_code, 200)
+        user = User.objects.get(pk=self.user.pk)
+        user.is_superuser = False
+        user.save()
+        self.assertEqual(self.client.get('/api/users/').status_code, 401)
+        self.assertEqual(
+            self.client.get('/api/users/export/').status_code, 401
+        )
+
+    def test_deactivation_revokes_tokens(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.is_active = False
+        user.save(update_fields=['is_active'])
+        self.assertEqual(self.client.get('/api/users/').status_code, 401)
+        user.refresh_from_db()
+        self.assertEqual(user.token_version, 1)
+
+    def test_other_changes_keep_tokens(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.first_name = 'Changed'
+        user.save()
+        user.save()
+        self.assertEqual(self.client.get('/api/users/').status_code, 200)
+
+
+class TokenVersionTests(TestCase):
+
+    def test_process_local_cache_reads_the_database(self):
+        user = create_user(verified=True)
+        client = token_client(user)
+        self.assertEqual(client.get('/api/users/').status_code, 200)
+        # A bump by another worker never reaches this process' locmem.
+        User.objects.filter(pk=user.pk).update(
+            token_version=F('token_version') + 1
+        )
+        self.assertEqual(client.get('/api/users/').status_code, 401)
+
+    @skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_shared_cache_serves_versions(self):
+        with override_settings(
+            CACHES=fakeredis_caches(), TOKEN_VERSION_CACHE_ALIAS='redis'
+        ):
+            user = create_user()
+            with self.assertNumQueries(0):
+                self.assertEqual(get_token_version(user.pk), 0)
+            user.revoke_tokens()
+            with self.assertNumQueries(0):
+                self.assertEqual(get_token_version(user.pk), 1)
+
+
+@override_settings(OTP_EMAIL_DISPATCH='outbox')
+class OutboxTests(TestCase):
+
+    def relay(self, batch_size=10, side_effect=None):
+        with mock.patch('users.outbox.current_app') as app:
+            app.send_task.side_effect = side_effect
+            published = relay_outbox(batch_size)
+        return published, app.send_task
+
+    def pending(self):
+        return OutboxMessage.objects.filter(sent_at__isnull=True).count()
+
+    def test_messages_are_relayed_once(self):
+        with mock.patch.object(send_otp_email_celery, 'delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                dispatch_otp_email('a@example.com', '1234')
+                dispatch_otp_emails([('b@example.com', '5678')])
+        delay.assert_not_called()
+        published, send_task = self.relay()
+        self.assertEqual(published, 2)
+        self.assertEqual(send_task.call_args_list, [
+            mock.call(send_otp_email_celery.name,
+                      args=['a@example.com', '1234'], producer=mock.ANY),
+            mock.call(send_bulk_otp_emails.name,
+                      args=[[['b@example.com', '5678']]], producer=mock.ANY),
+        ])
+        self.assertEqual(self.pending(), 0)
+        self.assertEqual(self.relay()[0], 0)
+
+    def test_rolled_back_messages_are_not_relayed(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            dispatch_otp_email('a@example.com', '1234')
+            raise RuntimeError
+        self.assertFalse(OutboxMessage.objects.exists())
+
+    def test_relay_publishes_in_batches(self):
+        for i in range(3):
+            dispatch_otp_email(f'user{i}@example.com', '1234')
+        self.assertEqual(self.relay(batch_size=2)[0], 2)
+        self.assertEqual(self.pending(), 1)
+        _, send_task = self.relay(batch_size=2)
+        self.assertEqual(
+            send_task.call_args.kwargs['args'], ['user2@example.com', '1234']
+        )
+        self.assertEqual(self.pending(), 0)
+
+    def test_unpublished_messages_stay_pending(self):
+        for i in range(2):
+            dispatch_otp_email(f'user{i}@example.com', '1234')
+        with self.assertLogs('users.outbox', 'ERROR'):
+            published, _ = self.relay(side_effect=[None, ConnectionError()])
+        self.assertEqual(published, 1)
+        self.assertEqual(self.pending(), 1)
+        self.assertEqual(self.relay()[0], 1)
+        self.assertEqual(self.pending(), 0)
+
+    @override_settings(OTP_EMAIL_DISPATCH='publisher')
+    def test_publisher_gets_the_email_on_commit(self):
+        with mock.patch('users.dispatch.get_publisher') as get_publisher:
+            with self.captureOnCommitCallbacks() as callbacks:
+                dispatch_otp_email('a@example.com', '1234')
+            get_publisher.assert_not_called()
+            for callback in callbacks:
+                callback()
+        get_publisher.return_value.publish.assert_called_once_with(
+            send_otp_email_celery, ('a@example.com', '1234')
+        )
+        self.assertFalse(OutboxMessage.objects.exists())
+
+
+@override_settings(
+    PASSWORD_HASHERS=['users.hashers.CalibratedArgon2PasswordHasher'],
+    ARGON2_TIME_COST=1, ARGON2_MEMORY_COST=64, ARGON2_PARALLELISM=1,
+    OTP_COALESCE_WINDOW=0,
+)
+class Argon2Tests(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        self.user = create_user(verified=True)
+        self.user.set_password('Secret-123')
+        self.user.save()
+
+    def login(self, password='Secret-123'):
+        return APIClient().post('/auth/token/login/', {
+            'email': self.user.email, 'password': password,
+            'otp': issue_otp(self.user),
+        }, format='json')
+
+    def stored_hash(self):
+        return User.objects.values_list('password', flat=True).get()
+
+    def test_login_rehashes_outdated_passwords(self):
+        old_hash = self.stored_hash()
+        with self.settings(ARGON2_MEMORY_COST=128):
+            self.assertEqual(self.login('wrong').status_code, 400)
+            self.assertEqual(self.stored_hash(), old_hash)
+            self.assertEqual(self.login().status_code, 200)
+            new_hash = self.stored_hash()
+            self.assertIn('m=128,t=1,p=1', new_hash)
+            self.assertEqual(self.login().status_code, 200)
+        self.assertEqual(self.stored_hash(), new_hash)
+        self.user.refresh_from_db()
+        self.assertEqual(get_token_version(self.user.pk),
+                         self.user.token_version)
+        self.assertEqual(self.user.token_version, 1)
+
+    def test_calibration_picks_the_strongest_costs_within_target(self):
+        # Pretend hashing takes 1 ms per MiB per pass.
+        fake = mock.Mock(side_effect=lambda t, m, p, s: t * m / 1024)
+        out = StringIO()
+        with mock.patch(
+            'users.management.commands.calibrate_argon2.measure', fake
+        ):
+            call_command('calibrate_argon2', target_ms=600,
+                         max_memory=262144, parallelism=4, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1], 'Calibrated: 512.0 ms, 256 MiB per '
+                                   'concurrent hash')
+        self.assertEqual(lines[2:], [
+            'ARGON2_TIME_COST=2', 'ARGON2_MEMORY_COST=262144',
+            'ARGON2_PARALLELISM=4',
+        ])
+        with mock.patch(
+            'users.management.commands.calibrate_argon2.measure', fake
+        ), self.assertRaises(CommandError):
+            call_command('calibrate_argon2', target_ms=1, stdout=out)
+
+    def test_measure_hashes(self):
+        self.assertGreater(measure(1, 64, 1, samples=2), 0)
+
+
+class UserCacheTests(TestCase):
+
+    def test_process_local_rows_expire_with_the_local_ttl(self):
+        cache = UserCache('default', timeout=300, local_size=16,
+                          local_ttl=0.05)
+        user = create_user()
+        caches['default'].clear()
+        self.assertFalse(cache.get_by_email(user.email).verified)
+        # A write by another worker is not invalidated here.
+        User.objects.filter(pk=user.pk).update(verified=True)
+        with self.assertNumQueries(0):
+            self.assertFalse(cache.get_by_email(user.email).verified)
+        time.sleep(0.1)
+        self.assertTrue(cache.get_by_email(user.email).verified)
+
+    def test_caches_are_looked_up_on_use(self):
+        cache = UserCache('default', timeout=300, local_size=16,
+                          local_ttl=5)
+        store = CacheAttemptStore('default')
+        with self.settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'lookup-on-use',
+        }}):
+            overridden = caches['default']
+            self.assertIs(cache.shared, overridden)
+            self.assertIs(store.cache, overridden)
+        self.assertIsNot(cache.shared, overridden)
+        self.assertIsNot(store.cache, overridden)
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class SharedUserCacheTests(TestCase):
+
+    def setUp(self):
+        override = override_settings(CACHES=fakeredis_caches())
+        override.enable()
+        self.addCleanup(override.disable)
+        self.cache = UserCache('redis', timeout=300, local_size=16,
+                               local_ttl=5)
+        patcher = mock.patch('users.cache._cache', self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def expire_invalidations(self):
+        caches['redis'].clear()
+
+    def test_lookups_are_cached(self):
+        user = create_user()
+        self.expire_invalidations()
+        self.cache.get_by_email(user.email)
+        self.cache.get_by_id(user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.cache.get_by_email(user.email).pk, user.pk)
+            self.assertEqual(self.cache.get_by_id(user.pk).pk, user.pk)
+
+    def test_password_hash_is_not_cached(self):
+        user = create_user()
+        user.set_password('Secret-123')
+        user.save()
+        self.expire_invalidations()
+        self.cache.get_by_id(user.pk)
+        key = caches['redis'].make_and_validate_key(f'user:id:{user.pk}')
+        raw = caches['redis']._cache.get_client(key).get(key)
+        self.assertNotIn(user.password.encode(), raw)
+        with self.assertNumQueries(0):
+            cached = self.cache.get_by_id(user.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(cached.check_password('Secret-123'))
+
+    def test_row_loaded_before_an_invalidation_is_not_stored(self):
+        user = create_user()
+        self.expire_invalidations()
+        stale = User.objects.get(pk=user.pk)
+
+        def load():
+            fresh = User.objects.get(pk=user.pk)
+            fresh.verified = True
+            fresh.save()
+            return stale
+
+        self.cache._get(f'user:id:{user.pk}', load, lambda row: True)
+        self.assertTrue(self.cache.get_by_id(user.pk).verified)
+
+    def test_email_change_drops_the_old_email(self):
+        user = create_user('old@example.com', verified=True)
+        self.expire_invalidations()
+        self.cache.get_by_email('old@example.com')
+        user = User.objects.get(pk=user.pk)
+        user.email = 'new@example.com'
+        user.save()
+        with self.assertRaises(User.DoesNotExist):
+            self.cache.get_by_email('old@example.com')
+        self.assertEqual(self.cache.get_by_email('new@example.com').pk,
+                         user.pk)
+        response = APIClient().post(
+            '/api/otp/', {'email': 'old@example.com'}, format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+def revocation_store(alias, sync_interval=0):
+    return RevocationStore(
+        alias, sync_interval=sync_interval, capacity=1000, error_rate=0.001,
+        max_age=3600,
+    )
+
+
+class DatabaseRevocationTests(TestCase):
+
+    def test_logout_is_seen_by_every_process(self):
+        user = create_user(verified=True)
+        client = token_client(user)
+        self.assertEqual(client.post('/auth/token/logout/').status_code, 204)
+        self.assertEqual(client.get('/api/users/').status_code, 401)
+        jti = RevokedToken.objects.get().jti
+        # A store created by another worker reads the same table.
+        self.assertTrue(revocation_store('default').is_revoked(jti))
+        self.assertFalse(revocation_store('default').is_revoked('other'))
+
+    def test_tokens_that_are_not_revoked_cost_no_query(self):
+        first = revocation_store('default', sync_interval=60)
+        second = revocation_store('default', sync_interval=60)
+        first.is_revoked('warm-up')
+        second.revoke('jti-1', time.time() + 60)
+        with self.assertNumQueries(0):
+            self.assertFalse(first.is_revoked('jti-2'))
+            # Not seen before the next sync.
+            self.assertFalse(first.is_revoked('jti-1'))
+        later = time.monotonic() + 61
+        with mock.patch('time.monotonic', return_value=later):
+            # One query to pull new revocations, one to confirm the hit.
+            with self.assertNumQueries(2):
+                self.assertTrue(first.is_revoked('jti-1'))
+            with self.assertNumQueries(0):
+                self.assertFalse(first.is_revoked('jti-2'))
+
+    def test_expired_entries_are_ignored_and_purged(self):
+        store = revocation_store('default')
+        store.revoke('fresh', time.time() + 60)
+        store.revoke('fresh', time.time() + 60)
+        store.revoke('stale', time.time() - 1)
+        RevokedToken.objects.create(
+            jti='expired', expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertTrue(store.is_revoked('fresh'))
+        self.assertFalse(store.is_revoked('stale'))
+        self.assertFalse(store.is_revoked('expired'))
+        self.assertEqual(purge_expired(pause=0)['revoked_tokens'], 1)
+        self.assertEqual(
+            list(RevokedToken.objects.values_list('jti', flat=True)),
+            ['fresh'],
+        )
+
+
+@skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisRevocationTests(TestCase):
+
+    def setUp(self):
+        override = override_settings(CACHES=fakeredis_caches())
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_revocations_reach_other_processes(self):
+        first, second = revocation_store('redis'), revocation_store('redis')
+        self.assertFalse(second.is_revoked('jti-1'))
+        first.revoke('jti-1', time.time() + 60)
+        self.assertTrue(first.is_revoked('jti-1'))
+        self.assertTrue(second.is_revoked('jti-1'))
+        self.assertFalse(second.is_revoked('jti-2'))
+        with self.assertNumQueries(0):
+            second.is_revoked('jti-1')
+        self.assertFalse(RevokedToken.objects.exists())
+
+
+class PurgeTests(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        users = [create_user(f'user{i}@example.com') for i in range(10)]
+        # Sparse matches: three expired codes spread over the id range.
+        OneTimePassword.objects.bulk_create(
+            OneTimePassword(
+                user=user, otp='123456',
+                otp_expiration=now + timedelta(
+                    minutes=-1 if i in (0, 5, 9) else 15
+                ),
+            )
+            for i, user in enumerate(users)
+        )
+        for i in range(4):
+            TaskResult.objects.create(task_id=f'task-{i}', status='SUCCESS')
+        TaskResult.objects.filter(task_id__in=['task-0', 'task-2']).update(
+            date_done=now - settings.TASK_RESULT_MAX_AGE - timedelta(hours=1)
+        )
+
+    def test_only_full_chunks_pause(self):
+        with mock.patch('time.sleep') as sleep:
+            self.assertEqual(
+                purge_in_chunks(expired_otps(), chunk_size=2, pause=1), 3
+            )
+            self.assertEqual(sleep.call_count, 1)
+            self.assertEqual(
+                purge_in_chunks(expired_otps(), chunk_size=2, pause=1), 0
+            )
+            self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(OneTimePassword.objects.count(), 7)
+
+    def test_purge_expired(self):
+        with mock.patch('time.sleep'):
+            result = purge_expired(chunk_size=1)
+        self.assertEqual(result['otps'], 3)
+        self.assertEqual(result['task_results'], 2)
+        self.assertEqual(
+            sorted(TaskResult.objects.values_list('task_id', flat=True)),
+            ['task-1', 'task-3'],
+        )
+
+    def test_dry_run_only_counts(self):
+        out = StringIO()
+        call_command('purge_expired', dry_run=True, stdout=out)
+        self.assertIn('Would delete 3 otps', out.getvalue())
+        self.assertIn('Would delete 2 task results', out.getvalue())
+        self.assertIn('Would delete 0 user imports', out.getvalue())
+        self.assertEqual(OneTimePassword.objects.count(), 10)
+        self.assertEqual(TaskResult.objects.count(), 4)
+        out = StringIO()
+        call_command('purge_expired', pause=0, stdout=out)
+        self.assertIn('Deleted 3 otps', out.getvalue())
+        self.assertEqual(OneTimePassword.objects.count(), 7)
+
+
+class ExportTests(TestCase):
+
+    def create_users(self, count, start=0):
+        User.objects.bulk_create(
+            User(username=f'user{i}', email=f'user{i}@example.com',
+                 first_name='First', last_name='Last')
+            for i in range(start, start + count)
+        )
+
+    def test_csv_escapes_formulas(self):
+        admin = create_user('admin@example.com', verified=True,
+                            is_superuser=True)
+        User.objects.create(username='-1', email='=cmd@example.com',
+                            first_name='+SUM(A1)', last_name='@x')
+        response = token_client(admin).get('/api/users/export/?output=csv')
+        content = b''.join(response.streaming_content).decode()
+        row = content.splitlines()[-1].split(',')
+        self.assertEqual(
+            row[1:], ["'-1", "'+SUM(A1)", "'@x", "'=cmd@example.com"]
+        )
+
+    def test_csv_export_imports_back(self):
+        User.objects.create(username='-1', email='=cmd@example.com',
+                            first_name='+SUM(A1)', last_name='@x')
+        lines = b''.join(stream_export(output='csv')).decode().splitlines()
+        User.objects.all().delete()
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as source:
+            source.write(f'{lines[0]},password\n{lines[1]},Secret-123\n')
+            source.flush()
+            call_command('import_users', source.name, output='csv',
+                         send_otp=False, stdout=StringIO())
+        self.assertEqual(
+            list(User.objects.values_list(
+                'username', 'email', 'first_name', 'last_name'
+            )),
+            [('-1', '=cmd@example.com', '+SUM(A1)', '@x')],
+        )
+
+    def peak_memory(self, **filters):
+        tracemalloc.start()
+        try:
+            for _ in stream_export(**filters):
+                pass
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    @override_settings(USER_EXPORT_CHUNK_SIZE=100)
+    def test_peak_memory_does_not_grow_with_rows(self):
+        # 500 against 5000 rows rather than a million to keep the suite
+        # fast; with a fixed chunk size the peak is flat either way.
+        self.create_users(500)
+        small = self.peak_memory(output='csv', compress=True)
+        self.create_users(4500, start=500)
+        large = self.peak_memory(output='csv', compress=True)
+        self.assertLess(large, small * 1.5)
+
+
+class BenchmarkCommandTests(TestCase):
+
+    def test_scenarios_run_and_roll_back(self):
+        out = StringIO()
+        call_command('benchmark', 'user-serialization', 'otp-email-batching',
+                     'task-results', 'revocation-check', 'request-metrics',
+                     rows=[5], repeat=1,
+                     smtp_handshake_ms=0, db_latency_ms=0, stdout=out)
+        self.assertIn(
+            'user-serialization [5 rows]: values rows:', out.getvalue()
+        )
+        self.assertIn('batches of 100: ', out.getvalue())
+        self.assertIn('5 sent, 1 connections', out.getvalue())
+        self.assertIn('failures: ', out.getvalue())
+        self.assertIn('0 writes per 1k tasks', out.getvalue())
+        self.assertIn('database: ', out.getvalue())
+        self.assertIn('with middleware: ', out.getvalue())
+        self.assertIn(' us per request', out.getvalue())
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(RevokedToken.objects.exists())
+
+    def test_rows_sweep(self):
+        out = StringIO()
+        scenario = SCENARIOS['user-serialization']
+        with swap_attributes(scenario, rows=(2, 3)):
+            call_command('benchmark', 'user-serialization', repeat=1,
+                         stdout=out)
+        self.assertIn('user-serialization [2 rows]: ', out.getvalue())
+        self.assertIn('user-serialization [3 rows]: ', out.getvalue())
+        self.assertEqual(scenario.rows, (1000, 10000, 100000))
+
+    def test_otp_queue_latency(self):
+        out = StringIO()
+        call_command('benchmark', 'otp-queue-latency', rows=[5], workers=2,
+                     bulk_task_ms=0, stdout=out)
+        self.assertIn('one queue: OTP wait p50: ', out.getvalue())
+        self.assertIn('dedicated queues: OTP wait p50: ', out.getvalue())
+        self.assertNotIn('benchmark.bulk_work', app.tasks)
+
+
+@override_settings(
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']
+)
+class HashPoolTests(TestCase):
+
+    def test_daemonic_workers_hash_in_threads(self):
+        with mock.patch('multiprocessing.current_process') as current:
+            current.return_value.daemon = True
+            hashes, pool = _hash_all(['a', 'b', 'c'], workers=2)
+        try:
+            self.assertIsInstance(pool, ThreadPoolExecutor)
+            hashes = list(hashes)
+        finally:
+            pool.shutdown()
+        self.assertEqual(len(hashes), 3)
+        self.assertTrue(check_password('b', hashes[1]))
+
+
+class AdminChangelistTests(TestCase):
+
+    def setUp(self):
+        self.admin = create_user('admin@example.com', is_superuser=True,
+                                 is_staff=True)
+        self.client.force_login(self.admin)
+
+    def create_users(self, count, start=0):
+        User.objects.bulk_create(
+            User(username=f'user{i}', email=f'user{i}@example.com',
+                 verified=bool(i % 2))
+            for i in range(start, start + count)
+        )
+
+    def count_queries(self, path):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        paths = [
+            '/admin/users/user/',
+            '/admin/users/user/?q=user1',
+            '/admin/users/user/?verified__exact=1',
+            '/admin/users/user/?p=2',
+        ]
+        self.create_users(60)
+        small = [self.count_queries(path) for path in paths]
+        self.create_users(240, start=60)
+        large = [self.count_queries(path) for path in paths]
+        self.assertEqual(large, small)
+
+
+class EstimateCountTests(TestCase):
+
+    def setUp(self):
+        for i in range(3):
+            create_user(f'user{i}@example.com', verified=bool(i % 2))
+
+    def test_other_databases_count_exactly(self):
+        queryset = User.objects.filter(verified=False)
+        with self.assertNumQueries(1):
+            self.assertEqual(estimate_count(queryset, 10000), 2)
+        paginator = EstimatedCountPaginator(User.objects.order_by('id'), 2)
+        self.assertEqual(paginator.count, 3)
+        self.assertEqual(paginator.num_pages, 2)
+
+    def postgres(self, row):
+        fake = mock.MagicMock(vendor='postgresql')
+        cursor = fake.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = row
+        return mock.patch('users.admin.connections', {'default': fake})
+
+    def test_postgres_estimates_large_tables(self):
+        with self.postgres((250000,)):
+            self.assertEqual(estimate_count(User.objects.all(), 10000),
+                             250000)
+        plan = [[{'Plan': {'Plan Rows': 50000}}]]
+        with self.postgres(plan):
+            self.assertEqual(
+                estimate_count(User.objects.filter(verified=True), 10000),
+                50000,
+            )
+
+    def test_postgres_counts_small_estimates_exactly(self):
+        with self.postgres((42,)):
+            self.assertEqual(estimate_count(User.objects.all(), 10000), 3)
@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from .cache import is_process_local
+
+TOKEN_VERSION_CLAIM = 'ver'
+REVOKED_VERSION = -1
+
+
+def _version_key(user_id):
+    return f'token-version:{user_id}'
+
+
+def _version_cache():
+    """
+    Returns the token version cache, or None when it is process-local: a
+    version bumped by one worker would stay stale in the others for the
+    whole token lifetime, so versions are read from the database instead.
+    """
+
+    cache = caches[settings.TOKEN_VERSION_CACHE_ALIAS]
+    return None if is_process_local(cache) else cache
+
+
+def token_versions_are_shared():
+    """
+    True when token versions are cached where every worker sees them, so
+    authentication can check them without selecting the user row.
+    """
+
+    return _version_cache() is not None
+
+
+def get_token_version(user_id):
+    """
+    Returns the current token version of a user from the cache, falling
+    back to the database on a miss. Deleted users get REVOKED_VERSION.
+    """
+
+    from .models import User
+
+    cache = _version_cache()
+    version = None if cache is None else cache.get(_version_key(user_id))
+    if version is None:
+        version = (
+            User.objects.filter(pk=user_id)
+            .values_list('token_version', flat=True)
+            .first()
+        )
+        if version is None:
+            version = REVOKED_VERSION
+        set_token_version(user_id, version)
+    return version
+
+
+def set_token_version(user_id, version):
+    cache = _version_cache()
+    if cache is None:
+        return
+    cache.set(
+        _version_key(user_id), version,
+        settings.SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'].total_seconds(),
+    )
+
+
+def set_token_versions(versions):
+    """
+    Caches the token versions of many users from a ``{user_id: version}``
+    mapping.
+    """
+
+    cache = _version_cache()
+    if cache is None:
+        return
+    cache.set_many(
+        {_version_key(pk): version for pk, version in versions.items()},
+        settings.SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'].total_seconds(),
+    )
+
+
+def add_user_claims(token, user):
+    token['is_superuser'] = user.is_superuser
+    token['verified'] = user.verified
+    token[TOKEN_VERSION_CLAIM] = user.token_version
+    return token
+
+
+def issue_tokens(user):
+    """
+    Returns an (access, refresh) token pair carrying the claims the
+    stateless authentication needs.
+    """
+
+    return (
+        add_user_claims(AccessToken.for_user(user), user),
+        add_user_claims(RefreshToken.for_user(user), user),
+    )
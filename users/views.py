@@ -4,10 +4,16 @@ from rest_framework import permissions, status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 
+from api.throttling import ClientIPThrottle, TargetEmailThrottle
+
+from .revocation import get_revocation_store
 from .serializers import CustomTokenObtainPairSerializer
+from .tokens import issue_tokens
 
 
 class CustomTokenObtainPairView(TokenObtainPairView):
@@ -16,6 +22,7 @@ class CustomTokenObtainPairView(TokenObtainPairView):
     """
 
     permission_classes = (permissions.AllowAny,)
+    throttle_classes = (ClientIPThrottle, TargetEmailThrottle)
     serializer_class = CustomTokenObtainPairSerializer
     
     @swagger_auto_schema(
@@ -46,8 +53,7 @@ class CustomTokenObtainPairView(TokenObtainPairView):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data.get("user")
-        access_token = AccessToken.for_user(user)
-        refresh_token = RefreshToken.for_user(user)
+        access_token, refresh_token = issue_tokens(user)
         response_data = {
             "auth_token": str(access_token),
             "refresh_token": str(refresh_token),
@@ -57,21 +63,41 @@ class CustomTokenObtainPairView(TokenObtainPairView):
 
 class TokenLogoutView(APIView):
     """
-    View for logging out and deleting the current user's auth token.
+    View for logging out by revoking the presented JWT tokens.
     """
 
     permission_classes = (IsAuthenticated,)
     @swagger_auto_schema(
         operation_id="Logout with JWT token",
-        operation_description="Logout user and delete JWT token.",
+        operation_description=(
+            "Revoke the access token used for the request and, if given, "
+            "its refresh token. With all_sessions every token of the user "
+            "is revoked."
+        ),
+        request_body=openapi.Schema(
+            type=openapi.TYPE_OBJECT,
+            properties={
+                'refresh_token': openapi.Schema(type=openapi.TYPE_STRING),
+                'all_sessions': openapi.Schema(type=openapi.TYPE_BOOLEAN),
+            },
+        ),
         responses={
             204: openapi.Response(
-                description="No content. Auth token successfully deleted.",
+                description="No content. Tokens successfully revoked.",
                 schema=openapi.Schema(
                     type=openapi.TYPE_OBJECT,
                     properties={204: "No Content"}
                 )
             ),
+            400: openapi.Response(
+                description="Bad request. Invalid refresh token.",
+                schema=openapi.Schema(
+                    type=openapi.TYPE_OBJECT,
+                    properties={
+                        'detail': openapi.Schema(type=openapi.TYPE_STRING)
+                    }
+                )
+            ),
             401: openapi.Response(
                 description="Unauthorized. Authentication credentials were not provided.",
                 schema=openapi.Schema(
@@ -85,11 +111,32 @@ class TokenLogoutView(APIView):
         tags=['Authentication'],
     )
     def post(self, request, *args, **kwargs):
-        try:
-            request.user.auth_token.delete()
-        except Exception:
+        access_token = request.auth
+        if access_token is None:
             return Response(
                 {'detail': 'Authentication credentials were not provided.'},
                 status=status.HTTP_401_UNAUTHORIZED
             )
+        refresh_token = request.data.get('refresh_token')
+        if refresh_token:
+            try:
+                refresh_token = RefreshToken(refresh_token)
+            except TokenError:
+                refresh_token = None
+            user_claim = api_settings.USER_ID_CLAIM
+            if (
+                refresh_token is None
+                or refresh_token[user_claim] != access_token[user_claim]
+            ):
+                return Response(
+                    {'detail': 'Invalid refresh token.'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        if request.data.get('all_sessions') in (True, 'true', 'True'):
+            getattr(request.user, 'instance', request.user).revoke_tokens()
+        else:
+            store = get_revocation_store()
+            store.revoke_token(access_token)
+            if refresh_token:
+                store.revoke_token(refresh_token)
         return Response(status=status.HTTP_204_NO_CONTENT)